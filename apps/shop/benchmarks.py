@@ -0,0 +1,114 @@
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models import Count, Q
+
+from apps.shop.models import Address, Cart, CartItem, City, Product, PurchaseReceipt
+from apps.shop.services import create_or_update_user_product_rate
+from apps.user.models import User
+from apps.user.services import generate_tokens_for_user
+from apps.utils.benchmark import Scenario
+
+BENCHMARK_PASSWORD = 'benchmark-password'
+
+
+def build_context():
+    """
+    Pick the rows the scenarios work on: the user with the longest purchase history (the expensive case),
+    one of their addresses, a product they can buy there, and an admin. Meant to run inside a transaction
+    that is rolled back, since it sets passwords and may create the admin and the address.
+    """
+    heaviest = (PurchaseReceipt.active.values('user').annotate(receipts=Count('id')).order_by('-receipts')
+                .values_list('user', flat=True).first())
+    user = User.objects.get(pk=heaviest) if heaviest else User.objects.filter(is_staff=False).first()
+    user.set_password(BENCHMARK_PASSWORD)
+    user.save(update_fields=['password'])
+    admin, _ = User.objects.get_or_create(email='benchmark-admin@example.com',
+                                          defaults={'is_staff': True, 'is_superuser': True})
+
+    address = Address.active.filter(user=user).select_related('city').first()
+    if address is None:
+        address = Address.objects.create(user=user, city=City.active.first(), address='Benchmark street')
+    products = (Product.active.filter(Q(city__isnull=True) | Q(city=address.city_id), category__is_active=True)
+                .select_related('category').order_by('id'))
+    product = products.first()
+
+    return {
+        'user': user,
+        'user_login': user.email,
+        'password': BENCHMARK_PASSWORD,
+        'user_auth': f"Bearer {generate_tokens_for_user(user)['access']}",
+        'admin_auth': f"Bearer {generate_tokens_for_user(admin)['access']}",
+        'address_id': address.id,
+        'city': address.city.name,
+        'product_id': product.id,
+        'category': product.category.name,
+        'product_ids': list(products.values_list('id', flat=True)[:100]),
+    }
+
+
+def _import_file(context):
+    rows = '\n'.join(f'Imported product {i},{1000 * i},{context["category"]}' for i in range(100))
+    return {'file': SimpleUploadedFile('products.csv', f'name,price,category\n{rows}\n'.encode()),
+            'file_format': 'csv'}
+
+
+def _open_cart_with_item(context):
+    # A fresh cart, since the user's own open cart may hold products from other cities
+    Cart.active.filter(user=context['user'], cart_status='O').update(cart_status='E')
+    cart = Cart.objects.create(user=context['user'], cart_status='O')
+    CartItem.objects.create(cart=cart, product_id=context['product_id'], quantity=1)
+    return {'cart_id': cart.id, 'address_id': context['address_id']}
+
+
+def _rated_product(context):
+    create_or_update_user_product_rate(user=context['user'], product_id=context['product_id'], rate=4)
+    return {'product_id': context['product_id']}
+
+
+SCENARIOS = [
+    Scenario('products', 'GET', 'search products'),
+    Scenario('products search', 'GET', 'search products', params=lambda c: {'search': 'smart phone'}),
+    Scenario('products fuzzy search', 'GET', 'search products', params=lambda c: {'search': 'smrt', 'fuzzy': True}),
+    Scenario('products filtered', 'GET', 'search products',
+             params=lambda c: {'category': c['category'], 'city': c['city'], 'order_by': '-price'}),
+    Scenario('products facets', 'GET', 'search products', params=lambda c: {'facets': 'category,city,price'}),
+    Scenario('products cursor', 'GET', 'search products',
+             params=lambda c: {'pagination': 'cursor', 'page_size': 100, 'order_by': 'price'}),
+    Scenario('products suggest', 'GET', 'suggest products', params=lambda c: {'q': 'sma'}),
+    Scenario('products changes', 'GET', 'product changes', auth='user_auth'),
+    Scenario('products export', 'GET', 'export products', auth='user_auth'),
+    Scenario('categories', 'GET', 'search categories'),
+    Scenario('admin create product', 'POST', 'admin create products', auth='admin_auth',
+             params=lambda c: {'name': 'Benchmark product', 'description': 'Benchmark', 'price': 1000,
+                               'category': c['category']}),
+    Scenario('admin update product', 'POST', 'admin update products', auth='admin_auth',
+             params=lambda c: {'id': c['product_id'], 'price': 2000}),
+    Scenario('admin bulk update products', 'POST', 'admin bulk update products', auth='admin_auth',
+             params=lambda c: {'patches': [{'id': pk, 'price': 1000} for pk in c['product_ids']]}),
+    Scenario('admin reprice products', 'POST', 'admin bulk update products', auth='admin_auth',
+             params=lambda c: {'filter': {'category': c['category']}, 'price': {'multiply': '1.1'}}),
+    Scenario('admin import products', 'POST', 'admin import products', auth='admin_auth', params=_import_file,
+             format='multipart'),
+    Scenario('admin create category', 'POST', 'admin create categories', auth='admin_auth',
+             params=lambda c: {'name': 'Benchmark category'}),
+    Scenario('admin update category', 'POST', 'admin update categories', auth='admin_auth',
+             params=lambda c: {'current_name': c['category'], 'new_name': 'Benchmark category'}),
+    Scenario('cart add items', 'POST', 'user add items to cart', auth='user_auth',
+             params=lambda c: [{'product_id': c['product_id'], 'quantity': 1}]),
+    Scenario('cart delete', 'POST', 'user delete cart', auth='user_auth',
+             params=lambda c: {'cart_id': Cart.objects.create(user=c['user'], cart_status='E').id}),
+    Scenario('cart purchase', 'POST', 'user purchase cart', auth='user_auth', params=_open_cart_with_item),
+    Scenario('user purchases', 'GET', 'user get purchase', auth='user_auth'),
+    Scenario('user active carts', 'GET', 'user get carts', auth='user_auth'),
+    Scenario('product comment', 'POST', 'user comment product', auth='user_auth',
+             params=lambda c: {'product_id': c['product_id'], 'comment': 'Benchmark comment'}),
+    Scenario('product rate', 'POST', 'user rate product', auth='user_auth',
+             params=lambda c: {'product_id': c['product_id'], 'rate': 5}),
+    Scenario('product rate delete', 'POST', 'user delete product rate', auth='user_auth', params=_rated_product),
+    Scenario('address create', 'POST', 'user create address', auth='user_auth',
+             params=lambda c: {'address': 'Benchmark street', 'city': c['city']}),
+    Scenario('address update', 'POST', 'user update address', auth='user_auth',
+             params=lambda c: {'address_id': c['address_id'], 'new_address': 'Benchmark avenue'}),
+    Scenario('address delete', 'POST', 'user delete address', auth='user_auth',
+             params=lambda c: {'address_id': c['address_id']}),
+    Scenario('address list', 'GET', 'user get address', auth='user_auth'),
+]
@@ -0,0 +1,124 @@
+import json
+import platform
+import subprocess
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from apps.shop import benchmarks as shop_benchmarks
+from apps.shop.models import Cart, Product, PurchaseReceipt
+from apps.shop.services import invalidate_catalog_cache
+from apps.shop.synthetic import SyntheticDataGenerator
+from apps.user import benchmarks as user_benchmarks
+from apps.user.models import User
+from apps.utils.benchmark import compare_results, run_scenario, uncovered_routes
+
+SCENARIOS = shop_benchmarks.SCENARIOS + user_benchmarks.SCENARIOS
+
+
+class Command(BaseCommand):
+    help = ('Benchmark every API route in-process: latency percentiles, queries and rows per request and peak '
+            'allocations. Runs against a fresh test database filled with synthetic data unless --existing is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--existing', action='store_true',
+                            help='Benchmark the configured database as is; every change is rolled back.')
+        parser.add_argument('--keepdb', action='store_true', help='Keep and reuse the benchmark test database.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--products', type=int, default=10000)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--carts', type=int, default=5000)
+        parser.add_argument('--ratings', type=int, default=20000)
+        parser.add_argument('--comments', type=int, default=5000)
+        parser.add_argument('--iterations', type=int, default=30)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--only', nargs='+', default=(), help='Only scenarios whose name contains one of these.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--compare', help='Fail if the results regress against this earlier --output file.')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Allowed relative p95 slowdown when comparing (default 0.25).')
+
+    def handle(self, *args, **options):
+        scenarios = [scenario for scenario in SCENARIOS
+                     if not options['only'] or any(part in scenario.name for part in options['only'])]
+        if not scenarios:
+            raise CommandError('No scenario matches --only')
+        missing = uncovered_routes(SCENARIOS, 'apps.shop.urls', 'apps.user.urls')
+        if missing:
+            self.stderr.write(self.style.WARNING(f"Routes without a scenario: {', '.join(missing)}"))
+
+        if options['existing']:
+            report = self.benchmark(scenarios, options)
+        else:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+            try:
+                if not Product.objects.exists():
+                    self.stdout.write('Generating the benchmark data set')
+                    SyntheticDataGenerator(seed=options['seed'], products=options['products'], users=options['users'],
+                                           carts=options['carts'], ratings=options['ratings'],
+                                           comments=options['comments']).generate()
+                report = self.benchmark(scenarios, options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(report, file, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if options['compare']:
+            try:
+                with open(options['compare']) as file:
+                    baseline = json.load(file)
+            except (OSError, ValueError) as exc:
+                raise CommandError(f"Cannot read {options['compare']}: {exc}")
+            regressions = compare_results(baseline['results'], report['results'], threshold=options['threshold'])
+            if regressions:
+                raise CommandError('Regressions against the baseline:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
+
+    def benchmark(self, scenarios, options):
+        invalidate_catalog_cache()
+        client = APIClient()
+        results = {}
+        # Everything, the benchmark user's password and admin included, is rolled back at the end
+        with transaction.atomic():
+            context = shop_benchmarks.build_context()
+            for scenario in scenarios:
+                result = results[scenario.name] = run_scenario(client, scenario, context,
+                                                               iterations=options['iterations'],
+                                                               warmup=options['warmup'])
+                self.stdout.write(f"{scenario.name:<30} p50 {result['p50_ms']:>9.2f}ms  "
+                                  f"p95 {result['p95_ms']:>9.2f}ms  p99 {result['p99_ms']:>9.2f}ms  "
+                                  f"{result['queries']:>3} queries  "
+                                  f"{result['rows'] if result['rows'] is not None else '-':>6} rows  "
+                                  f"{result['peak_memory_kb']:>9.1f}KB  {result['statuses']}")
+            # Exact counts: planner estimates lag behind the data until the next ANALYZE
+            dataset = {model.__name__: model.objects.count() for model in (Product, User, Cart, PurchaseReceipt)}
+            transaction.set_rollback(True)
+
+        return {
+            'meta': {
+                'created': timezone.now().isoformat(),
+                'commit': self.get_commit(),
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'iterations': options['iterations'],
+                'warmup': options['warmup'],
+                'dataset': dataset,
+            },
+            'results': results,
+        }
+
+    @staticmethod
+    def get_commit():
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.shop.product_import import PRODUCT_IMPORT_FORMATS, import_products
+
+
+class Command(BaseCommand):
+    help = 'Import products from a CSV or JSON Lines file, reporting the rows that could not be imported.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', dest='file_format', choices=PRODUCT_IMPORT_FORMATS,
+                            help='Defaults to the file extension.')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--max-errors', type=int, default=1000, help='How many row errors to print.')
+
+    def handle(self, *args, **options):
+        file_format = options['file_format'] or options['path'].rsplit('.', 1)[-1].lower()
+        if file_format not in PRODUCT_IMPORT_FORMATS:
+            raise CommandError(f"Cannot tell the format of {options['path']}, pass --format")
+
+        try:
+            with open(options['path'], 'rb') as stream:
+                report = import_products(stream, file_format, chunk_size=options['chunk_size'],
+                                         max_reported_errors=options['max_errors'])
+        except OSError as exc:
+            raise CommandError(str(exc))
+
+        for error in report['errors']:
+            messages = '; '.join(f"{field}: {' '.join(map(str, field_errors))}"
+                                 for field, field_errors in error['errors'].items())
+            self.stderr.write(f"line {error['line']}: {messages}")
+        style = self.style.WARNING if report['failed'] else self.style.SUCCESS
+        self.stdout.write(style(f"Imported {report['created']} products, {report['failed']} rows failed"))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.shop.services import rebuild_product_rating_aggregates
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized product rating aggregates from the ratings table and report drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report drifted products, exit with an error if there are any.')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        drifted = rebuild_product_rating_aggregates(chunk_size=options['chunk_size'], dry_run=options['check'])
+
+        if options['check']:
+            if drifted:
+                raise CommandError(f"{len(drifted)} products have drifted rating aggregates: "
+                                   f"{', '.join(map(str, drifted[:20]))}")
+            self.stdout.write(self.style.SUCCESS('Product rating aggregates are consistent'))
+            return
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt rating aggregates, {len(drifted)} products were fixed"))
@@ -0,0 +1,55 @@
+import asyncio
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.utils.load_replay import LoadReplay, ReplayError, load_collection
+
+
+class Command(BaseCommand):
+    help = ('Replay weighted user journeys built from the Postman collection against a running server and report '
+            'per-step latency histograms and error rates.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--collection', default=settings.BASE_DIR / 'docs' / 'postman.json')
+        parser.add_argument('--config', default=settings.BASE_DIR / 'docs' / 'load_scenarios.json',
+                            help='Journeys, their weights and the bodies and extractions of their steps.')
+        parser.add_argument('--base-url', help='Defaults to the collection base_url variable.')
+        parser.add_argument('--rate', type=float, default=5.0, help='Virtual users arriving per second.')
+        parser.add_argument('--ramp', type=float, default=10.0, help='Seconds to reach --rate.')
+        parser.add_argument('--duration', type=float, default=60.0, help='Seconds to hold --rate after the ramp.')
+        parser.add_argument('--max-users', type=int, default=100, help='Journeys running at once.')
+        parser.add_argument('--timeout', type=float, default=10.0)
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--output', help='Write the report as JSON to this file.')
+
+    def handle(self, *args, **options):
+        if options['rate'] <= 0 or options['ramp'] < 0 or options['duration'] < 0 or options['max_users'] < 1:
+            raise CommandError('--rate and --max-users must be positive, --ramp and --duration not negative')
+        try:
+            requests, defaults = load_collection(options['collection'])
+            with open(options['config']) as file:
+                config = json.load(file)
+            # OTPs only leave the server by email or SMS, so journeys read them from the shared cache
+            replay = LoadReplay(requests, config, defaults=defaults, rate=options['rate'], ramp=options['ramp'],
+                                duration=options['duration'], max_users=options['max_users'],
+                                timeout=options['timeout'], seed=options['seed'], base_url=options['base_url'],
+                                cache=cache)
+        except (OSError, ValueError, KeyError, ReplayError) as exc:
+            raise CommandError(f'Cannot set up the replay: {exc}')
+
+        report = asyncio.run(replay.run())
+
+        for name, counts in report['journeys'].items():
+            self.stdout.write(f"{name}: {counts.get('started', 0)} started, {counts.get('completed', 0)} completed, "
+                              f"{counts.get('failed', 0)} failed")
+        for name, step in report['steps'].items():
+            self.stdout.write(f"  {name:<45} {step['requests']:>6} requests  p50 {step['p50_ms']}ms  "
+                              f"p95 {step['p95_ms']}ms  p99 {step['p99_ms']}ms  errors {step['error_rate']:.1%}")
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(report, file, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
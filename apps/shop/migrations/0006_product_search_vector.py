@@ -0,0 +1,31 @@
+# Generated by Django 4.2.16 on 2026-10-18 09:56
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+from apps.utils.db import postgresql_only
+
+POPULATE_AND_INDEX_SEARCH_VECTOR = '''
+UPDATE shop_product SET search_vector =
+    setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(description, '')), 'B');
+CREATE INDEX shop_product_search_vector_gin ON shop_product USING gin (search_vector);
+'''
+
+DROP_SEARCH_VECTOR_INDEX = 'DROP INDEX IF EXISTS shop_product_search_vector_gin;'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_purchasereceipt_is_active_receiptorder_is_active'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(*postgresql_only(POPULATE_AND_INDEX_SEARCH_VECTOR, DROP_SEARCH_VECTOR_INDEX)),
+    ]
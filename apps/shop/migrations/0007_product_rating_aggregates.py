@@ -0,0 +1,36 @@
+# Generated by Django 4.2.16 on 2026-10-18 10:00
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def populate_rating_aggregates(apps, schema_editor):
+    Product = apps.get_model('shop', 'Product')
+    UserRateProduct = apps.get_model('shop', 'UserRateProduct')
+
+    aggregates = (UserRateProduct.objects.filter(is_active=True, product__isnull=False)
+                  .values('product_id').annotate(rating_sum=Sum('rate'), rating_count=Count('id')))
+    for row in aggregates.iterator():
+        Product.objects.filter(pk=row['product_id']).update(rating_sum=row['rating_sum'],
+                                                          rating_count=row['rating_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0006_product_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(populate_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 10:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_product_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='quantity',
+            field=models.IntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 10:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0008_order_quantity'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cart',
+            name='cart_status',
+            field=models.CharField(choices=[('O', 'OPEN'), ('R', 'PROCESSING'), ('P', 'PAID'), ('E', 'EXPIRED')], max_length=1),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations
+
+from apps.utils.db import postgresql_only
+
+CREATE_NAME_TRIGRAM_INDEX = '''
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX shop_product_name_trgm_gin ON shop_product USING gin (name gin_trgm_ops);
+'''
+
+DROP_NAME_TRIGRAM_INDEX = 'DROP INDEX IF EXISTS shop_product_name_trgm_gin;'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_cart_processing_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(*postgresql_only(CREATE_NAME_TRIGRAM_INDEX, DROP_NAME_TRIGRAM_INDEX)),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.16 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_product_name_trigram_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['updated', 'id'], name='shop_product_updated_id_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.16 on 2026-10-18 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0011_product_updated_id_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'id'], name='shop_address_active_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'cart_status'], name='shop_cart_active_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cartitem',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['cart', 'product'], name='shop_cartitem_active_cart_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['name', 'id'], name='shop_product_active_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['price', 'id'], name='shop_product_active_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['category', 'name'], name='shop_product_active_cat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchasereceipt',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', '-created', '-id'], name='shop_receipt_active_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userrateproduct',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'product'], name='shop_rate_active_user_idx'),
+        ),
+    ]
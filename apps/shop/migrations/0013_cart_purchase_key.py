@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 11:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0012_active_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='purchase_key',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.16 on 2026-10-18 15:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0013_cart_purchase_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -1,8 +1,12 @@
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 
 from apps.user.models import User
 from apps.utils.managers import ActiveManager
 
+# Every `active` manager query filters on is_active=True, so the hot indexes only cover active rows
+ACTIVE = models.Q(is_active=True)
+
 
 class ProductCategory(models.Model):
     name = models.CharField(max_length=100, unique=True, null=False, blank=False)
@@ -32,14 +36,28 @@ class Product(models.Model):
     updated = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
     city = models.ForeignKey(City, on_delete=models.PROTECT, null=True)
+    search_vector = SearchVectorField(null=True, editable=False)
+    rating_sum = models.IntegerField(default=0)
+    rating_count = models.IntegerField(default=0)
 
     objects = models.Manager()
     active = ActiveManager()
 
+    class Meta:
+        indexes = [
+            # Change feed: rows changed after a (updated, id) watermark
+            models.Index(fields=['updated', 'id'], name='shop_product_updated_id_idx'),
+            # Catalog pages ordered by name or price (with the keyset tiebreaker), and category listings
+            models.Index(fields=['name', 'id'], condition=ACTIVE, name='shop_product_active_name_idx'),
+            models.Index(fields=['price', 'id'], condition=ACTIVE, name='shop_product_active_price_idx'),
+            models.Index(fields=['category', 'name'], condition=ACTIVE, name='shop_product_active_cat_idx'),
+        ]
+
 
 class Order(models.Model):
     product = models.ForeignKey(Product, on_delete=models.PROTECT)
     price = models.IntegerField(null=False, blank=False)
+    quantity = models.IntegerField(default=1)
     user = models.ForeignKey(User, on_delete=models.PROTECT)
     discount = models.IntegerField(null=True, blank=False)
     created = models.DateTimeField(auto_now_add=True)
@@ -60,6 +78,12 @@ class PurchaseReceipt(models.Model):
     objects = models.Manager()
     active = ActiveManager()
 
+    class Meta:
+        indexes = [
+            # A user's receipts, newest first
+            models.Index(fields=['user', '-created', '-id'], condition=ACTIVE, name='shop_receipt_active_user_idx'),
+        ]
+
 
 class ReceiptOrder(models.Model):
     receipt = models.ForeignKey(PurchaseReceipt, on_delete=models.PROTECT)
@@ -76,18 +100,27 @@ class ReceiptOrder(models.Model):
 class Cart(models.Model):
     CART_STATUS = (
         ('O', 'OPEN'),
+        ('R', 'PROCESSING'),
         ('P', 'PAID'),
         ('E', 'EXPIRED'),
     )
     products = models.ManyToManyField(Product, through='CartItem')
     user = models.ForeignKey(User, on_delete=models.PROTECT, null=True)
     cart_status = models.CharField(max_length=1, choices=CART_STATUS, null=False, blank=False)
+    # Idempotency key of the payment for the current checkout reservation
+    purchase_key = models.CharField(max_length=32, null=True, blank=True)
     created = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
 
     objects = models.Manager()
     active = ActiveManager()
 
+    class Meta:
+        indexes = [
+            # The user's open cart, looked up on every add-to-cart
+            models.Index(fields=['user', 'cart_status'], condition=ACTIVE, name='shop_cart_active_user_idx'),
+        ]
+
 
 class CartItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.PROTECT, null=True)
@@ -98,16 +131,27 @@ class CartItem(models.Model):
     objects = models.Manager()
     active = ActiveManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['cart', 'product'], condition=ACTIVE, name='shop_cartitem_active_cart_idx'),
+        ]
+
 
 class Address(models.Model):
     city = models.ForeignKey(City, on_delete=models.PROTECT, null=True)
     address = models.CharField(max_length=250, null=False, blank=False)
     user = models.ForeignKey(User, on_delete=models.PROTECT, null=True)
+    updated = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
 
     objects = models.Manager()
     active = ActiveManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'id'], condition=ACTIVE, name='shop_address_active_user_idx'),
+        ]
+
     def __str__(self):
         return f"{str(self.city)} - {self.address}"
 
@@ -140,3 +184,8 @@ class UserRateProduct(models.Model):
 
     objects = models.Manager()
     active = ActiveManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'product'], condition=ACTIVE, name='shop_rate_active_user_idx'),
+        ]
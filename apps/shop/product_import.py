@@ -0,0 +1,110 @@
+import csv
+import json
+
+from django.db import transaction
+
+from apps.shop.models import Product
+from apps.shop.registry import category_registry, city_registry
+from apps.shop.search import get_search_backend
+from apps.shop.serializers import InImportProductRow
+from apps.shop.services import invalidate_catalog_cache
+from apps.shop.suggest import suggester
+
+PRODUCT_IMPORT_FORMATS = ('csv', 'jsonl')
+
+
+def _decode_lines(stream, decode_errors):
+    """Decode a binary stream line by line. A line that is not UTF-8 reads as blank and is noted in `decode_errors`."""
+    for line, raw in enumerate(stream, start=1):
+        try:
+            yield raw.decode('utf-8-sig' if line == 1 else 'utf-8')
+        except UnicodeDecodeError as exc:
+            decode_errors.append((line, None, {'non_field_errors': [f'Invalid UTF-8 at byte {exc.start}']}))
+            yield '\n'
+
+
+def _pop_all(items):
+    while items:
+        yield items.pop(0)
+
+
+def read_product_rows(stream, file_format):
+    """
+    Yield `(line, row, error)` for every record of a binary CSV or JSON Lines stream, reading it one line
+    at a time. CSV needs a header row; empty CSV cells count as missing values.
+    """
+    decode_errors = []
+    lines = _decode_lines(stream, decode_errors)
+    if file_format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield from _pop_all(decode_errors)
+            if None in row:
+                yield reader.line_num, None, {'non_field_errors': ['Too many columns']}
+                continue
+            yield reader.line_num, {key: value for key, value in row.items() if value not in ('', None)}, None
+        yield from _pop_all(decode_errors)
+        return
+
+    for line, text in enumerate(lines, start=1):
+        yield from _pop_all(decode_errors)
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError as exc:
+            yield line, None, {'non_field_errors': [f'Invalid JSON: {exc}']}
+            continue
+        if not isinstance(row, dict):
+            yield line, None, {'non_field_errors': ['Expected a JSON object']}
+            continue
+        yield line, row, None
+
+
+def _insert_chunk(products):
+    with transaction.atomic():
+        created = Product.objects.bulk_create(products)
+        product_ids = [product.pk for product in created if product.pk is not None]
+        if product_ids:
+            get_search_backend().index_products(product_ids)
+    return len(created)
+
+
+def import_products(stream, file_format, *, chunk_size=2000, max_reported_errors=1000):
+    """
+    Create products from a CSV or JSON Lines stream in chunks of `chunk_size`, each chunk one
+    `bulk_create` in its own transaction. Invalid rows are skipped and reported with their line number
+    (the first `max_reported_errors` of them), so memory stays flat however large the file is.
+    """
+    # Category and city names are resolved once up front instead of once per row
+    context = {'categories': category_registry.ids_by_name(), 'cities': city_registry.ids_by_name()}
+    report = {'created': 0, 'failed': 0, 'errors': []}
+
+    chunk = []
+    for line, row, errors in read_product_rows(stream, file_format):
+        if errors is None:
+            serializer = InImportProductRow(data=row, context=context)
+            if serializer.is_valid():
+                data = serializer.validated_data
+                chunk.append(Product(name=data['name'], description=data['description'], price=data['price'],
+                                     category_id=data.get('category'), city_id=data.get('city'),
+                                     is_active=data['is_active']))
+            else:
+                errors = serializer.errors
+
+        if errors is not None:
+            report['failed'] += 1
+            if len(report['errors']) < max_reported_errors:
+                report['errors'].append({'line': line, 'errors': errors})
+
+        if len(chunk) >= chunk_size:
+            report['created'] += _insert_chunk(chunk)
+            chunk = []
+
+    if chunk:
+        report['created'] += _insert_chunk(chunk)
+
+    if report['created']:
+        invalidate_catalog_cache()
+        suggester.invalidate()
+    return report
@@ -0,0 +1,72 @@
+import copy
+import threading
+import time
+
+from django.conf import settings
+
+from apps.shop.models import City, ProductCategory
+from apps.utils.cache import bump_version_on_commit, get_version
+
+
+class ModelRegistry:
+    """
+    Process-local copy of a small, rarely changing table, looked up by name or id without a query. Each
+    worker reloads its copy after REGISTRY_TTL seconds, or as soon as the table's version in the shared
+    cache moves; the save and delete signals bump that version.
+    """
+
+    def __init__(self, model, namespace):
+        self.model = model
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def _is_current(self, snapshot, version):
+        return (snapshot is not None and snapshot['version'] == version
+                and time.monotonic() - snapshot['loaded_at'] < settings.REGISTRY_TTL)
+
+    def _get_snapshot(self):
+        version = get_version(self.namespace)
+        snapshot = self._snapshot
+        if self._is_current(snapshot, version):
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if not self._is_current(snapshot, version):
+                instances = list(self.model.objects.all())
+                snapshot = self._snapshot = {
+                    'version': version,
+                    'loaded_at': time.monotonic(),
+                    'by_name': {instance.name: instance for instance in instances},
+                    'by_id': {instance.id: instance for instance in instances},
+                }
+        return snapshot
+
+    def _found(self, instance, include_inactive):
+        if instance is None or not (include_inactive or instance.is_active):
+            raise self.model.DoesNotExist(f'{self.model.__name__} matching query does not exist.')
+        # Callers get their own copy, the cached instances are shared between threads
+        return copy.copy(instance)
+
+    def get(self, name, include_inactive=False):
+        return self._found(self._get_snapshot()['by_name'].get(name), include_inactive)
+
+    def get_by_id(self, pk, include_inactive=False):
+        return self._found(self._get_snapshot()['by_id'].get(pk), include_inactive)
+
+    def ids_by_name(self):
+        """Name to id of the active rows, for resolving many names without going through `get`."""
+        return {name: instance.id for name, instance in self._get_snapshot()['by_name'].items() if instance.is_active}
+
+    def ids_containing(self, text):
+        """Ids of the rows whose name contains `text`, ignoring case, like an `icontains` lookup."""
+        text = text.casefold()
+        return [pk for pk, instance in self._get_snapshot()['by_id'].items() if text in instance.name.casefold()]
+
+    def invalidate(self):
+        bump_version_on_commit(self.namespace)
+
+
+city_registry = ModelRegistry(City, 'registry:city')
+category_registry = ModelRegistry(ProductCategory, 'registry:product_category')
@@ -0,0 +1,288 @@
+import heapq
+import math
+import re
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramWordSimilarity
+from django.db import connections, transaction
+from django.db.models import Case, F, FloatField, Value, When
+from django.db.models.functions import Cast
+from django.utils.module_loading import import_string
+
+from apps.shop.models import Product
+from apps.utils.db import is_postgresql
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return [token.casefold() for token in TOKEN_RE.findall(text or '')]
+
+
+def trigrams(text):
+    """The trigrams pg_trgm extracts: every word padded with two spaces in front and one behind."""
+    result = set()
+    for token in tokenize(text):
+        padded = f'  {token} '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+class BaseSearchBackend:
+    """
+    Full-text search over product name and description. `search` narrows a product queryset to the
+    matching rows and annotates it with a `rank` relevance score (higher is better), leaving every
+    other filter and ordering decision to the caller.
+    """
+
+    def search(self, queryset, text):
+        raise NotImplementedError
+
+    def fuzzy_search(self, queryset, text):
+        """
+        Typo-tolerant variant of `search`: products whose name shares enough trigrams with `text`
+        (word similarity of at least PRODUCT_FUZZY_SEARCH_THRESHOLD), at most `max_fuzzy_candidates` of
+        them, with the similarity as `rank`.
+        """
+        raise NotImplementedError
+
+    def index_product(self, product):
+        pass
+
+    def index_products(self, product_ids):
+        pass
+
+    def remove_product(self, product_id):
+        pass
+
+    @staticmethod
+    def unranked(queryset):
+        return queryset.annotate(rank=Value(0.0, output_field=FloatField()))
+
+    @staticmethod
+    def scored(queryset, scores):
+        """Narrow `queryset` to the ids in `scores` (`{id: score}`), with each score as `rank`."""
+        rank = Case(*[When(pk=product_id, then=Value(score)) for product_id, score in scores.items()],
+                    default=Value(0.0), output_field=FloatField())
+        return queryset.filter(pk__in=list(scores)).annotate(rank=rank)
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    Uses the GIN-indexed `Product.search_vector` tsvector column, kept in sync on save. Fuzzy search
+    goes through the pg_trgm GIN index on `name`, which applies pg_trgm.word_similarity_threshold; it is
+    set to PRODUCT_FUZZY_SEARCH_THRESHOLD for the candidate query's own transaction only.
+    """
+    config = 'simple'
+    max_fuzzy_candidates = 200
+
+    def search_vector(self):
+        return (SearchVector('name', weight='A', config=self.config) +
+                SearchVector('description', weight='B', config=self.config))
+
+    @staticmethod
+    def exact(score):
+        # ts_rank and word_similarity return real, which comes back rounded in a keyset cursor and then never
+        # equals the stored score again, so every next page would repeat the last one; double precision
+        # round-trips exactly
+        return Cast(score, FloatField())
+
+    def search(self, queryset, text):
+        terms = tokenize(text)
+        if not terms:
+            return self.unranked(queryset)
+
+        # Every term must match, each one as a prefix, to stay close to the old icontains behaviour
+        query = SearchQuery(' & '.join(f'{term}:*' for term in terms), search_type='raw', config=self.config)
+        return queryset.filter(search_vector=query).annotate(rank=self.exact(SearchRank(F('search_vector'), query)))
+
+    def fuzzy_search(self, queryset, text):
+        if not tokenize(text):
+            return self.unranked(queryset)
+        candidates = (queryset.filter(name__trigram_word_similar=text)
+                      .annotate(similarity=self.exact(TrigramWordSimilarity(text, 'name')))
+                      .order_by('-similarity').values_list('pk', 'similarity')[:self.max_fuzzy_candidates])
+        # The setting is local to the transaction, so the candidates are read here rather than whenever the
+        # caller evaluates the queryset
+        with transaction.atomic(using=queryset.db):
+            with connections[queryset.db].cursor() as cursor:
+                cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)",
+                               [str(settings.PRODUCT_FUZZY_SEARCH_THRESHOLD)])
+            scores = dict(candidates)
+        return self.scored(queryset, scores)
+
+    def index_product(self, product):
+        self.index_products([product.pk])
+
+    def index_products(self, product_ids):
+        Product.objects.filter(pk__in=product_ids).update(search_vector=self.search_vector())
+
+
+class InMemorySearchBackend(BaseSearchBackend):
+    """
+    Process-local inverted index for SQLite and test runs. The index is loaded from the database on
+    first use and then maintained from the `Product` save/delete signals.
+    """
+    name_weight = 1.0
+    description_weight = 0.4
+    max_fuzzy_candidates = 200
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._documents = None
+        self._postings = {}
+        self._vocabulary = []
+        self._vocabulary_dirty = False
+        self._name_trigrams = {}
+        self._trigram_postings = {}
+
+    def _ensure_loaded(self):
+        if self._documents is not None:
+            return
+        with self._lock:
+            if self._documents is not None:
+                return
+            self._documents = {}
+            self._postings = {}
+            self._name_trigrams = {}
+            self._trigram_postings = {}
+            for product_id, name, description in Product.objects.values_list('id', 'name', 'description').iterator():
+                self._add(product_id, name, description)
+
+    def _add(self, product_id, name, description):
+        self._discard(product_id)
+        weights = {}
+        for token in tokenize(name):
+            weights[token] = weights.get(token, 0) + self.name_weight
+        for token in tokenize(description):
+            weights[token] = weights.get(token, 0) + self.description_weight
+
+        self._documents[product_id] = weights
+        for token, weight in weights.items():
+            self._postings.setdefault(token, {})[product_id] = weight
+        self._vocabulary_dirty = True
+
+        name_trigrams = self._name_trigrams[product_id] = trigrams(name)
+        for trigram in name_trigrams:
+            self._trigram_postings.setdefault(trigram, set()).add(product_id)
+
+    def _discard(self, product_id):
+        for trigram in self._name_trigrams.pop(product_id, ()):
+            posting = self._trigram_postings[trigram]
+            posting.discard(product_id)
+            if not posting:
+                del self._trigram_postings[trigram]
+
+        weights = self._documents.pop(product_id, None)
+        if not weights:
+            return
+        for token in weights:
+            posting = self._postings[token]
+            posting.pop(product_id, None)
+            if not posting:
+                del self._postings[token]
+        self._vocabulary_dirty = True
+
+    def _expand(self, term):
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self._postings)
+            self._vocabulary_dirty = False
+
+        position = bisect_left(self._vocabulary, term)
+        while position < len(self._vocabulary) and self._vocabulary[position].startswith(term):
+            yield self._vocabulary[position]
+            position += 1
+
+    def scores(self, text):
+        terms = tokenize(text)
+        if not terms:
+            return None
+
+        self._ensure_loaded()
+        with self._lock:
+            total = len(self._documents) or 1
+            scores = None
+            for term in terms:
+                term_scores = {}
+                for token in self._expand(term):
+                    posting = self._postings[token]
+                    idf = math.log(1 + total / len(posting))
+                    for product_id, weight in posting.items():
+                        term_scores[product_id] = term_scores.get(product_id, 0) + weight * idf
+
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {product_id: scores[product_id] + score
+                              for product_id, score in term_scores.items() if product_id in scores}
+                if not scores:
+                    break
+
+        return scores
+
+    def fuzzy_scores(self, text):
+        # Shared trigrams over the trigrams of `text`: pg_trgm's word_similarity, give or take word order
+        query = trigrams(text)
+        if not query:
+            return None
+        self._ensure_loaded()
+        threshold = settings.PRODUCT_FUZZY_SEARCH_THRESHOLD
+        with self._lock:
+            shared = {}
+            for trigram in query:
+                for product_id in self._trigram_postings.get(trigram, ()):
+                    shared[product_id] = shared.get(product_id, 0) + 1
+        scores = ((product_id, count / len(query)) for product_id, count in shared.items())
+        return {product_id: score for product_id, score in scores if score >= threshold}
+
+    def search(self, queryset, text):
+        # Every match is kept, as with the tsvector search: only the fuzzy candidates are capped
+        return self.ranked(queryset, self.scores(text))
+
+    def fuzzy_search(self, queryset, text):
+        return self.ranked(queryset, self.fuzzy_scores(text), self.max_fuzzy_candidates)
+
+    def ranked(self, queryset, scores, limit=None):
+        if scores is None:
+            return self.unranked(queryset)
+        if limit is not None and len(scores) > limit:
+            # Keep the best `limit` matches among the rows the queryset's own filters let through
+            allowed = queryset.filter(pk__in=list(scores)).values_list('pk', flat=True)
+            scores = dict(heapq.nlargest(limit, ((pk, scores[pk]) for pk in allowed), key=lambda item: item[1]))
+        return self.scored(queryset, scores)
+
+    def index_product(self, product):
+        if self._documents is None:
+            return
+        with self._lock:
+            self._add(product.pk, product.name, product.description)
+
+    def index_products(self, product_ids):
+        if self._documents is None:
+            return
+        rows = Product.objects.filter(pk__in=product_ids).values_list('id', 'name', 'description')
+        with self._lock:
+            for product_id, name, description in rows:
+                self._add(product_id, name, description)
+
+    def remove_product(self, product_id):
+        if self._documents is None:
+            return
+        with self._lock:
+            self._discard(product_id)
+
+
+_backend = None
+
+
+def get_search_backend():
+    global _backend
+    if _backend is None:
+        backend_path = settings.PRODUCT_SEARCH_BACKEND
+        if not backend_path:
+            backend_path = ('apps.shop.search.PostgresSearchBackend' if is_postgresql()
+                            else 'apps.shop.search.InMemorySearchBackend')
+        _backend = import_string(backend_path)()
+    return _backend
@@ -1,9 +1,32 @@
-from django.db import transaction
-from django.db.models import Q, Sum
+from collections import Counter
+from datetime import timedelta
 
-from apps.shop.models import (Product, ProductCategory, Cart, CartItem, PurchaseReceipt)
+from django.conf import settings
+from django.db import transaction
+from django.db.models import (Case, Count, DecimalField, ExpressionWrapper, F, FloatField, IntegerField, Max, Sum,
+                              Value, When)
+from django.db.models.functions import Cast, Greatest, NullIf, Round
+from django.utils import timezone
+
+from apps.shop.models import (Product, ProductCategory, City, Cart, CartItem, PurchaseReceipt, Address)
+from apps.shop.search import get_search_backend
+from apps.shop.registry import category_registry, city_registry
+from apps.shop.services import invalidate_catalog_cache
+from apps.shop.suggest import suggester
+from apps.shop.serializers import OutGetProducts, OutGetCategories, OutGetUserCarts, OutPurchaseReceiptSerializer
+from apps.utils.cache import get_version
+from apps.utils.querysets import shape_queryset
 from apps.utils.exceptions import TooManyItemsException
 
+PRODUCT_RATING = ExpressionWrapper(Cast('rating_sum', FloatField()) / NullIf('rating_count', Value(0)),
+                                   output_field=FloatField())
+
+# Unrated products have no rating and always sort last
+PRODUCT_ORDERINGS = {
+    'rating': F('rating').asc(nulls_last=True),
+    '-rating': F('rating').desc(nulls_last=True),
+}
+
 
 def search_products(validated_data):
     search = validated_data.get('search', '')
@@ -11,15 +34,15 @@ def search_products(validated_data):
     min_price = validated_data.get('min_price')
     max_price = validated_data.get('max_price')
     city = validated_data.get('city')
-    order_by = validated_data.get('order_by', 'name')
-
-    queryset = Product.active.filter(is_active=True)
+    order_by = validated_data.get('order_by')
 
-    if search:
-        queryset = queryset.filter(Q(name__icontains=search) | Q(description__icontains=search))
+    queryset = Product.active.filter(is_active=True).annotate(rating=PRODUCT_RATING)
 
     if category:
-        queryset = queryset.filter(category__name=category)
+        try:
+            queryset = queryset.filter(category_id=category_registry.get(category, include_inactive=True).id)
+        except ProductCategory.DoesNotExist:
+            queryset = queryset.none()
 
     if min_price is not None:
         queryset = queryset.filter(price__gte=min_price)
@@ -28,12 +51,84 @@ def search_products(validated_data):
         queryset = queryset.filter(price__lte=max_price)
 
     if city is not None:
-        queryset = queryset.filter(city__name__icontains=city)
+        queryset = queryset.filter(city_id__in=city_registry.ids_containing(city))
 
-    queryset = queryset.order_by(order_by)
+    # Searched last, so that backends which cap their matches only drop rows the filters would keep
+    if search and validated_data.get('fuzzy'):
+        queryset = get_search_backend().fuzzy_search(queryset, search)
+    elif search:
+        queryset = get_search_backend().search(queryset, search)
+
+    # Searches are ordered by relevance unless the client asked for a specific order
+    if order_by is None:
+        order_by = ('-rank', 'name') if search else ('name',)
+    else:
+        order_by = (PRODUCT_ORDERINGS.get(order_by, order_by),)
+
+    queryset = shape_queryset(queryset.order_by(*order_by), OutGetProducts)
     return queryset
 
 
+def get_price_buckets():
+    bounds = settings.PRODUCT_PRICE_FACET_BOUNDS
+    return list(zip([0] + bounds, bounds + [None]))
+
+
+def get_product_facets(validated_data, facets):
+    """
+    Category, city and price bucket counts for the filtered products, from one query grouped by all
+    three at once; the per-facet counts are summed up from its rows and named through the registries.
+    """
+    buckets = get_price_buckets()
+    price_bucket = Case(*[When(price__lt=upper, then=Value(index)) for index, (_, upper) in enumerate(buckets[:-1])],
+                        default=Value(len(buckets) - 1), output_field=IntegerField())
+    rows = (search_products(validated_data).order_by().prefetch_related(None)
+            .values('category_id', 'city_id', bucket=price_bucket).annotate(count=Count('id')))
+
+    counts = {'category': Counter(), 'city': Counter(), 'price': Counter()}
+    for row in rows:
+        counts['category'][row['category_id']] += row['count']
+        counts['city'][row['city_id']] += row['count']
+        counts['price'][row['bucket']] += row['count']
+
+    result = {}
+    for facet, registry in (('category', category_registry), ('city', city_registry)):
+        if facet in facets:
+            values = [{'id': pk, 'name': registry.get_by_id(pk, include_inactive=True).name, 'count': count}
+                      for pk, count in counts[facet].items() if pk is not None]
+            result[facet] = sorted(values, key=lambda value: (-value['count'], value['name']))
+    if 'price' in facets:
+        result['price'] = [{'min': lower, 'max': upper, 'count': counts['price'][index]}
+                           for index, (lower, upper) in enumerate(buckets)]
+    return result
+
+
+def get_product_changes():
+    """
+    Every product, deactivated ones included, in (updated, id) order for the change feed. Rows changed in
+    the last PRODUCT_CHANGES_LAG seconds are held back: a transaction still in flight may commit a row
+    with an earlier `updated`, and a watermark past it would skip that row for good.
+    """
+    settled = timezone.now() - timedelta(seconds=settings.PRODUCT_CHANGES_LAG)
+    queryset = Product.objects.filter(updated__lt=settled).annotate(rating=PRODUCT_RATING).order_by('updated', 'id')
+    return shape_queryset(queryset, OutGetProducts)
+
+
+PRODUCT_EXPORT_FIELDS = ['id', 'name', 'description', 'price', 'category_name', 'city_name', 'rating_sum',
+                         'rating_count', 'created', 'updated']
+
+
+def get_products_export_rows(chunk_size=2000):
+    """
+    Every active product as a plain dict, category and city names joined in, read through a server-side
+    cursor `chunk_size` rows at a time so memory does not grow with the catalog.
+    """
+    return (Product.active.order_by('id')
+            .values('id', 'name', 'description', 'price', 'rating_sum', 'rating_count', 'created', 'updated',
+                    category_name=F('category__name'), city_name=F('city__name'))
+            .iterator(chunk_size=chunk_size))
+
+
 def search_categories(validated_data):
     search = validated_data.get('search', '')
     order_by = validated_data.get('order_by', 'name')
@@ -43,33 +138,117 @@ def search_categories(validated_data):
     if search:
         queryset = queryset.filter(name__icontains=search)
 
-    queryset = queryset.order_by(order_by)
+    queryset = shape_queryset(queryset.order_by(order_by), OutGetCategories)
     return queryset
 
 
 def create_product(validated_data):
-    return Product.active.create(**validated_data)
+    product = Product.active.create(**validated_data)
+    invalidate_catalog_cache()
+    return product
 
 
 def update_product(validated_data):
     product = Product.active.get(id=validated_data['id'])
+    changed = []
     for attr, value in validated_data.items():
-        setattr(product, attr, value)
-    product.save()
+        field = Product._meta.get_field(attr)
+        new_value = value.pk if field.is_relation and value is not None else value
+        if getattr(product, field.attname) != new_value:
+            setattr(product, attr, value)
+            changed.append(attr)
+
+    # Only the changed columns are written; `updated` is refreshed by auto_now when it is listed
+    if changed:
+        product.save(update_fields=changed + ['updated'])
+        invalidate_catalog_cache()
     return product
 
 
+def bulk_update_products(patches):
+    """
+    Apply `{id, field: value, ...}` patches with one `bulk_update` per distinct set of patched fields,
+    writing only those columns and `updated`. Returns the number of updated products and the ids that
+    do not exist.
+    """
+    patches_by_id = {patch['id']: {attr: value for attr, value in patch.items() if attr != 'id'} for patch in patches}
+    fields = {attr for patch in patches_by_id.values() for attr in patch}
+    products = Product.objects.only('id', *fields).in_bulk(patches_by_id)
+
+    now = timezone.now()
+    groups = {}
+    for product_id, patch in patches_by_id.items():
+        product = products.get(product_id)
+        if product is None or not patch:
+            continue
+        for attr, value in patch.items():
+            setattr(product, attr, value)
+        product.updated = now
+        groups.setdefault(tuple(sorted(patch)), []).append(product)
+
+    with transaction.atomic():
+        for group_fields, group in groups.items():
+            Product.objects.bulk_update(group, [*group_fields, 'updated'], batch_size=500)
+
+    updated_ids = [product.id for group in groups.values() for product in group]
+    if updated_ids:
+        # bulk_update sends no signals, so refresh what the save signals would have
+        reindexed = [product.id for group_fields, group in groups.items()
+                     if {'name', 'description'} & set(group_fields) for product in group]
+        if reindexed:
+            get_search_backend().index_products(reindexed)
+        if {'name', 'is_active'} & fields:
+            suggester.invalidate()
+        invalidate_catalog_cache()
+    return len(updated_ids), sorted(set(patches_by_id) - set(products))
+
+
+def reprice_products(filters, multiply=None, add=None):
+    """Change the price of every product matching `filters` in a single UPDATE; returns the row count."""
+    queryset = Product.objects.all()
+    if 'ids' in filters:
+        queryset = queryset.filter(pk__in=filters['ids'])
+    try:
+        if 'category' in filters:
+            queryset = queryset.filter(category_id=category_registry.get(filters['category']).id)
+        if 'city' in filters:
+            queryset = queryset.filter(city_id=city_registry.get(filters['city']).id)
+    except (ProductCategory.DoesNotExist, City.DoesNotExist):
+        return 0
+    if 'min_price' in filters:
+        queryset = queryset.filter(price__gte=filters['min_price'])
+    if 'max_price' in filters:
+        queryset = queryset.filter(price__lte=filters['max_price'])
+
+    price = F('price')
+    if multiply is not None:
+        price = Round(price * Value(multiply, output_field=DecimalField(max_digits=8, decimal_places=4)))
+    if add is not None:
+        price = price + add
+    updated = queryset.update(price=Greatest(Cast(price, IntegerField()), Value(0)), updated=timezone.now())
+    if updated:
+        invalidate_catalog_cache()
+    return updated
+
+
 def create_category(validated_data):
-    return ProductCategory.active.create(**validated_data)
+    category = ProductCategory.active.create(**validated_data)
+    invalidate_catalog_cache()
+    return category
 
 
 def update_category(validated_data):
     category = ProductCategory.active.get(name=validated_data['current_name'])
+    before = (category.name, category.is_active)
     if 'new_name' in validated_data:
         category.name = validated_data['new_name']
     if 'is_active' in validated_data:
         category.is_active = validated_data['is_active']
     category.save()
+    # Products show their category, so a real change counts as a change of every product for the change feed
+    if (category.name, category.is_active) != before:
+        Product.objects.filter(category=category).update(updated=timezone.now())
+    invalidate_catalog_cache()
     return category
 
 
@@ -83,19 +262,6 @@ def get_or_create_active_cart(user):
     return cart
 
 
-def add_item_to_cart(cart, product_id, quantity):
-    product = Product.active.get(id=product_id)
-    cart_item, created = CartItem.active.get_or_create(
-        cart=cart,
-        product=product,
-        defaults={'quantity': quantity}
-    )
-    if not created:
-        cart_item.quantity += quantity
-        cart_item.save()
-    return cart_item
-
-
 @transaction.atomic
 def process_add_items_to_cart(user, items_data):
     cart = get_or_create_active_cart(user)
@@ -105,17 +271,53 @@ def process_add_items_to_cart(user, items_data):
     if cart_products_count + len(items_data) > 10:
         raise TooManyItemsException()
 
+    product_ids = {item_data['product_id'] for item_data in items_data}
+    products = Product.active.only('id', 'name', 'price').in_bulk(product_ids)
+    if len(products) != len(product_ids):
+        raise Product.DoesNotExist('Product matching query does not exist.')
+
+    existing_items = {}
+    for cart_item in CartItem.active.select_for_update().filter(cart=cart, product_id__in=product_ids).order_by('id'):
+        existing_items.setdefault(cart_item.product_id, cart_item)
+
+    new_items = {}
     cart_items = []
     for item_data in items_data:
-        cart_item = add_item_to_cart(cart, item_data['product_id'], item_data['quantity'])
+        product = products[item_data['product_id']]
+        cart_item = existing_items.get(product.id) or new_items.get(product.id)
+        if cart_item is None:
+            cart_item = new_items[product.id] = CartItem(cart=cart, product=product, quantity=0)
+        cart_item.product = product
+        cart_item.quantity += item_data['quantity']
         cart_items.append(cart_item)
 
+    if new_items:
+        CartItem.active.bulk_create(new_items.values())
+    if existing_items:
+        CartItem.active.bulk_update(existing_items.values(), ['quantity'])
+
     return cart, cart_items
 
 
 def get_user_purchase_receipts(user, **filters):
-    return PurchaseReceipt.active.filter(user=user)
+    # Newest first; orders and their products are prefetched with only the serialized columns
+    queryset = PurchaseReceipt.active.filter(user=user).order_by('-created', '-id')
+    return shape_queryset(queryset, OutPurchaseReceiptSerializer)
 
 
 def get_user_open_carts(user, **filters):
-    return Cart.active.filter(user=user, cart_status='O')
+    return shape_queryset(Cart.active.filter(user=user, cart_status='O'), OutGetUserCarts)
+
+
+def get_user_addresses_validators(user):
+    # Addresses show their city's name, so the cities' version counts too
+    stats = Address.active.filter(user=user).aggregate(count=Count('id'), updated=Max('updated'))
+    return {'user': user.pk, 'cities': get_version(city_registry.namespace), **stats}
+
+
+def get_user_carts_validators(user):
+    # The listing shows each open cart's status and products, and cart items are only ever added, so the
+    # counts and the newest ids move whenever it changes
+    stats = Cart.active.filter(user=user, cart_status='O').aggregate(
+        carts=Count('id', distinct=True), last_cart=Max('id'), items=Count('cartitem'), last_item=Max('cartitem__id'))
+    return {'user': user.pk, **stats}
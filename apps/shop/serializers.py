@@ -1,17 +1,46 @@
+from decimal import Decimal
+
 from rest_framework import serializers
 
 from apps.shop.models import *
+from apps.shop.registry import category_registry
 from apps.shop.services import user_purchase_order
 from apps.utils.exceptions import (TooManyItemsException, UserCartAddressCityDoesNotMatch, EmptyCartException)
 
 
+PRODUCT_FACETS = ('category', 'city', 'price')
+
+
 class InGetProducts(serializers.Serializer):
     search = serializers.CharField(required=False, allow_blank=True)
     category = serializers.CharField(required=False, allow_blank=True)
     min_price = serializers.IntegerField(required=False, min_value=0)
     max_price = serializers.IntegerField(required=False, min_value=0)
     city = serializers.CharField(required=False, allow_blank=True)
-    order_by = serializers.ChoiceField(choices=['name', 'price', '-name', '-price', 'city', '-city'], required=False)
+    order_by = serializers.ChoiceField(choices=['name', 'price', '-name', '-price', 'city', '-city',
+                                                'rating', '-rating'], required=False)
+    # Typo-tolerant trigram matching on the product name instead of full-text search
+    fuzzy = serializers.BooleanField(required=False, default=False)
+    # Comma separated, e.g. `facets=category,city,price`
+    facets = serializers.CharField(required=False, allow_blank=True)
+
+    @classmethod
+    def validate_facets(cls, value):
+        facets = sorted({facet.strip() for facet in value.split(',') if facet.strip()})
+        unknown = set(facets) - set(PRODUCT_FACETS)
+        if unknown:
+            raise serializers.ValidationError(f"Unknown facets: {', '.join(sorted(unknown))}")
+        return facets
+
+
+class InSuggestProducts(serializers.Serializer):
+    q = serializers.CharField(max_length=100)
+    limit = serializers.IntegerField(required=False, min_value=1, max_value=20, default=10)
+
+
+class InExportProducts(serializers.Serializer):
+    # Not called `format`, which DRF reserves for choosing the renderer
+    export_format = serializers.ChoiceField(choices=['ndjson', 'csv'], required=False, default='ndjson')
 
 
 class ProductCategorySerializer(serializers.ModelSerializer):
@@ -29,10 +58,12 @@ class ProductCitySerializer(serializers.ModelSerializer):
 class OutGetProducts(serializers.ModelSerializer):
     category = ProductCategorySerializer(read_only=True)
     city = ProductCitySerializer(read_only=True)
+    rating = serializers.FloatField(read_only=True)
 
     class Meta:
         model = Product
-        fields = ['id', 'name', 'description', 'price', 'category', 'created', 'updated', 'is_active', 'city']
+        fields = ['id', 'name', 'description', 'price', 'category', 'created', 'updated', 'is_active', 'city',
+                  'rating', 'rating_count']
 
 
 class InGetCategories(serializers.Serializer):
@@ -57,7 +88,7 @@ class OutOrderSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Order
-        fields = ['id', 'price', 'product', 'discount']
+        fields = ['id', 'price', 'quantity', 'product', 'discount']
 
 
 class OutPurchaseReceiptSerializer(serializers.ModelSerializer):
@@ -65,7 +96,7 @@ class OutPurchaseReceiptSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = PurchaseReceipt
-        fields = ['items', 'price', 'user']
+        fields = ['id', 'items', 'price', 'user', 'created']
 
 
 class InGetUserCarts(serializers.Serializer):
@@ -96,7 +127,7 @@ class InAdminCreateProducts(serializers.ModelSerializer):
     @classmethod
     def validate_category(cls, value):
         try:
-            return ProductCategory.active.get(name=value)
+            return category_registry.get(value)
         except ProductCategory.DoesNotExist:
             raise serializers.ValidationError("Invalid category")
 
@@ -109,6 +140,41 @@ class OutAdminCreateProducts(serializers.ModelSerializer):
         fields = ['id', 'name', 'description', 'price', 'category', 'created', 'updated', 'is_active']
 
 
+class InAdminImportProducts(serializers.Serializer):
+    file = serializers.FileField()
+    file_format = serializers.ChoiceField(choices=['csv', 'jsonl'], required=False)
+
+    def validate(self, attrs):
+        if 'file_format' not in attrs:
+            extension = attrs['file'].name.rsplit('.', 1)[-1].lower()
+            if extension not in ('csv', 'jsonl'):
+                raise serializers.ValidationError({'file_format': 'Cannot tell the format from the file name'})
+            attrs['file_format'] = extension
+        return attrs
+
+
+class InImportProductRow(serializers.Serializer):
+    """One imported product. Category and city names are resolved from `categories`/`cities` in the context."""
+    name = serializers.CharField(max_length=100)
+    description = serializers.CharField(required=False, allow_blank=True, default='')
+    price = serializers.IntegerField(min_value=0)
+    category = serializers.CharField(required=False)
+    city = serializers.CharField(required=False)
+    is_active = serializers.BooleanField(required=False, default=True)
+
+    def validate_category(self, value):
+        try:
+            return self.context['categories'][value]
+        except KeyError:
+            raise serializers.ValidationError("Invalid category")
+
+    def validate_city(self, value):
+        try:
+            return self.context['cities'][value]
+        except KeyError:
+            raise serializers.ValidationError("Invalid city")
+
+
 class InAdminUpdateProducts(serializers.ModelSerializer):
     category = serializers.CharField(required=False)
     id = serializers.IntegerField(required=True)
@@ -126,7 +192,7 @@ class InAdminUpdateProducts(serializers.ModelSerializer):
     @classmethod
     def validate_category(cls, value):
         try:
-            return ProductCategory.active.get(name=value)
+            return category_registry.get(value)
         except ProductCategory.DoesNotExist:
             raise serializers.ValidationError("Invalid category")
 
@@ -159,6 +225,70 @@ class InAdminUpdateCategory(serializers.ModelSerializer):
         fields = ['current_name', 'new_name', 'is_active']
 
 
+class InAdminProductPatch(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField(max_length=100, required=False)
+    description = serializers.CharField(required=False, allow_blank=True)
+    price = serializers.IntegerField(min_value=0, required=False)
+    category = serializers.CharField(required=False)
+    is_active = serializers.BooleanField(required=False)
+
+    @classmethod
+    def validate_category(cls, value):
+        try:
+            return category_registry.get(value)
+        except ProductCategory.DoesNotExist:
+            raise serializers.ValidationError("Invalid category")
+
+
+class InAdminProductFilter(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, max_length=10000)
+    category = serializers.CharField(required=False)
+    city = serializers.CharField(required=False)
+    min_price = serializers.IntegerField(required=False, min_value=0)
+    max_price = serializers.IntegerField(required=False, min_value=0)
+    # Matching every product, inactive ones included, has to be asked for explicitly
+    all = serializers.BooleanField(required=False, default=False)
+
+    def validate(self, attrs):
+        if not attrs['all'] and attrs.keys() == {'all'}:
+            raise serializers.ValidationError('Give at least one filter, or all: true to match every product')
+        return attrs
+
+
+class InAdminPriceChange(serializers.Serializer):
+    """New price = round(price * multiply + add), never below zero."""
+    multiply = serializers.DecimalField(max_digits=8, decimal_places=4, min_value=Decimal('0.0001'), required=False)
+    add = serializers.IntegerField(required=False)
+
+    def validate(self, attrs):
+        if not attrs:
+            raise serializers.ValidationError('Give multiply, add or both')
+        return attrs
+
+
+class InAdminBulkUpdateProducts(serializers.Serializer):
+    """Either `patches`, or `filter` together with a `price` change."""
+    patches = InAdminProductPatch(many=True, required=False)
+    filter = InAdminProductFilter(required=False)
+    price = InAdminPriceChange(required=False)
+
+    def validate_patches(self, value):
+        if len(value) > 1000:
+            raise serializers.ValidationError('At most 1000 patches per request')
+        if len({patch['id'] for patch in value}) != len(value):
+            raise serializers.ValidationError('Each product can only be patched once per request')
+        return value
+
+    def validate(self, attrs):
+        if 'patches' in attrs:
+            if 'filter' in attrs or 'price' in attrs:
+                raise serializers.ValidationError('Send either patches or a filter with a price change')
+        elif 'filter' not in attrs or 'price' not in attrs:
+            raise serializers.ValidationError('A filter needs a price change and the other way around')
+        return attrs
+
+
 class OutAdminUpdateProducts(serializers.ModelSerializer):
     category = serializers.StringRelatedField()
 
@@ -206,6 +336,10 @@ class InUserRateProduct(serializers.ModelSerializer):
         fields = ['product_id', 'rate']
 
 
+class InUserDeleteProductRate(serializers.Serializer):
+    product_id = serializers.IntegerField()
+
+
 class InUserAddAddress(serializers.Serializer):
     address = serializers.CharField(max_length=250, required=True)
     city = serializers.CharField(max_length=50, required=True)
@@ -1,35 +1,105 @@
+import logging
+import uuid
 from typing import Union
-from django.db.models import Sum
-
-from apps.shop.models import (Product, Post, Comment, UserRateProduct, Address, City, Cart)
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from apps.shop.models import (Product, Post, Comment, UserRateProduct, Address, City, Cart, CartItem, Order,
+                              PurchaseReceipt, ReceiptOrder)
+from apps.shop.registry import city_registry
 from apps.user.models import User
-from apps.utils.exceptions import EmptyCartException, UserCartAddressCityDoesNotMatch
+from apps.utils.cache import bump_version_on_commit
+from apps.utils.exceptions import (EmptyCartException, UserCartAddressCityDoesNotMatch, CartNotOpenException,
+                                   PaymentGatewayException, PaymentGatewayUnavailable)
 from apps.utils.purchase_gateway import purchase_gateway
 
+logger = logging.getLogger(__name__)
+
+CATALOG_CACHE_NAMESPACE = 'catalog'
+
+
+def invalidate_catalog_cache():
+    bump_version_on_commit(CATALOG_CACHE_NAMESPACE)
+
 
 def create_user_comment(*, user: User, comment: str, product_id: int, post: Union[Post, None]):
     product = Product.active.get(id=product_id)
     Comment.objects.create(user=user, comment=comment, product=product, post=post)
 
 
-def create_or_update_user_product_rate(*, user: User, product_id: int, rate: int):
-    product = Product.active.get(id=product_id)
-    previous_rate = UserRateProduct.objects.filter(user=user, product=product)
-    if previous_rate.exists():
-        previous_rate.delete()
+def adjust_product_rating(*, product_id: int, rate_delta: int, count_delta: int):
+    Product.objects.filter(pk=product_id).update(rating_sum=F('rating_sum') + rate_delta,
+                                                 rating_count=F('rating_count') + count_delta,
+                                                 updated=timezone.now())
+    # Cached catalog pages keep the old rating until CATALOG_CACHE_TIMEOUT: bumping the catalog version here
+    # would throw away every cached page on every rating
 
-    UserRateProduct.objects.create(user=user, product=product, rate=rate)
+
+@transaction.atomic
+def create_or_update_user_product_rate(*, user: User, product_id: int, rate: int):
+    # Locking the product serializes ratings of the same product, so a user can never end up with two
+    product = Product.active.select_for_update().get(id=product_id)
+    previous_rate = UserRateProduct.active.filter(user=user, product=product).first()
+    if previous_rate is None:
+        UserRateProduct.objects.create(user=user, product=product, rate=rate)
+        adjust_product_rating(product_id=product.id, rate_delta=rate, count_delta=1)
+    elif previous_rate.rate != rate:
+        adjust_product_rating(product_id=product.id, rate_delta=rate - previous_rate.rate, count_delta=0)
+        previous_rate.rate = rate
+        previous_rate.save(update_fields=['rate'])
+
+
+@transaction.atomic
+def remove_user_product_rate(*, user: User, product_id: int):
+    product = Product.active.select_for_update().get(id=product_id)
+    previous_rate = UserRateProduct.active.get(user=user, product=product)
+    previous_rate.is_active = False
+    previous_rate.save(update_fields=['is_active'])
+    adjust_product_rating(product_id=product.id, rate_delta=-previous_rate.rate, count_delta=-1)
+
+
+def rebuild_product_rating_aggregates(*, chunk_size: int = 2000, dry_run: bool = False):
+    """
+    Recompute `rating_sum`/`rating_count` from the active ratings, one chunk of products at a time, and
+    write back only the products that drifted. Returns the ids of the drifted products.
+    """
+    drifted = []
+    last_id = 0
+    while True:
+        products = list(Product.objects.filter(pk__gt=last_id).order_by('pk')
+                        .only('id', 'rating_sum', 'rating_count')[:chunk_size])
+        if not products:
+            return drifted
+        last_id = products[-1].id
+
+        actual = {row['product_id']: (row['rating_sum'], row['rating_count'])
+                  for row in UserRateProduct.active.filter(product__in=products).values('product_id')
+                  .annotate(rating_sum=Sum('rate'), rating_count=Count('id')).order_by()}
+
+        changed = []
+        for product in products:
+            rating_sum, rating_count = actual.get(product.id, (0, 0))
+            if (product.rating_sum, product.rating_count) != (rating_sum, rating_count):
+                product.rating_sum, product.rating_count = rating_sum, rating_count
+                changed.append(product)
+
+        drifted.extend(product.id for product in changed)
+        if changed and not dry_run:
+            Product.objects.bulk_update(changed, ['rating_sum', 'rating_count'])
 
 
 def create_user_address(*, user: User, city: str, address: str):
-    city = City.active.get(name=city)
-    return Address.objects.create(user=user, city=city, address=address)
+    city = city_registry.get(city)
+    address = Address.objects.create(user=user, city=city, address=address)
+    return address
 
 
 def update_user_address(*, user: User, address_id: int, new_address: Union[str, None], new_city: Union[str, None]):
     address = Address.active.get(user=user, id=address_id)
     if new_city is not None:
-        new_city = City.active.get(name=new_city)
+        new_city = city_registry.get(new_city)
         address.city = new_city
 
     if new_address is not None:
@@ -49,24 +119,88 @@ def inactive_user_address(*, user: User, address_id: int):
 def delete_user_cart(*, user: User, cart_id: int):
     cart = Cart.active.get(user=user, id=cart_id)
     cart.is_active = False
-    return cart.save()
+    cart.save()
 
 
-def user_purchase_order(*, user: User, cart_id: int, address_id: int):
+def create_purchase_receipt(*, user: User, lines: list, total_price: int):
+    """Write the receipt and one order per cart line, snapshotting the price at purchase time."""
+    receipt = PurchaseReceipt.objects.create(user=user, price=total_price)
+    orders = Order.objects.bulk_create([
+        Order(user=user, product_id=product_id, price=price, quantity=quantity, discount=0)
+        for product_id, price, quantity in lines
+    ])
+    ReceiptOrder.objects.bulk_create([ReceiptOrder(receipt=receipt, order=order, user=user) for order in orders])
+    return receipt
+
+
+@transaction.atomic
+def reserve_cart_for_purchase(*, user: User, cart_id: int, address_id: int):
+    """
+    Validate and price the cart, then move it to PROCESSING with a fresh payment key so the payment can
+    run outside of any transaction while the cart's items are frozen. A cart already in PROCESSING is a
+    checkout whose payment outcome is unknown; it is resumed with the same key, so the gateway charges
+    it at most once however many times the checkout is retried.
+    """
     address = Address.active.get(user=user, id=address_id, is_active=True)
-    cart = Cart.active.get(user=user, id=cart_id, is_active=True)
-    products = cart.products.all()
-    if len(products) == 0:
+    cart = Cart.active.select_for_update().get(user=user, id=cart_id, is_active=True)
+    if cart.cart_status in ('P', 'E'):
+        raise CartNotOpenException()
+
+    cart_items = CartItem.active.filter(cart=cart, product__isnull=False)
+    lines = list(cart_items.order_by('id').values_list('product_id', 'product__price', 'quantity'))
+    if not lines:
         raise EmptyCartException()
 
-    for product in products:
-        if product.city is None:
-            continue
-        if not product.city.id == address.city.id:
-            raise UserCartAddressCityDoesNotMatch(product_id=product.id)
+    mismatched_product_id = (cart_items.filter(product__city__isnull=False)
+                             .exclude(product__city=address.city_id)
+                             .order_by('product_id').values_list('product_id', flat=True).first())
+    if mismatched_product_id is not None:
+        raise UserCartAddressCityDoesNotMatch(product_id=mismatched_product_id)
+
+    if cart.cart_status != 'R':
+        cart.cart_status = 'R'
+        cart.purchase_key = uuid.uuid4().hex
+        cart.save(update_fields=['cart_status', 'purchase_key'])
+    total_price = sum(price * quantity for _, price, quantity in lines)
+    return cart, lines, total_price
 
-    total_price = products.aggregate(Sum('price'))['price__sum']
-    tracking_code = purchase_gateway(total_price)
+
+def release_cart_reservation(*, cart: Cart):
+    Cart.objects.filter(pk=cart.pk, cart_status='R').update(cart_status='O', purchase_key=None)
+    cart.cart_status, cart.purchase_key = 'O', None
+
+
+@transaction.atomic
+def complete_purchase_order(*, user: User, cart: Cart, lines: list, total_price: int):
+    # A concurrent retry of the same reservation may have been charged and completed it first
+    if not Cart.objects.filter(pk=cart.pk, cart_status='R').update(cart_status='P'):
+        raise CartNotOpenException()
+    receipt = create_purchase_receipt(user=user, lines=lines, total_price=total_price)
     cart.cart_status = 'P'
-    cart.save()
-    return cart, total_price, tracking_code
+    return receipt
+
+
+async def user_purchase_order(*, user: User, cart_id: int, address_id: int):
+    cart, lines, total_price = await sync_to_async(reserve_cart_for_purchase)(user=user, cart_id=cart_id,
+                                                                               address_id=address_id)
+    try:
+        tracking_code = await purchase_gateway(total_price, cart.purchase_key)
+    except PaymentGatewayUnavailable:
+        # The payment may have gone through: keep the reservation so a retry reuses its key
+        raise
+    except PaymentGatewayException:
+        await sync_to_async(release_cart_reservation)(cart=cart)
+        raise
+
+    try:
+        receipt = await sync_to_async(complete_purchase_order)(user=user, cart=cart, lines=lines,
+                                                               total_price=total_price)
+    except CartNotOpenException:
+        raise
+    except Exception:
+        # The cart stays reserved, so a retried checkout is answered by the gateway from the same key and
+        # writes the receipt then, without charging again
+        logger.exception('Cart %s was charged (tracking code %s, key %s) but its receipt was not written',
+                         cart.pk, tracking_code, cart.purchase_key)
+        raise
+    return cart, receipt, total_price, tracking_code
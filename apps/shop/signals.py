@@ -0,0 +1,62 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.shop.models import City, Product, ProductCategory
+from apps.shop.registry import category_registry, city_registry
+from apps.shop.search import get_search_backend
+from apps.shop.suggest import suggester
+
+SEARCHABLE_PRODUCT_FIELDS = {'name', 'description'}
+SUGGESTED_PRODUCT_FIELDS = {'name', 'is_active', 'rating_count'}
+
+
+@receiver(post_save, sender=Product)
+def index_product_for_search(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    if update_fields is not None and not SEARCHABLE_PRODUCT_FIELDS & set(update_fields):
+        return
+    get_search_backend().index_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_search(sender, instance, **kwargs):
+    get_search_backend().remove_product(instance.pk)
+
+
+@receiver(post_save, sender=Product)
+def index_product_for_suggestions(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    if update_fields is not None and not SUGGESTED_PRODUCT_FIELDS & set(update_fields):
+        return
+    suggester.index_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_suggestions(sender, instance, **kwargs):
+    suggester.remove_product(instance.pk)
+
+
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+def invalidate_city_registry(sender, **kwargs):
+    city_registry.invalidate()
+
+
+@receiver(post_save, sender=ProductCategory)
+@receiver(post_delete, sender=ProductCategory)
+def invalidate_category_registry(sender, **kwargs):
+    category_registry.invalidate()
+
+
+@receiver(post_save, sender=ProductCategory)
+def index_category_for_suggestions(sender, instance, raw=False, **kwargs):
+    if not raw:
+        suggester.index_category(instance)
+
+
+@receiver(post_delete, sender=ProductCategory)
+def remove_category_from_suggestions(sender, instance, **kwargs):
+    suggester.remove_category(instance.pk)
+
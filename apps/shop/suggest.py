@@ -0,0 +1,196 @@
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, Q
+
+from apps.shop.models import Product, ProductCategory
+from apps.shop.search import TOKEN_RE
+from apps.utils.cache import bump_version, bump_version_on_commit, get_version
+
+
+class PrefixIndex:
+    """
+    Sorted array of name keys for prefix lookups with bisect. Every word of a name starts a key, so
+    "pho" finds "Smart Phone" too. Results are the `limit` most popular matches, memoized per prefix
+    until the index changes.
+    """
+    max_memoized = 10000
+
+    def __init__(self, rows=()):
+        self._keys = []
+        self._names = {}
+        self._popularity = {}
+        self._memo = {}
+        # Bulk loads sort once instead of inserting key by key
+        for pk, name, popularity in rows:
+            self._names[pk] = name
+            self._popularity[pk] = popularity
+            self._keys.extend((key, pk) for key in self.name_keys(name))
+        self._keys.sort()
+
+    @staticmethod
+    def normalize(text):
+        return ' '.join(text.casefold().split())
+
+    @classmethod
+    def name_keys(cls, name):
+        name = cls.normalize(name)
+        return {name[match.start():] for match in TOKEN_RE.finditer(name)}
+
+    def add(self, pk, name, popularity=0):
+        self.remove(pk)
+        self._names[pk] = name
+        self._popularity[pk] = popularity
+        for key in self.name_keys(name):
+            insort(self._keys, (key, pk))
+        self._memo.clear()
+
+    def popularity(self, pk):
+        return self._popularity.get(pk, 0)
+
+    def remove(self, pk):
+        name = self._names.pop(pk, None)
+        if name is None:
+            return
+        self._popularity.pop(pk, None)
+        for key in self.name_keys(name):
+            position = bisect_left(self._keys, (key, pk))
+            if position < len(self._keys) and self._keys[position] == (key, pk):
+                del self._keys[position]
+        self._memo.clear()
+
+    def suggest(self, prefix, limit):
+        prefix = self.normalize(prefix)
+        memo_key = (prefix, limit)
+        if memo_key in self._memo:
+            return self._memo[memo_key]
+
+        matches = set()
+        position = bisect_left(self._keys, (prefix,))
+        while position < len(self._keys) and self._keys[position][0].startswith(prefix):
+            matches.add(self._keys[position][1])
+            position += 1
+        best = heapq.nsmallest(limit, matches, key=lambda pk: (-self._popularity[pk], self._names[pk], pk))
+        results = [{'id': pk, 'name': self._names[pk]} for pk in best]
+
+        if len(self._memo) >= self.max_memoized:
+            self._memo.clear()
+        self._memo[memo_key] = results
+        return results
+
+
+class ProductSuggester:
+    """
+    Process-local prefix indexes over active product and category names, ranked by popularity (the
+    number of ratings of a product, the number of products in a category). Writes in this worker are
+    applied right away from the save/delete signals; they also bump a version in the shared cache, which
+    this worker adopts as its own. A version changed by another worker or an index older than
+    SUGGEST_INDEX_TTL is rebuilt in a background thread while the old index keeps answering. Only the
+    very first lookup in a worker reads the database.
+    """
+    namespace = 'suggest'
+    background_refresh = True
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._products = None
+        self._categories = None
+        self._version = None
+        self._loaded_at = None
+        self._refreshing = False
+
+    def _build(self):
+        version = get_version(self.namespace)
+        products = PrefixIndex(Product.active.values_list('id', 'name', 'rating_count').iterator())
+        categories = PrefixIndex(ProductCategory.active
+                                 .annotate(product_count=Count('product', filter=Q(product__is_active=True)))
+                                 .values_list('id', 'name', 'product_count'))
+
+        with self._lock:
+            self._products, self._categories = products, categories
+            self._version, self._loaded_at = version, time.monotonic()
+
+    def _refresh_in_background(self):
+        try:
+            close_old_connections()
+            self._build()
+        finally:
+            self._refreshing = False
+            connection.close()
+
+    def _ensure_current(self):
+        if self._products is None:
+            with self._lock:
+                if self._products is None:
+                    self._build()
+            return
+
+        stale = (self._version != get_version(self.namespace)
+                 or time.monotonic() - self._loaded_at > settings.SUGGEST_INDEX_TTL)
+        if not stale or self._refreshing:
+            return
+        if not self.background_refresh:
+            self._build()
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def suggest(self, prefix, limit=10):
+        self._ensure_current()
+        with self._lock:
+            return {'products': self._products.suggest(prefix, limit),
+                    'categories': self._categories.suggest(prefix, limit)}
+
+    def invalidate(self):
+        bump_version_on_commit(self.namespace)
+
+    def _bump_version(self):
+        # Like bump_version_on_commit, but the write is already in the local index, so the new version is
+        # adopted unless another worker bumped it in between
+        self._adopt_version(bump_version(self.namespace))
+        transaction.on_commit(lambda: self._adopt_version(bump_version(self.namespace)))
+
+    def _adopt_version(self, version):
+        with self._lock:
+            if self._version is not None and version == self._version + 1:
+                self._version = version
+
+    def index_product(self, product):
+        if self._products is not None:
+            with self._lock:
+                if product.is_active:
+                    self._products.add(product.pk, product.name, product.rating_count)
+                else:
+                    self._products.remove(product.pk)
+        self._bump_version()
+
+    def remove_product(self, product_id):
+        if self._products is not None:
+            with self._lock:
+                self._products.remove(product_id)
+        self._bump_version()
+
+    def index_category(self, category):
+        if self._categories is not None:
+            with self._lock:
+                if category.is_active:
+                    self._categories.add(category.pk, category.name, self._categories.popularity(category.pk))
+                else:
+                    self._categories.remove(category.pk)
+        self._bump_version()
+
+    def remove_category(self, category_id):
+        if self._categories is not None:
+            with self._lock:
+                self._categories.remove(category_id)
+        self._bump_version()
+
+
+suggester = ProductSuggester()
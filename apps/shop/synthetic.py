@@ -0,0 +1,326 @@
+import csv
+import io
+import math
+import random
+import uuid
+from array import array
+from datetime import timedelta
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Count, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from apps.shop.models import (Address, Cart, CartItem, City, Comment, Order, Product, ProductCategory,
+                              PurchaseReceipt, ReceiptOrder, UserRateProduct)
+from apps.shop.registry import category_registry, city_registry
+from apps.shop.search import get_search_backend
+from apps.shop.services import invalidate_catalog_cache
+from apps.shop.suggest import suggester
+from apps.user.models import User
+
+ADJECTIVES = ['Smart', 'Classic', 'Portable', 'Wireless', 'Organic', 'Compact', 'Premium', 'Vintage', 'Ultra',
+              'Eco', 'Digital', 'Handmade', 'Heavy Duty', 'Mini', 'Pro', 'Deluxe']
+NOUNS = ['Phone', 'Laptop', 'Kettle', 'Backpack', 'Lamp', 'Chair', 'Watch', 'Headphones', 'Camera', 'Blender',
+         'Sneakers', 'Jacket', 'Notebook', 'Speaker', 'Monitor', 'Bicycle', 'Teapot', 'Carpet', 'Perfume', 'Drill']
+WORDS = ['great', 'quality', 'fast', 'delivery', 'price', 'works', 'broke', 'after', 'week', 'love', 'it',
+         'recommended', 'not', 'as', 'described', 'good', 'value', 'would', 'buy', 'again']
+RATES = [1, 2, 3, 4, 5]
+RATE_WEIGHTS = [5, 7, 15, 33, 40]
+
+
+class ZipfSampler:
+    """
+    Draws indexes in [0, n) with P(k) roughly proportional to 1 / (k + 1) ** exponent, through the inverse
+    CDF of the continuous power law, so it needs no table however large `n` is. Index 0 is the most popular.
+    """
+
+    def __init__(self, n, exponent, rng):
+        self.n = n
+        self.exponent = exponent
+        self.rng = rng
+
+    def __call__(self):
+        u = self.rng.random()
+        if self.exponent == 1:
+            rank = (self.n + 1) ** u
+        else:
+            power = 1 - self.exponent
+            rank = (((self.n + 1) ** power - 1) * u + 1) ** (1 / power)
+        return min(int(rank) - 1, self.n - 1)
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def _copy_rows(model, columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    sql = f"COPY {model._meta.db_table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    with connection.cursor() as cursor:
+        cursor.cursor.copy_expert(sql, buffer)
+
+
+def write_rows(model, columns, rows, chunk_size):
+    """
+    Insert `rows` (tuples of `columns` values, primary key included) in chunks, each in its own
+    transaction: with COPY on PostgreSQL, with `bulk_create` elsewhere. `bulk_create` stamps auto_now
+    fields itself, so only COPY keeps the generated timestamps. Returns the number of rows written.
+    """
+    written = 0
+    for chunk in _chunks(rows, chunk_size):
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                _copy_rows(model, columns, chunk)
+            else:
+                model.objects.bulk_create([model(**dict(zip(columns, row))) for row in chunk])
+        written += len(chunk)
+    return written
+
+
+def _next_id(model):
+    return (model.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+
+
+class SyntheticDataGenerator:
+    """
+    Generates a skewed, internally consistent shop. Products, users and cities are picked with Zipfian
+    popularity, so a few products dominate carts, orders, ratings and comments and a few users have long
+    histories. Every value comes from one `random.Random(seed)` and primary keys are assigned up front, so
+    the same seed and sizes give the same rows (timestamps are relative to now). Memory stays flat apart
+    from one price per product.
+    """
+    columns = {
+        City: ['id', 'name', 'is_active'],
+        ProductCategory: ['id', 'name', 'is_active'],
+        User: ['id', 'password', 'first_name', 'last_name', 'email', 'is_active', 'is_staff', 'is_superuser',
+               'created_at', 'updated_at'],
+        Address: ['id', 'city_id', 'address', 'user_id', 'is_active'],
+        Product: ['id', 'name', 'description', 'price', 'category_id', 'city_id', 'created', 'updated', 'is_active',
+                  'rating_sum', 'rating_count'],
+        Cart: ['id', 'user_id', 'cart_status', 'created', 'is_active'],
+        CartItem: ['id', 'product_id', 'cart_id', 'quantity', 'is_active'],
+        Order: ['id', 'product_id', 'price', 'quantity', 'user_id', 'created', 'updated'],
+        PurchaseReceipt: ['id', 'price', 'user_id', 'created', 'updated', 'is_active'],
+        ReceiptOrder: ['id', 'receipt_id', 'order_id', 'user_id', 'created', 'updated', 'is_active'],
+        UserRateProduct: ['id', 'user_id', 'product_id', 'rate', 'is_active'],
+        Comment: ['id', 'user_id', 'comment', 'product_id', 'is_active'],
+    }
+
+    def __init__(self, *, seed=0, cities=100, categories=200, users=10000, products=100000, carts=50000,
+                 ratings=200000, comments=50000, zipf_exponent=1.1, history_days=730, chunk_size=10000,
+                 password='synthetic'):
+        if cities < 1 or categories < 1 or users < 1 or products < 1:
+            raise ValueError('Synthetic data needs at least one city, category, user and product')
+        self.rng = random.Random(seed)
+        self.cities = cities
+        self.categories = categories
+        self.users = users
+        self.products = products
+        self.carts = carts
+        self.ratings = ratings
+        self.comments = comments
+        self.zipf_exponent = zipf_exponent
+        self.history_days = history_days
+        self.chunk_size = chunk_size
+        self.password = password
+        self.now = timezone.now()
+        self.counts = {}
+        self.progress = None
+
+    def generate(self, progress=None):
+        """Write everything and return the number of rows written per model name."""
+        self.progress = progress
+        self.generate_places()
+        self.generate_users()
+        self.generate_products()
+        self.generate_carts()
+        self.generate_ratings()
+        self.generate_comments()
+        self.finish()
+        return self.counts
+
+    def report(self, message):
+        if self.progress is not None:
+            self.progress(message)
+
+    def write(self, model, rows):
+        count = write_rows(model, self.columns[model], rows, self.chunk_size)
+        self.counts[model.__name__] = self.counts.get(model.__name__, 0) + count
+        self.report(f'{model.__name__}: {self.counts[model.__name__]} rows')
+
+    def zipf(self, n):
+        return ZipfSampler(n, self.zipf_exponent, self.rng)
+
+    def timestamp(self):
+        # Skewed towards the recent past, like real traffic
+        return self.now - timedelta(seconds=self.history_days * 86400 * self.rng.random() ** 2)
+
+    def user_id(self, index):
+        return uuid.UUID(int=(self.user_base + index) % 2 ** 128)
+
+    def product_sampler(self):
+        # Zipf ranks are scattered over the id space, so the popular products are not all the oldest ones
+        rank = self.zipf(self.products)
+        return lambda: rank() * self.product_stride % self.products
+
+    def generate_places(self):
+        self.first_city = _next_id(City)
+        self.first_category = _next_id(ProductCategory)
+        # Names carry the id, so a later run never collides with an earlier one
+        self.write(City, ((self.first_city + i, f'City {self.first_city + i}', True) for i in range(self.cities)))
+        self.write(ProductCategory, ((self.first_category + i, f'Category {self.first_category + i}',
+                                      self.rng.random() > 0.02) for i in range(self.categories)))
+
+    def generate_users(self):
+        self.user_base = self.rng.getrandbits(128)
+        first_address = _next_id(Address)
+        # Hashing is deliberately slow, so every synthetic user shares one precomputed hash
+        password = make_password(self.password)
+        city = self.zipf(self.cities)
+
+        def users():
+            for i in range(self.users):
+                user_id, created = self.user_id(i), self.timestamp()
+                yield (user_id, password, f'First{i}', f'Last{i}', f'{user_id.hex}@example.com', True, False, False,
+                       created, created)
+
+        self.write(User, users())
+        self.write(Address, ((first_address + i, self.first_city + city(), f'No. {i}, Street {i % 997}',
+                              self.user_id(i), True) for i in range(self.users)))
+
+    def generate_products(self):
+        self.first_product = _next_id(Product)
+        self.product_stride = next(step for step in range(int(self.products * 0.618) + 1, 2 * self.products + 2)
+                                   if math.gcd(step, self.products) == 1)
+        self.prices = array('l')
+        category, city = self.zipf(self.categories), self.zipf(self.cities)
+
+        def products():
+            for i in range(self.products):
+                price = int(self.rng.lognormvariate(13, 1.2)) // 1000 * 1000 + 1000
+                self.prices.append(price)
+                created = self.timestamp()
+                city_id = self.first_city + city() if self.rng.random() < 0.8 else None
+                yield (self.first_product + i, f'{self.rng.choice(ADJECTIVES)} {self.rng.choice(NOUNS)} {i}',
+                       ' '.join(self.rng.choices(WORDS, k=12)), price, self.first_category + category(), city_id,
+                       created, created, self.rng.random() > 0.05, 0, 0)
+
+        self.write(Product, products())
+
+        backend = get_search_backend()
+        for ids in _chunks(range(self.first_product, self.first_product + self.products), self.chunk_size):
+            backend.index_products(ids)
+        self.report('Product search index built')
+
+    def generate_carts(self):
+        """Carts with their items; paid carts also get their orders and purchase receipt."""
+        ids = {model: _next_id(model) for model in (Cart, CartItem, Order, PurchaseReceipt, ReceiptOrder)}
+        user, product = self.zipf(self.users), self.product_sampler()
+        # A user has at most one open cart, as get_or_create_active_cart expects
+        has_open_cart = set()
+
+        for cart_indexes in _chunks(range(self.carts), self.chunk_size):
+            rows = {model: [] for model in ids}
+            for _ in cart_indexes:
+                user_index, created = user(), self.timestamp()
+                user_id, cart_id = self.user_id(user_index), ids[Cart]
+                ids[Cart] += 1
+                roll = self.rng.random()
+                status = 'P' if roll < 0.75 else 'E' if roll < 0.9 or user_index in has_open_cart else 'O'
+                if status == 'O':
+                    has_open_cart.add(user_index)
+                rows[Cart].append((cart_id, user_id, status, created, True))
+
+                lines = {}
+                for _ in range(self.rng.randint(1, 5)):
+                    lines[product()] = self.rng.randint(1, 3)
+                for product_index, quantity in lines.items():
+                    rows[CartItem].append((ids[CartItem], self.first_product + product_index, cart_id, quantity, True))
+                    ids[CartItem] += 1
+                if status != 'P':
+                    continue
+
+                receipt_id = ids[PurchaseReceipt]
+                ids[PurchaseReceipt] += 1
+                total = 0
+                for product_index, quantity in lines.items():
+                    price = self.prices[product_index]
+                    total += price * quantity
+                    rows[Order].append((ids[Order], self.first_product + product_index, price, quantity, user_id,
+                                        created, created))
+                    rows[ReceiptOrder].append((ids[ReceiptOrder], receipt_id, ids[Order], user_id, created, created,
+                                               True))
+                    ids[Order] += 1
+                    ids[ReceiptOrder] += 1
+                rows[PurchaseReceipt].append((receipt_id, total, user_id, created, created, True))
+
+            for model in (Cart, CartItem, Order, PurchaseReceipt, ReceiptOrder):
+                self.write(model, rows[model])
+
+    def user_shares(self):
+        """Yield `(user index, number of ratings)` so the heavy users get the Zipfian share of all ratings."""
+        weights_total = sum(1 / (rank + 1) ** self.zipf_exponent for rank in range(self.users))
+        for index in range(self.users):
+            expected = self.ratings * (1 / (index + 1) ** self.zipf_exponent) / weights_total
+            count = int(expected) + (self.rng.random() < expected % 1)
+            if count:
+                yield index, min(count, max(self.products // 2, 1))
+
+    def generate_ratings(self):
+        if not self.ratings:
+            return
+        first_rate = _next_id(UserRateProduct)
+        product = self.product_sampler()
+
+        def ratings():
+            rate_id = first_rate
+            for user_index, count in self.user_shares():
+                rated, attempts = set(), 0
+                # Heavy users keep drawing the same popular products, so fall back to uniform ones once that stalls
+                while len(rated) < count:
+                    attempts += 1
+                    candidate = product() if attempts <= 4 * count else self.rng.randrange(self.products)
+                    if candidate in rated:
+                        continue
+                    rated.add(candidate)
+                    yield (rate_id, self.user_id(user_index), self.first_product + candidate,
+                           self.rng.choices(RATES, RATE_WEIGHTS)[0], True)
+                    rate_id += 1
+
+        self.write(UserRateProduct, ratings())
+
+    def generate_comments(self):
+        first_comment = _next_id(Comment)
+        user, product = self.zipf(self.users), self.product_sampler()
+        self.write(Comment, ((first_comment + i, self.user_id(user()),
+                              ' '.join(self.rng.choices(WORDS, k=self.rng.randint(3, 30))),
+                              self.first_product + product(), True) for i in range(self.comments)))
+
+    def finish(self):
+        if self.ratings:
+            # One set-based UPDATE over the generated products instead of a pass per chunk
+            ratings = UserRateProduct.active.filter(product=OuterRef('pk')).order_by().values('product')
+            Product.objects.filter(id__gte=self.first_product).update(
+                rating_sum=Coalesce(Subquery(ratings.annotate(total=Sum('rate')).values('total')), 0),
+                rating_count=Coalesce(Subquery(ratings.annotate(total=Count('id')).values('total')), 0))
+            self.report('Product rating aggregates updated')
+
+        # Primary keys were given explicitly, so move the sequences past them
+        models = list(self.columns)
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
+
+        # Nothing went through the ORM signals, so drop every derived cache by hand
+        invalidate_catalog_cache()
+        suggester.invalidate()
+        city_registry.invalidate()
+        category_registry.invalidate()
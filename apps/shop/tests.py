@@ -1,17 +1,64 @@
-from unittest.mock import patch
-
-from django.db.models import Sum
-from django.test import TestCase
+import asyncio
+import csv
+import json
+import os
+import random
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import skipUnless
+from unittest.mock import AsyncMock, patch
+
+import httpx
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.db.models import Count, Sum
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from rest_framework.test import APIClient
+from django.utils import timezone
 from rest_framework import status
+from rest_framework.test import APIClient
+
 from apps.user.models import User
+from apps.user.services import generate_tokens_for_user
+from apps.utils.benchmark import compare_results, run_scenario, uncovered_routes
+from apps.utils.cache import bump_version, read_through
+from apps.utils.db import is_postgresql
+from apps.utils.exceptions import PaymentGatewayException, PaymentGatewayUnavailable
+from apps.utils.idempotency import IdempotencyMixin
+from apps.utils.load_replay import LoadReplay, load_collection
+from apps.utils.profiling import ProfilingMiddleware, RequestProfile
+from apps.utils.purchase_gateway import HttpPurchaseGateway, LocalPurchaseGateway
+from apps.utils.testing import QueryCountAssertionsMixin, QueryPlanAssertionsMixin
+from .benchmarks import build_context as build_benchmark_context
+from .management.commands.benchmark_endpoints import SCENARIOS as BENCHMARK_SCENARIOS
+from .product_import import import_products
+from .search import get_search_backend
+from .suggest import suggester
+from .selectors import (search_products, get_product_changes, get_product_facets, get_user_open_carts,
+                        get_user_purchase_receipts, process_add_items_to_cart, get_user_addresses_validators,
+                        get_user_carts_validators)
+from .serializers import OutGetUserCarts, OutUserGetAddress
+from .services import (create_or_update_user_product_rate, remove_user_product_rate, update_user_address,
+                       inactive_user_address, delete_user_cart, reserve_cart_for_purchase,
+                       rebuild_product_rating_aggregates)
+from .synthetic import SyntheticDataGenerator, ZipfSampler
+from .registry import category_registry, city_registry
 from .models import (ProductCategory, Product, Cart, CartItem, PurchaseReceipt, Order, ReceiptOrder, Comment,
                      UserRateProduct, Address, City)
 
 
 class ShopAPITestCase(TestCase):
     def setUp(self):
+        cache.clear()
         self.client = APIClient()
         self.admin_user = User.objects.create_superuser('admin@test.com', 'adminpass')
         self.regular_user = User.objects.create_user('user@test.com', 'userpass')
@@ -170,7 +217,9 @@ class ShopAPITestCase(TestCase):
         url = reverse('user get purchase')
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['items'][0]['product']['name'], 'Laptop')
+        self.assertIsNone(response.data['next'])
 
     def test_get_user_carts(self):
         self.client.force_authenticate(user=self.regular_user)
@@ -248,6 +297,59 @@ class ShopAPITestCase(TestCase):
         self.assertEqual(UserRateProduct.active.count(), 1)
         self.assertEqual(UserRateProduct.active.first().rate, 4)
 
+    def test_product_rating_aggregates_follow_rate_changes(self):
+        other_user = User.objects.create_user('other@test.com', 'otherpass')
+        url = reverse('user rate product')
+
+        self.client.force_authenticate(user=self.regular_user)
+        self.client.post(path=url, data={'product_id': self.product.id, 'rate': 4}, format='json')
+        self.client.post(path=url, data={'product_id': self.product.id, 'rate': 2}, format='json')
+        self.client.force_authenticate(user=other_user)
+        self.client.post(path=url, data={'product_id': self.product.id, 'rate': 5}, format='json')
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_sum, self.product.rating_count), (7, 2))
+
+        response = self.client.get(reverse('search products'))
+        self.assertEqual(response.data['results'][0]['rating'], 3.5)
+        self.assertEqual(response.data['results'][0]['rating_count'], 2)
+
+        url = reverse('user delete product rate')
+        response = self.client.post(path=url, data={'product_id': self.product.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(path=url, data={'product_id': self.product.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_sum, self.product.rating_count), (2, 1))
+
+    def test_get_products_ordered_by_rating(self):
+        unrated = Product.objects.create(name='Mouse', price=10, category=self.category)
+        best = Product.objects.create(name='Monitor', price=300, category=self.category, rating_sum=9,
+                                      rating_count=2)
+        self.product.rating_sum, self.product.rating_count = 3, 1
+        self.product.save()
+
+        url = reverse('search products')
+        for params in [{'order_by': '-rating'}, {'order_by': '-rating', 'pagination': 'cursor', 'page_size': 1}]:
+            ids = []
+            response = self.client.get(url, params)
+            while True:
+                ids.extend(item['id'] for item in response.data['results'])
+                if not response.data['next']:
+                    break
+                response = self.client.get(response.data['next'])
+            self.assertEqual(ids, [best.id, self.product.id, unrated.id])
+
+    def test_rebuild_product_ratings_command_fixes_drift(self):
+        UserRateProduct.objects.create(user=self.regular_user, product=self.product, rate=3)
+        call_command('rebuild_product_ratings', stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_sum, self.product.rating_count), (3, 1))
+        call_command('rebuild_product_ratings', '--check', stdout=StringIO())
+
+        Product.objects.filter(pk=self.product.pk).update(rating_count=5)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_product_ratings', '--check', stdout=StringIO())
+
     def test_user_create_valid_address(self):
         self.client.force_authenticate(user=self.regular_user)
         url = reverse('user create address')
@@ -442,7 +544,7 @@ class ShopAPITestCase(TestCase):
         # Validate results
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
-    @patch('apps.shop.services.purchase_gateway')
+    @patch('apps.shop.services.purchase_gateway', new_callable=AsyncMock)
     def test_user_create_cart_and_purchase(self, mock_purchase_gateway):
         mock_purchase_gateway.return_value = 12345
         self.client.force_authenticate(user=self.regular_user)
@@ -492,6 +594,176 @@ class ShopAPITestCase(TestCase):
         self.assertEqual(response.data['tracking_code'], 12345)
         self.assertEqual(cart.cart_status, 'P')
 
+    @patch('apps.shop.services.purchase_gateway', new_callable=AsyncMock)
+    def test_user_purchase_charges_quantities_once(self, mock_purchase_gateway):
+        mock_purchase_gateway.return_value = 12345
+        self.client.force_authenticate(user=self.regular_user)
+        mouse = Product.objects.create(name='Mouse', price=30, category=self.category, city=self.city)
+        self.client.post(reverse('user add items to cart'), [{'product_id': self.product.id, 'quantity': 2},
+                                                             {'product_id': mouse.id, 'quantity': 3}], format='json')
+        self.client.post(path=reverse('user create address'), data={'address': 'home', 'city': self.city.name},
+                         format='json')
+        data = {'cart_id': Cart.active.get().id, 'address_id': Address.active.get().id}
+
+        url = reverse('user purchase cart')
+        with self.assertNumQueries(13):
+            response = self.client.post(path=url, data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_price'], 2 * 1000 + 3 * 30)
+
+        # Receipts are read back from the prices snapshotted at checkout
+        Product.objects.filter(pk=mouse.pk).update(price=999)
+        receipt = PurchaseReceipt.active.get(pk=response.data['receipt_id'])
+        self.assertEqual(receipt.price, 2090)
+        response = self.client.get(reverse('user get purchase'))
+        items = response.data['results'][0]['items']
+        self.assertEqual(sorted((item['product']['id'], item['price'], item['quantity']) for item in items),
+                         [(self.product.id, 1000, 2), (mouse.id, 30, 3)])
+
+        response = self.client.post(path=url, data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], 'Cart is not open')
+        mock_purchase_gateway.assert_called_once_with(2090, Cart.objects.get(pk=data['cart_id']).purchase_key)
+
+    def prepare_purchase(self):
+        self.client.force_authenticate(user=self.regular_user)
+        self.client.post(reverse('user add items to cart'), [{'product_id': self.product.id, 'quantity': 1}],
+                         format='json')
+        self.client.post(path=reverse('user create address'), data={'address': 'home', 'city': self.city.name},
+                         format='json')
+        cart = Cart.active.get()
+        return cart, {'cart_id': cart.id, 'address_id': Address.active.get().id}
+
+    @patch('apps.shop.services.purchase_gateway', new_callable=AsyncMock)
+    def test_user_purchase_rejected_payment_reopens_cart(self, mock_purchase_gateway):
+        mock_purchase_gateway.side_effect = PaymentGatewayException()
+        cart, data = self.prepare_purchase()
+
+        response = self.client.post(path=reverse('user purchase cart'), data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_502_BAD_GATEWAY)
+        cart.refresh_from_db()
+        self.assertEqual((cart.cart_status, cart.purchase_key), ('O', None))
+        self.assertEqual(PurchaseReceipt.active.count(), 1)
+
+    @patch('apps.shop.services.purchase_gateway', new_callable=AsyncMock)
+    def test_user_purchase_unknown_payment_outcome_is_resumed_with_the_same_key(self, mock_purchase_gateway):
+        mock_purchase_gateway.side_effect = [PaymentGatewayUnavailable(), 12345]
+        cart, data = self.prepare_purchase()
+        url = reverse('user purchase cart')
+
+        response = self.client.post(path=url, data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_502_BAD_GATEWAY)
+        cart.refresh_from_db()
+        self.assertEqual(cart.cart_status, 'R')
+        self.assertEqual(PurchaseReceipt.active.count(), 1)
+
+        response = self.client.post(path=url, data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['tracking_code'], 12345)
+        self.assertEqual(PurchaseReceipt.active.count(), 2)
+        first, retry = mock_purchase_gateway.await_args_list
+        self.assertEqual(first, retry)
+        self.assertEqual(first.args, (1000, cart.purchase_key))
+
+    @patch('apps.shop.services.purchase_gateway', new_callable=AsyncMock)
+    def test_user_purchase_receipt_failure_keeps_the_charged_cart_reserved(self, mock_purchase_gateway):
+        mock_purchase_gateway.return_value = 12345
+        cart, data = self.prepare_purchase()
+        url = reverse('user purchase cart')
+
+        with patch('apps.shop.services.create_purchase_receipt', side_effect=RuntimeError), \
+                self.assertLogs('apps.shop.services', 'ERROR'), self.assertRaises(RuntimeError):
+            self.client.post(path=url, data=data, format='json')
+        cart.refresh_from_db()
+        self.assertEqual(cart.cart_status, 'R')
+
+        response = self.client.post(path=url, data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(PurchaseReceipt.active.filter(price=1000).count(), 1)
+        self.assertEqual(len({call.args for call in mock_purchase_gateway.await_args_list}), 1)
+
+    def test_user_add_items_to_cart_with_idempotency_key(self):
+        self.client.force_authenticate(user=self.regular_user)
+        url = reverse('user add items to cart')
+        data = [{'product_id': self.product.id, 'quantity': 2}]
+
+        first = self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='add-items-1')
+        with self.assertNumQueries(0):
+            retry = self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='add-items-1')
+        self.assertEqual(retry.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(CartItem.active.get().quantity, 2)
+
+        response = self.client.post(url, [{'product_id': self.product.id, 'quantity': 1}], format='json',
+                                    HTTP_IDEMPOTENCY_KEY='add-items-1')
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='add-items-2')
+        self.assertEqual(CartItem.active.get().quantity, 4)
+
+    @patch('apps.utils.idempotency.IdempotencyMixin.idempotency_wait', 0.1)
+    def test_user_add_items_to_cart_while_same_key_in_flight(self):
+        self.client.force_authenticate(user=self.regular_user)
+        url = reverse('user add items to cart')
+        request = self.client.post(url, [], format='json').wsgi_request
+        cache_key = IdempotencyMixin.get_idempotency_cache_key(request, 'add-items-in-flight')
+        cache.add(f'{cache_key}:lock', 'in-flight', 60)
+
+        data = [{'product_id': self.product.id, 'quantity': 2}]
+        response = self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='add-items-in-flight')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(CartItem.active.count(), 0)
+
+    def test_user_add_items_to_cart_replays_response_stored_while_taking_the_lock(self):
+        self.client.force_authenticate(user=self.regular_user)
+        url = reverse('user add items to cart')
+        data = [{'product_id': self.product.id, 'quantity': 2}]
+        first = self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='add-items-race')
+        cache_key = IdempotencyMixin.get_idempotency_cache_key(first.wsgi_request, 'add-items-race')
+        stored = cache.get(cache_key)
+        cache.delete(cache_key)
+        add = caches['default'].add
+
+        def finish_first_request_then_add(*args, **kwargs):
+            cache.set(cache_key, stored)
+            return add(*args, **kwargs)
+
+        with patch.object(caches['default'], 'add', side_effect=finish_first_request_then_add):
+            retry = self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='add-items-race')
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(CartItem.active.get().quantity, 2)
+        self.assertIsNone(cache.get(f'{cache_key}:lock'))
+
+    def test_user_add_items_to_cart_unhandled_error_releases_idempotency_key(self):
+        self.client.force_authenticate(user=self.regular_user)
+        url = reverse('user add items to cart')
+        data = [{'product_id': self.product.id, 'quantity': 2}]
+        with patch('apps.shop.views.process_add_items_to_cart', side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='add-items-error')
+
+        response = self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='add-items-error')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(CartItem.active.get().quantity, 2)
+
+    @patch('apps.shop.services.purchase_gateway', new_callable=AsyncMock)
+    def test_user_purchase_retry_with_idempotency_key_is_not_charged_twice(self, mock_purchase_gateway):
+        mock_purchase_gateway.return_value = 12345
+        self.client.force_authenticate(user=self.regular_user)
+        self.client.post(reverse('user add items to cart'), [{'product_id': self.product.id, 'quantity': 1}],
+                         format='json')
+        self.client.post(path=reverse('user create address'), data={'address': 'home', 'city': self.city.name},
+                         format='json')
+        data = {'cart_id': Cart.active.get().id, 'address_id': Address.active.get().id}
+
+        url = reverse('user purchase cart')
+        first = self.client.post(path=url, data=data, format='json', HTTP_IDEMPOTENCY_KEY='purchase-1')
+        retry = self.client.post(path=url, data=data, format='json', HTTP_IDEMPOTENCY_KEY='purchase-1')
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.data, first.data)
+        mock_purchase_gateway.assert_awaited_once()
+
     def test_user_create_cart_and_purchase_non_existing_cart(self):
         self.client.force_authenticate(user=self.regular_user)
         
@@ -606,3 +878,1164 @@ class ShopAPITestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(response.data['error'], f"Product with id {mismatch_product_id} address city mismatch")
         self.assertEqual(cart.cart_status, 'O')
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class ProductSearchTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.category = ProductCategory.objects.create(name='Electronics')
+        self.books = ProductCategory.objects.create(name='Books')
+        self.city = City.objects.create(name='Tehran')
+        self.phone = Product.objects.create(name='Smart Phone', description='Android handset', price=500,
+                                            category=self.category, city=self.city)
+        self.case = Product.objects.create(name='Leather Case', description='Fits any smart phone', price=50,
+                                           category=self.category)
+        self.novel = Product.objects.create(name='Phone Book', description='Old directory', price=10,
+                                            category=self.books)
+
+    def search(self, **params):
+        response = self.client.get(reverse('search products'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['id'] for item in response.data['results']]
+
+    def test_search_matches_word_prefixes(self):
+        self.assertEqual(set(self.search(search='pho')), {self.phone.id, self.case.id, self.novel.id})
+        self.assertEqual(self.search(search='andr'), [self.phone.id])
+        self.assertEqual(self.search(search='tablet'), [])
+
+    def test_search_ranks_name_matches_above_description_matches(self):
+        self.assertEqual(self.search(search='smart phone'), [self.phone.id, self.case.id])
+
+    def test_search_keeps_filter_semantics(self):
+        self.assertEqual(self.search(search='phone', category='Electronics', max_price=100), [self.case.id])
+        self.assertEqual(self.search(search='phone', city='teh'), [self.phone.id])
+        self.assertEqual(self.search(search='phone', order_by='price'), [self.novel.id, self.case.id, self.phone.id])
+
+    def test_search_keeps_every_match(self):
+        products = Product.objects.bulk_create(Product(name=f'Widget {number}', price=number, category=self.books)
+                                               for number in range(1200))
+        get_search_backend().index_products([product.pk for product in products])
+        self.assertEqual(search_products({'search': 'widget'}).count(), 1200)
+
+    def test_fuzzy_search_tolerates_typos(self):
+        iphone = Product.objects.create(name='iPhone 15', description='Apple handset', price=900,
+                                        category=self.category)
+        self.assertEqual(self.search(search='iphnoe'), [])
+        self.assertEqual(self.search(search='iphnoe', fuzzy=True), [iphone.id])
+        self.assertEqual(self.search(search='smrat phone', fuzzy=True)[0], self.phone.id)
+        self.assertEqual(self.search(search='qwxz', fuzzy=True), [])
+        self.assertEqual(self.search(search='phoen', fuzzy=True, category='Books'), [self.novel.id])
+
+    def test_fuzzy_candidates_are_taken_from_the_filtered_products(self):
+        Product.objects.create(name='Phone', price=5, category=self.category, is_active=False)
+        with patch.object(type(get_search_backend()), 'max_fuzzy_candidates', 1):
+            self.assertEqual(self.search(search='phoen', fuzzy=True, category='Books'), [self.novel.id])
+            self.assertEqual(len(self.search(search='phoen', fuzzy=True)), 1)
+
+    @override_settings(PRODUCT_FUZZY_SEARCH_THRESHOLD=0.9)
+    def test_fuzzy_search_threshold(self):
+        self.assertEqual(self.search(search='smrat phone', fuzzy=True), [])
+        self.assertEqual(self.search(search='smart phone', fuzzy=True)[0], self.phone.id)
+
+    def test_facets_count_the_filtered_products_in_one_query(self):
+        url = reverse('search products')
+        # Load the search index and the city and category registries the facet names come from
+        self.client.get(url, {'search': 'phone', 'facets': 'category,city'})
+        with self.assertNumQueries(2):
+            self.client.get(url, {'search': 'phone'})
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {'search': 'phone', 'facets': 'category,city,price'})
+
+        facets = response.data['facets']
+        self.assertEqual(facets['category'], [{'id': self.category.id, 'name': 'Electronics', 'count': 2},
+                                              {'id': self.books.id, 'name': 'Books', 'count': 1}])
+        self.assertEqual(facets['city'], [{'id': self.city.id, 'name': 'Tehran', 'count': 1}])
+        self.assertEqual(facets['price'][0], {'min': 0, 'max': 500_000, 'count': 3})
+        self.assertEqual(sum(bucket['count'] for bucket in facets['price']), 3)
+
+        response = self.client.get(url, {'search': 'phone', 'max_price': 100, 'facets': 'category'})
+        self.assertEqual(set(response.data['facets']), {'category'})
+        self.assertEqual([value['count'] for value in response.data['facets']['category']], [1, 1])
+
+        response = self.client.get(url, {'facets': 'brand'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_index_follows_product_updates(self):
+        self.search(search='phone')
+        self.novel.name = 'Atlas'
+        self.novel.save()
+        self.assertNotIn(self.novel.id, self.search(search='phone'))
+        self.assertEqual(self.search(search='atlas'), [self.novel.id])
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class CatalogCursorPaginationTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.category = ProductCategory.objects.create(name='Electronics')
+        cities = [City.objects.create(name='Tehran'), City.objects.create(name='Shiraz'), None]
+        for i in range(25):
+            Product.objects.create(name=f"Product {i % 7}", price=(i % 4) * 100, category=self.category,
+                                   city=cities[i % 3])
+
+    def walk(self, **params):
+        url = reverse('search products')
+        params.update({'pagination': 'cursor', 'page_size': 4})
+        response = self.client.get(url, params)
+        ids = []
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.extend(item['id'] for item in response.data['results'])
+            if response.data['next'] is None:
+                return ids
+            response = self.client.get(response.data['next'])
+
+    def test_cursor_pages_cover_every_product_once_in_order(self):
+        for order_by in ['name', '-name', 'price', '-price', 'city', '-city']:
+            ids = self.walk(order_by=order_by)
+            self.assertEqual(len(ids), 25, order_by)
+            self.assertEqual(len(set(ids)), 25, order_by)
+        self.assertEqual(len(set(self.walk(search='product'))), 25)
+
+        products = {product.id: product for product in Product.active.all()}
+        prices = [products[product_id].price for product_id in self.walk(order_by='-price')]
+        self.assertEqual(prices, sorted(prices, reverse=True))
+
+    def test_cursor_pagination_skips_count_unless_asked(self):
+        url = reverse('search products')
+        response = self.client.get(url, {'pagination': 'cursor'})
+        self.assertNotIn('count', response.data)
+        response = self.client.get(url, {'pagination': 'cursor', 'count': 'exact', 'max_price': 100})
+        self.assertEqual(response.data['count'], 13)
+        response = self.client.get(url, {'count': 'estimate'})
+        self.assertEqual(response.data['count'], 25)
+
+    def test_invalid_or_foreign_cursor_is_rejected(self):
+        url = reverse('search products')
+        response = self.client.get(url, {'pagination': 'cursor', 'cursor': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.get(url, {'pagination': 'cursor', 'page_size': 2, 'order_by': 'price'})
+        cursor = response.data['next'].split('cursor=')[1].split('&')[0]
+        response = self.client.get(url, {'pagination': 'cursor', 'cursor': cursor, 'order_by': 'name'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_categories_cursor_pagination(self):
+        for i in range(5):
+            ProductCategory.objects.create(name=f"Category {i}")
+        url = reverse('search categories')
+        response = self.client.get(url, {'pagination': 'cursor', 'page_size': 4})
+        names = [item['name'] for item in response.data['results']]
+        response = self.client.get(response.data['next'])
+        names += [item['name'] for item in response.data['results']]
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(names, sorted(ProductCategory.active.values_list('name', flat=True)))
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class CatalogQueryCountTestCase(QueryCountAssertionsMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user('user@test.com', 'userpass')
+        self.city = City.objects.create(name='Tehran')
+
+    def add_products(self, size):
+        for i in range(Product.objects.count(), size):
+            category = ProductCategory.objects.create(name=f"Category {i}")
+            Product.objects.create(name=f"Product {i}", price=i, category=category, city=self.city)
+
+    def test_get_products_query_count_does_not_grow_with_page_size(self):
+        url = reverse('search products')
+        self.assertConstantQueries(lambda: self.client.get(url, {'page_size': 100}), self.add_products, expected=2)
+        self.assertConstantQueries(lambda: self.client.get(url, {'pagination': 'cursor', 'page_size': 100}),
+                                   self.add_products, sizes=(30, 60), expected=1)
+
+    def test_get_categories_query_count_does_not_grow_with_page_size(self):
+        url = reverse('search categories')
+        self.assertConstantQueries(lambda: self.client.get(url, {'page_size': 100}), self.add_products, expected=2)
+
+    def test_get_user_carts_query_count_does_not_grow_with_cart_size(self):
+        self.client.force_authenticate(user=self.user)
+        url = reverse('user get carts')
+
+        def fill_carts(size):
+            self.add_products(size)
+            for product in Product.objects.all()[:size]:
+                cart = Cart.objects.create(user=self.user, cart_status='O')
+                CartItem.objects.create(cart=cart, product=product)
+
+        # The ETag aggregate, then the carts and their products
+        self.assertConstantQueries(lambda: self.client.get(url), fill_carts, expected=3)
+
+    def test_get_user_purchase_receipts_query_count_does_not_grow(self):
+        self.client.force_authenticate(user=self.user)
+        url = reverse('user get purchase')
+        self.add_products(5)
+        products = list(Product.objects.all())
+
+        def add_receipts(size):
+            for _ in range(PurchaseReceipt.objects.count(), size):
+                receipt = PurchaseReceipt.objects.create(user=self.user, price=0)
+                for product in products:
+                    order = Order.objects.create(product=product, user=self.user, price=product.price)
+                    ReceiptOrder.objects.create(receipt=receipt, order=order, user=self.user)
+
+        self.assertConstantQueries(lambda: self.client.get(url, {'page_size': 50}), add_receipts, expected=2)
+
+        receipt_ids = []
+        response = self.client.get(url, {'page_size': 10})
+        while True:
+            receipt_ids.extend(receipt['id'] for receipt in response.data['results'])
+            if response.data['next'] is None:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(receipt_ids, sorted(receipt_ids, reverse=True))
+        self.assertEqual(len(receipt_ids), 25)
+
+    def test_add_items_to_cart_query_count_does_not_grow_with_batch_size(self):
+        self.client.force_authenticate(user=self.user)
+        url = reverse('user add items to cart')
+        self.add_products(9)
+        product_ids = list(Product.objects.values_list('id', flat=True))
+        batch = []
+
+        def next_batch(size):
+            CartItem.objects.all().delete()
+            Cart.objects.all().delete()
+            Cart.objects.create(user=self.user, cart_status='O')
+            CartItem.objects.create(cart=Cart.objects.get(), product_id=product_ids[0], quantity=1)
+            batch[:] = [{'product_id': product_id, 'quantity': 1} for product_id in product_ids[:size]]
+
+        self.assertConstantQueries(lambda: self.client.post(url, batch, format='json'), next_batch, sizes=(2, 4, 9))
+
+        next_batch(1)
+        response = self.client.post(url, [{'product_id': product_ids[0], 'quantity': 2}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(CartItem.active.get(product_id=product_ids[0]).quantity, 3)
+
+    def test_add_items_to_cart_with_duplicates_and_unknown_products(self):
+        self.client.force_authenticate(user=self.user)
+        url = reverse('user add items to cart')
+        self.add_products(2)
+        first, second = Product.objects.values_list('id', flat=True)
+
+        response = self.client.post(url, [{'product_id': first, 'quantity': 1}, {'product_id': second, 'quantity': 1},
+                                          {'product_id': first, 'quantity': 2}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['quantity'] for item in response.data['items']], [3, 1, 3])
+        self.assertEqual(CartItem.active.get(product_id=first).quantity, 3)
+
+        response = self.client.post(url, [{'product_id': second, 'quantity': 1}, {'product_id': 0, 'quantity': 1}],
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(CartItem.active.get(product_id=second).quantity, 1)
+
+
+class CatalogResponseCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.admin_user = User.objects.create_superuser('admin@test.com', 'adminpass')
+        self.user = User.objects.create_user('user@test.com', 'userpass')
+        self.category = ProductCategory.objects.create(name='Electronics')
+        self.product = Product.objects.create(name='Laptop', price=1000, category=self.category)
+
+    def test_repeated_catalog_requests_are_served_from_cache(self):
+        url = reverse('search products')
+        first = self.client.get(url, {'min_price': '10', 'page_size': 10})
+        with self.assertNumQueries(0):
+            second = self.client.get(url, {'page_size': 10, 'min_price': 10})
+        self.assertEqual(second.data, first.data)
+
+        with self.assertNumQueries(2):
+            self.client.get(url, {'min_price': 10, 'page_size': 5})
+
+    def test_catalog_writes_invalidate_cached_pages(self):
+        products_url, categories_url = reverse('search products'), reverse('search categories')
+        self.client.get(products_url)
+        self.client.get(categories_url)
+
+        self.client.force_authenticate(user=self.admin_user)
+        self.client.post(reverse('admin update products'), {'id': self.product.id, 'price': 900}, format='json')
+        self.client.post(reverse('admin create categories'), {'name': 'Books'}, format='json')
+        self.client.force_authenticate(user=None)
+
+        self.assertEqual(self.client.get(products_url).data['results'][0]['price'], 900)
+        self.assertEqual(self.client.get(categories_url).data['count'], 2)
+
+        # Ratings are left to the cache timeout instead of emptying the whole catalog cache
+        self.client.force_authenticate(user=self.user)
+        self.client.post(reverse('user rate product'), {'product_id': self.product.id, 'rate': 4}, format='json')
+        self.client.force_authenticate(user=None)
+        self.assertIsNone(self.client.get(products_url).data['results'][0]['rating'])
+        with override_settings(CATALOG_CACHE_TIMEOUT=0):
+            self.assertEqual(self.client.get(products_url).data['results'][0]['rating'], 4.0)
+
+    @override_settings(CATALOG_CACHE_TIMEOUT=0)
+    def test_zero_timeout_disables_the_cache(self):
+        url = reverse('search products')
+        self.client.get(url)
+        with self.assertNumQueries(2):
+            self.client.get(url)
+
+
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.admin_user = User.objects.create_superuser('admin@test.com', 'adminpass')
+        self.user = User.objects.create_user('user@test.com', 'userpass')
+        self.category = ProductCategory.objects.create(name='Electronics')
+        self.city = City.objects.create(name='Tehran')
+        self.product = Product.objects.create(name='Laptop', price=1000, category=self.category)
+
+    @override_settings(CATALOG_CACHE_TIMEOUT=0)
+    def test_unchanged_products_page_is_not_modified(self):
+        url = reverse('search products')
+        response = self.client.get(url, {'category': 'Electronics'})
+        # The newest `updated` does not move when a product is deactivated or leaves the filter
+        self.assertNotIn('Last-Modified', response)
+
+        # The ETag comes from the page itself: its count and rows, never an aggregate over the whole filter
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'category': 'Electronics'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        params = {'category': 'Electronics', 'pagination': 'cursor'}
+        etag = self.client.get(url, params)['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code,
+                             status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('COUNT', queries[0]['sql'])
+
+        self.client.force_authenticate(user=self.admin_user)
+        self.client.post(reverse('admin update products'), {'id': self.product.id, 'price': 900}, format='json')
+        response = self.client.get(url, {'category': 'Electronics'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_categories_etag_follows_category_writes(self):
+        url = reverse('search categories')
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code,
+                             status.HTTP_304_NOT_MODIFIED)
+
+        self.client.force_authenticate(user=self.admin_user)
+        self.client.post(reverse('admin create categories'), {'name': 'Books'}, format='json')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_user_addresses_and_carts_etags_follow_their_content(self):
+        self.client.force_authenticate(user=self.user)
+        addresses_url, carts_url = reverse('user get address'), reverse('user get carts')
+        addresses_etag = self.client.get(addresses_url)['ETag']
+        carts_etag = self.client.get(carts_url)['ETag']
+        self.assertEqual(self.client.get(addresses_url, HTTP_IF_NONE_MATCH=addresses_etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(self.client.get(carts_url, HTTP_IF_NONE_MATCH=carts_etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+
+        self.client.post(reverse('user create address'), {'address': 'home', 'city': 'Tehran'}, format='json')
+        self.client.post(reverse('user add items to cart'), [{'product_id': self.product.id, 'quantity': 1}],
+                         format='json')
+        response = self.client.get(addresses_url, HTTP_IF_NONE_MATCH=addresses_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        addresses_etag = response['ETag']
+        response = self.client.get(carts_url, HTTP_IF_NONE_MATCH=carts_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+
+        other = User.objects.create_user('other@test.com', 'otherpass')
+        self.client.force_authenticate(user=other)
+        self.assertEqual(self.client.get(addresses_url, HTTP_IF_NONE_MATCH=addresses_etag).status_code,
+                         status.HTTP_200_OK)
+
+        # Changes made elsewhere, e.g. by another worker with its own cache, or to the city an address shows
+        self.client.force_authenticate(user=self.user)
+        cache.clear()
+        City.objects.filter(pk=self.city.pk).update(name='Tehran Province')
+        self.assertEqual(self.client.get(addresses_url, HTTP_IF_NONE_MATCH=addresses_etag).status_code,
+                         status.HTTP_200_OK)
+
+
+    def test_unchanged_user_addresses_and_carts_skip_serialization(self):
+        self.client.force_authenticate(user=self.user)
+        addresses_url, carts_url = reverse('user get address'), reverse('user get carts')
+        address_id = self.client.post(reverse('user create address'), {'address': 'home', 'city': 'Tehran'},
+                                      format='json').data['id']
+        self.client.post(reverse('user add items to cart'), [{'product_id': self.product.id, 'quantity': 1}],
+                         format='json')
+        addresses_etag = self.client.get(addresses_url)['ETag']
+        carts_etag = self.client.get(carts_url)['ETag']
+
+        with patch.object(OutUserGetAddress, 'to_representation') as addresses, \
+                patch.object(OutGetUserCarts, 'to_representation') as carts, self.assertNumQueries(2):
+            self.assertEqual(self.client.get(addresses_url, HTTP_IF_NONE_MATCH=addresses_etag).status_code,
+                             status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(self.client.get(carts_url, HTTP_IF_NONE_MATCH=carts_etag).status_code,
+                             status.HTTP_304_NOT_MODIFIED)
+        addresses.assert_not_called()
+        carts.assert_not_called()
+
+        self.client.post(reverse('user update address'), {'address_id': address_id, 'new_address': 'work'},
+                         format='json')
+        response = self.client.get(addresses_url, HTTP_IF_NONE_MATCH=addresses_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['address'], 'work')
+
+
+class RegistryTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user('user@test.com', 'userpass')
+        self.admin_user = User.objects.create_superuser('admin@test.com', 'adminpass')
+        self.city = City.objects.create(name='Tehran')
+        self.category = ProductCategory.objects.create(name='Electronics')
+
+    def test_lookups_cost_no_queries_once_loaded(self):
+        city_registry.get('Tehran')
+        category_registry.get('Electronics')
+        with self.assertNumQueries(0):
+            self.assertEqual(city_registry.get('Tehran').id, self.city.id)
+            self.assertEqual(category_registry.get_by_id(self.category.id).name, 'Electronics')
+            self.assertEqual(city_registry.ids_containing('teh'), [self.city.id])
+            with self.assertRaises(City.DoesNotExist):
+                city_registry.get('Shiraz')
+
+        self.client.force_authenticate(user=self.user)
+        with self.assertNumQueries(1):
+            self.client.post(reverse('user create address'), {'address': 'home', 'city': 'Tehran'}, format='json')
+
+    def test_saves_invalidate_the_registry(self):
+        category_registry.get('Electronics')
+        self.client.force_authenticate(user=self.admin_user)
+        self.client.post(reverse('admin update categories'), {'current_name': 'Electronics', 'new_name': 'Gadgets'},
+                         format='json')
+        self.assertEqual(category_registry.get('Gadgets').id, self.category.id)
+        with self.assertRaises(ProductCategory.DoesNotExist):
+            category_registry.get('Electronics')
+
+        City.objects.create(name='Shiraz', is_active=False)
+        with self.assertRaises(City.DoesNotExist):
+            city_registry.get('Shiraz')
+        self.assertEqual(city_registry.get('Shiraz', include_inactive=True).name, 'Shiraz')
+
+    def test_version_bumped_by_another_worker_reloads_the_registry(self):
+        city_registry.get('Tehran')
+        City.objects.filter(pk=self.city.pk).update(name='Tehran Province')
+        self.assertEqual(city_registry.get('Tehran').id, self.city.id)
+
+        bump_version(city_registry.namespace)
+        self.assertEqual(city_registry.get('Tehran Province').id, self.city.id)
+
+    def test_registry_is_reloaded_after_its_ttl(self):
+        city_registry.get('Tehran')
+        City.objects.filter(pk=self.city.pk).update(is_active=False)
+        with override_settings(REGISTRY_TTL=0):
+            with self.assertRaises(City.DoesNotExist):
+                city_registry.get('Tehran')
+
+
+@patch('apps.shop.suggest.ProductSuggester.background_refresh', False)
+class SuggestProductsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.phones = ProductCategory.objects.create(name='Phones')
+        self.books = ProductCategory.objects.create(name='Photo Books')
+        self.phone = Product.objects.create(name='Smart Phone', price=500, category=self.phones, rating_count=3)
+        self.cover = Product.objects.create(name='Phone Cover', price=20, category=self.phones, rating_count=9)
+        self.album = Product.objects.create(name='Photo Album', price=40, category=self.books)
+        Product.objects.create(name='Old Phone', price=10, category=self.phones, is_active=False)
+
+    def suggest(self, q, **params):
+        response = self.client.get(reverse('suggest products'), {'q': q, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_suggestions_match_word_prefixes_by_popularity(self):
+        data = self.suggest('PHO')
+        self.assertEqual([item['id'] for item in data['products']], [self.cover.id, self.phone.id, self.album.id])
+        self.assertEqual([item['name'] for item in data['categories']], ['Phones', 'Photo Books'])
+        self.assertEqual([item['name'] for item in self.suggest('phone c')['products']], ['Phone Cover'])
+        self.assertEqual(len(self.suggest('pho', limit=1)['products']), 1)
+        self.assertEqual(self.suggest('tablet'), {'products': [], 'categories': []})
+
+    def test_warm_suggestions_do_not_query_the_database(self):
+        self.suggest('pho')
+        with self.assertNumQueries(0):
+            self.suggest('sma')
+            self.suggest('phot')
+
+    def test_suggestions_follow_product_and_category_writes(self):
+        self.suggest('pho')
+        self.cover.is_active = False
+        self.cover.save()
+        tablet = Product.objects.create(name='Phablet', price=300, category=self.phones)
+        self.books.is_active = False
+        self.books.save()
+
+        data = self.suggest('ph')
+        self.assertEqual({item['id'] for item in data['products']}, {self.phone.id, self.album.id, tablet.id})
+        self.assertEqual([item['name'] for item in data['categories']], ['Phones'])
+
+    def test_own_writes_do_not_rebuild_the_index(self):
+        self.suggest('pho')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.album.name = 'Photo Frame'
+            self.album.save()
+        with self.assertNumQueries(0):
+            self.assertIn('Photo Frame', [item['name'] for item in self.suggest('photo f')['products']])
+
+        # A write in another worker only shows up as a newer version
+        Product.objects.filter(pk=self.phone.pk).update(name='Smart Speaker')
+        bump_version(suggester.namespace)
+        self.assertEqual([item['name'] for item in self.suggest('smart')['products']], ['Smart Speaker'])
+
+    def test_blank_prefix_is_rejected(self):
+        response = self.client.get(reverse('suggest products'), {'q': ''})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProductBulkUpdateTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.admin_user = User.objects.create_superuser('admin@test.com', 'adminpass')
+        self.client.force_authenticate(user=self.admin_user)
+        self.electronics = ProductCategory.objects.create(name='Electronics')
+        self.books = ProductCategory.objects.create(name='Books')
+        self.phone = Product.objects.create(name='Phone', price=1000, category=self.electronics)
+        self.laptop = Product.objects.create(name='Laptop', price=2005, category=self.electronics)
+        self.novel = Product.objects.create(name='Novel', price=30, category=self.books)
+        self.url = reverse('admin bulk update products')
+
+    def test_update_product_writes_only_changed_columns(self):
+        self.client.post(reverse('admin update products'), {'id': self.phone.id, 'price': 1000}, format='json')
+        self.phone.refresh_from_db()
+        updated = self.phone.updated
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('admin update products'), {'id': self.phone.id, 'price': 900, 'name': 'Phone'},
+                             format='json')
+        update_sql = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(update_sql), 1)
+        self.assertNotIn('"description"', update_sql[0])
+        self.assertNotIn('"name"', update_sql[0])
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.price, 900)
+        self.assertGreater(self.phone.updated, updated)
+
+    def test_patches_are_applied_in_bulk(self):
+        before = self.novel.updated
+        response = self.client.post(self.url, {'patches': [
+            {'id': self.phone.id, 'price': 900},
+            {'id': self.laptop.id, 'price': 1900},
+            {'id': self.novel.id, 'name': 'Paperback Novel', 'category': 'Electronics'},
+            {'id': 0, 'price': 1},
+        ]}, format='json')
+
+        self.assertEqual(response.data, {'updated': 3, 'not_found': [0]})
+        self.assertEqual(dict(Product.objects.values_list('id', 'price')),
+                         {self.phone.id: 900, self.laptop.id: 1900, self.novel.id: 30})
+        self.novel.refresh_from_db()
+        self.assertEqual((self.novel.name, self.novel.category_id), ('Paperback Novel', self.electronics.id))
+        self.assertGreater(self.novel.updated, before)
+
+        response = self.client.get(reverse('search products'), {'search': 'paperback'})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.novel.id])
+
+    def test_filter_reprices_in_a_single_update(self):
+        category_registry.get('Electronics')
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, {'filter': {'category': 'Electronics'}, 'price': {'multiply': '1.1'}},
+                                        format='json')
+        self.assertEqual(response.data, {'updated': 2})
+        self.assertEqual(dict(Product.objects.values_list('id', 'price')),
+                         {self.phone.id: 1100, self.laptop.id: 2206, self.novel.id: 30})
+
+        self.client.post(self.url, {'filter': {'max_price': 1500}, 'price': {'add': -100}}, format='json')
+        self.assertEqual(dict(Product.objects.values_list('id', 'price')),
+                         {self.phone.id: 1000, self.laptop.id: 2206, self.novel.id: 0})
+
+    def test_bulk_update_input_must_be_patches_or_filter_with_price(self):
+        for data in [{}, {'filter': {'category': 'Books'}}, {'price': {'add': 1}},
+                     {'patches': [{'id': self.phone.id, 'price': 1}], 'price': {'add': 1}},
+                     {'patches': [{'id': self.phone.id, 'price': 1}, {'id': self.phone.id, 'price': 2}]},
+                     {'filter': {}, 'price': {}}, {'filter': {}, 'price': {'multiply': '0.5'}},
+                     {'filter': {'all': False}, 'price': {'add': 1}},
+                     {'filter': {'category': 'Electronics'}, 'price': {'multiply': 0}}]:
+            response = self.client.post(self.url, data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, data)
+        self.assertEqual(dict(Product.objects.values_list('id', 'price')),
+                         {self.phone.id: 1000, self.laptop.id: 2005, self.novel.id: 30})
+
+        response = self.client.post(self.url, {'filter': {'all': True}, 'price': {'add': 1}}, format='json')
+        self.assertEqual(response.data, {'updated': 3})
+
+
+@override_settings(PRODUCT_CHANGES_LAG=0)
+class ProductChangesTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user('user@test.com', 'userpass')
+        self.client.force_authenticate(user=self.user)
+        self.category = ProductCategory.objects.create(name='Electronics')
+        self.products = [Product.objects.create(name=f'Product {i}', price=i, category=self.category) for i in range(5)]
+
+    def changes(self, **params):
+        response = self.client.get(reverse('product changes'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_sync_resumes_from_the_watermark(self):
+        first = self.changes(page_size=3)
+        self.assertTrue(first['has_more'])
+        second = self.changes(page_size=3, since=first['watermark'])
+        self.assertFalse(second['has_more'])
+        self.assertEqual([row['id'] for row in first['results'] + second['results']],
+                         [product.id for product in self.products])
+
+        idle = self.changes(since=second['watermark'])
+        self.assertEqual((idle['results'], idle['watermark']), ([], second['watermark']))
+
+        changed = self.products[1]
+        changed.is_active = False
+        changed.save()
+        delta = self.changes(since=idle['watermark'])
+        self.assertEqual([(row['id'], row['is_active']) for row in delta['results']], [(changed.id, False)])
+
+    def test_category_changes_mark_their_products_changed(self):
+        watermark = self.changes()['watermark']
+        admin = User.objects.create_superuser('admin@test.com', 'adminpass')
+        self.client.force_authenticate(user=admin)
+        url = reverse('admin update categories')
+        self.client.post(url, {'current_name': 'Electronics', 'new_name': 'Gadgets'}, format='json')
+        response = self.changes(since=watermark)
+        self.assertEqual(len(response['results']), 5)
+        self.assertEqual({row['category']['name'] for row in response['results']}, {'Gadgets'})
+
+        # A no-op update does not touch the products
+        self.client.post(url, {'current_name': 'Gadgets', 'new_name': 'Gadgets', 'is_active': True}, format='json')
+        self.assertEqual(self.changes(since=response['watermark'])['results'], [])
+
+    def test_since_accepts_a_datetime(self):
+        Product.objects.filter(pk=self.products[0].pk).update(updated=timezone.now() - timedelta(days=2))
+        since = (timezone.now() - timedelta(days=1)).isoformat()
+        results = self.changes(since=since)['results']
+        self.assertEqual([row['id'] for row in results], [product.id for product in self.products[1:]])
+
+        response = self.client.get(reverse('product changes'), {'since': 'not-a-watermark'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(PRODUCT_CHANGES_LAG=60)
+    def test_recent_changes_are_held_back(self):
+        self.assertEqual(self.changes()['results'], [])
+
+
+class ProductExportTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user('user@test.com', 'userpass')
+        self.client.force_authenticate(user=self.user)
+        self.category = ProductCategory.objects.create(name='Electronics')
+        self.city = City.objects.create(name='Tehran')
+        self.phone = Product.objects.create(name='Phone, "Pro"', price=1000, category=self.category, city=self.city)
+        self.cable = Product.objects.create(name='Cable', description='2m\nUSB-C', price=5)
+        Product.objects.create(name='Old Phone', price=10, is_active=False)
+
+    def export(self, **params):
+        response = self.client.get(reverse('export products'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_export_streams_active_products_as_ndjson(self):
+        with self.assertNumQueries(1):
+            response, content = self.export()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['id'] for row in rows], [self.phone.id, self.cable.id])
+        self.assertEqual((rows[0]['name'], rows[0]['category_name'], rows[0]['city_name']),
+                         ('Phone, "Pro"', 'Electronics', 'Tehran'))
+        self.assertEqual((rows[1]['description'], rows[1]['category_name']), ('2m\nUSB-C', None))
+
+    def test_export_streams_csv(self):
+        response, content = self.export(export_format='csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(StringIO(content)))
+        self.assertEqual([row['name'] for row in rows], ['Phone, "Pro"', 'Cable'])
+        self.assertEqual(rows[1]['description'], '2m\nUSB-C')
+
+    def test_export_requires_authentication(self):
+        self.client.force_authenticate(user=None)
+        response = self.client.get(reverse('export products'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ProductImportTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.admin_user = User.objects.create_superuser('admin@test.com', 'adminpass')
+        self.category = ProductCategory.objects.create(name='Electronics')
+        self.city = City.objects.create(name='Tehran')
+
+    def test_admin_imports_csv_and_reports_bad_rows(self):
+        content = ('name,description,price,category,city,is_active\n'
+                   'Smart Phone,"Android, 128GB",500,Electronics,Tehran,true\n'
+                   'Toaster,,30,Kitchen,,\n'
+                   'Laptop,,-5,Electronics,,\n'
+                   'Mouse,,10,Electronics,,false,extra\n'
+                   'Keyboard,,20,,,\n')
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.post(reverse('admin import products'),
+                                    {'file': SimpleUploadedFile('products.csv', content.encode())},
+                                    format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 3))
+        self.assertEqual([error['line'] for error in response.data['errors']], [3, 4, 5])
+        self.assertIn('category', response.data['errors'][0]['errors'])
+        self.assertIn('price', response.data['errors'][1]['errors'])
+
+        phone = Product.active.get(name='Smart Phone')
+        self.assertEqual((phone.description, phone.price, phone.category_id, phone.city_id),
+                         ('Android, 128GB', 500, self.category.id, self.city.id))
+        self.assertIsNone(Product.active.get(name='Keyboard').category_id)
+
+        self.client.force_authenticate(user=None)
+        response = self.client.get(reverse('search products'), {'search': 'android'})
+        self.assertEqual([item['id'] for item in response.data['results']], [phone.id])
+
+    def test_import_jsonl_in_chunks(self):
+        lines = [json.dumps({'name': f'Product {i}', 'price': i, 'category': 'Electronics'}) for i in range(7)]
+        lines.insert(3, '{not json')
+        lines.insert(5, '[1, 2]')
+        stream = BytesIO('\n'.join(lines).encode())
+
+        with patch('apps.shop.product_import.Product.objects.bulk_create',
+                   wraps=Product.objects.bulk_create) as bulk_create:
+            report = import_products(stream, 'jsonl', chunk_size=3)
+        self.assertEqual(bulk_create.call_count, 3)
+        self.assertEqual((report['created'], report['failed']), (7, 2))
+        self.assertEqual([error['line'] for error in report['errors']], [4, 6])
+        self.assertEqual(Product.objects.count(), 7)
+
+    def test_undecodable_lines_are_reported_as_row_errors(self):
+        csv_content = (b'name,price,category\nDesk Lamp,40,Electronics\nCaf\xe9 Table,90,Electronics\n'
+                       b'Chair,60,Electronics\n')
+        jsonl_content = b'{"name": "Sofa", "price": 5, "category": "Electronics"}\n{"name": "Caf\xe9"}\n'
+        for file_format, content, created in (('csv', csv_content, 2), ('jsonl', jsonl_content, 1)):
+            with self.subTest(file_format=file_format):
+                report = import_products(BytesIO(content), file_format)
+                self.assertEqual((report['created'], report['failed']), (created, 1))
+                self.assertEqual(report['errors'][0]['line'], 3 if file_format == 'csv' else 2)
+                self.assertIn('Invalid UTF-8', report['errors'][0]['errors']['non_field_errors'][0])
+
+    def test_import_products_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as file:
+            file.write('name,price,category\nDesk Lamp,40,Electronics\nChair,abc,Electronics\n')
+        self.addCleanup(os.remove, file.name)
+
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_products', file.name, stdout=stdout, stderr=stderr)
+        self.assertIn('Imported 1 products, 1 rows failed', stdout.getvalue())
+        self.assertIn('line 3: price:', stderr.getvalue())
+        self.assertTrue(Product.objects.filter(name='Desk Lamp').exists())
+
+        with self.assertRaises(CommandError):
+            call_command('import_products', 'products.xml', stdout=StringIO())
+
+
+@skipUnless(is_postgresql(), 'Query plans are checked on PostgreSQL only')
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class SelectorQueryPlanTestCase(QueryPlanAssertionsMixin, TestCase):
+    """Selectors and services must reach the large tables through an index once they are seeded and analyzed."""
+    large_tables = {'shop_product', 'shop_cart', 'shop_cartitem', 'shop_address', 'shop_userrateproduct',
+                    'shop_purchasereceipt'}
+
+    @classmethod
+    def setUpTestData(cls):
+        password = make_password('userpass')
+        users = User.objects.bulk_create([User(email=f'user{i}@test.com', password=password) for i in range(2000)])
+        cls.city = City.objects.create(name='Tehran')
+        categories = ProductCategory.objects.bulk_create([ProductCategory(name=f'Category {i}') for i in range(50)])
+        products = Product.objects.bulk_create([
+            Product(name=f'Product {i}', price=i * 1000, category=categories[i % 50], city=cls.city,
+                    is_active=i % 10 != 9)
+            for i in range(20000)], batch_size=2000)
+        get_search_backend().index_products([product.pk for product in products])
+
+        addresses = Address.objects.bulk_create([Address(user=user, city=cls.city, address='Street') for user in users])
+        carts = Cart.objects.bulk_create([Cart(user=user, cart_status=cart_status)
+                                          for user in users for cart_status in ('O', 'P', 'P')], batch_size=2000)
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=products[i * 10 % 20000])
+                                      for i, cart in enumerate(carts)], batch_size=2000)
+        UserRateProduct.objects.bulk_create([UserRateProduct(user=users[i % 2000], product=products[i], rate=3)
+                                             for i in range(1, 20000, 3)], batch_size=2000)
+        PurchaseReceipt.objects.bulk_create([PurchaseReceipt(user=user, price=1000)
+                                             for user in users for _ in range(3)], batch_size=2000)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.user, cls.address = users[0], addresses[0]
+        cls.cart = carts[0]
+        cls.product = products[1]
+
+    def assertIndexed(self, func):
+        self.assertNoSequentialScans(func, self.large_tables)
+
+    def test_catalog_selectors(self):
+        # The search term has to be selective: one matching every row is rightly read with a sequential scan
+        for validated_data in ({}, {'order_by': 'price'}, {'order_by': '-price', 'min_price': 5000, 'max_price': 9000},
+                               {'category': 'Category 3'}, {'search': 'Product 1234'},
+                               {'search': 'Prodcut 12345', 'fuzzy': True}):
+            with self.subTest(validated_data=validated_data):
+                self.assertIndexed(lambda: list(search_products(validated_data)[:20]))
+        self.assertIndexed(lambda: get_product_facets({'category': 'Category 3'}, ['category', 'city', 'price']))
+        self.assertIndexed(lambda: list(get_product_changes()[:500]))
+
+    def test_user_selectors(self):
+        self.assertIndexed(lambda: list(get_user_open_carts(self.user)))
+        self.assertIndexed(lambda: list(get_user_purchase_receipts(self.user)[:20]))
+        self.assertIndexed(lambda: get_user_addresses_validators(self.user))
+        self.assertIndexed(lambda: get_user_carts_validators(self.user))
+        items = [{'product_id': self.product.id, 'quantity': 1}]
+        self.assertIndexed(lambda: process_add_items_to_cart(self.user, items))
+
+    def test_user_services(self):
+        self.assertIndexed(lambda: create_or_update_user_product_rate(user=self.user, product_id=self.product.id,
+                                                                      rate=4))
+        self.assertIndexed(lambda: remove_user_product_rate(user=self.user, product_id=self.product.id))
+        self.assertIndexed(lambda: update_user_address(user=self.user, address_id=self.address.id,
+                                                       new_address='Avenue', new_city=None))
+        self.assertIndexed(lambda: reserve_cart_for_purchase(user=self.user, cart_id=self.cart.id,
+                                                             address_id=self.address.id))
+        paid_cart = Cart.objects.filter(user=self.user, cart_status='P').first()
+        self.assertIndexed(lambda: delete_user_cart(user=self.user, cart_id=paid_cart.id))
+        self.assertIndexed(lambda: inactive_user_address(user=self.user, address_id=self.address.id))
+
+
+class SyntheticDataTestCase(TestCase):
+    def test_zipf_sampler_is_seeded_and_skewed(self):
+        first, second = ZipfSampler(1000, 1.1, random.Random(7)), ZipfSampler(1000, 1.1, random.Random(7))
+        draws = [first() for _ in range(5000)]
+        self.assertEqual(draws, [second() for _ in range(5000)])
+        self.assertTrue(all(0 <= draw < 1000 for draw in draws))
+        self.assertGreater(draws.count(0), 10 * draws.count(100))
+
+    def test_generate_synthetic_data(self):
+        stdout = StringIO()
+        call_command('generate_synthetic_data', seed=3, products=300, users=40, cities=5, categories=8, carts=120,
+                     ratings=400, comments=50, chunk_size=100, stdout=stdout)
+        self.assertIn('Generated', stdout.getvalue())
+
+        self.assertEqual(Product.objects.count(), 300)
+        self.assertEqual(User.objects.count(), 40)
+        self.assertEqual(Cart.objects.count(), 120)
+        self.assertEqual(Comment.objects.count(), 50)
+        self.assertAlmostEqual(UserRateProduct.objects.count(), 400, delta=40)
+        self.assertTrue(User.objects.first().check_password('synthetic'))
+
+        # Popularity is skewed, one open cart per user, and receipts add up to their orders
+        top_rated = UserRateProduct.objects.values('product').annotate(n=Count('id')).order_by('-n').first()
+        self.assertGreater(top_rated['n'], 400 / 300 * 5)
+        self.assertFalse(Cart.objects.filter(cart_status='O').values('user').annotate(n=Count('id'))
+                         .filter(n__gt=1).exists())
+        self.assertEqual(PurchaseReceipt.objects.count(), Cart.objects.filter(cart_status='P').count())
+        for receipt in PurchaseReceipt.objects.prefetch_related('items')[:20]:
+            self.assertEqual(receipt.price, sum(order.price * order.quantity for order in receipt.items.all()))
+        self.assertEqual(rebuild_product_rating_aggregates(dry_run=True), [])
+
+        # Sequences moved past the generated keys
+        self.assertGreater(Product.objects.create(name='Extra', price=1).id, 300)
+
+
+@patch('apps.shop.suggest.ProductSuggester.background_refresh', False)
+class EndpointBenchmarkTestCase(TestCase):
+    def setUp(self):
+        SyntheticDataGenerator(seed=1, products=60, users=10, cities=3, categories=4, carts=20, ratings=50,
+                               comments=10, chunk_size=50).generate()
+
+    def test_scenarios_cover_every_route(self):
+        self.assertEqual(uncovered_routes(BENCHMARK_SCENARIOS, 'apps.shop.urls', 'apps.user.urls'), [])
+
+    def test_every_scenario_succeeds(self):
+        client, context = APIClient(), build_benchmark_context()
+        for scenario in BENCHMARK_SCENARIOS:
+            with self.subTest(scenario=scenario.name):
+                result = run_scenario(client, scenario, context, iterations=2, warmup=0)
+                self.assertTrue(all(code < 400 for code in result['statuses']), result['statuses'])
+                self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+                self.assertGreater(result['peak_memory_kb'], 0)
+        # Every request was rolled back
+        self.assertFalse(Product.objects.filter(name='Benchmark product').exists())
+
+    def test_command_writes_results_and_catches_regressions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            call_command('benchmark_endpoints', existing=True, only=['categories', 'address list'], iterations=3,
+                         warmup=0, output=output, stdout=StringIO(), stderr=StringIO())
+            with open(output) as file:
+                report = json.load(file)
+            self.assertEqual(set(report['results']), {'categories', 'address list'})
+            self.assertEqual(report['meta']['dataset']['Product'], 60)
+
+            # Three iterations time too noisily to compare latencies; queries and statuses are what is checked
+            call_command('benchmark_endpoints', existing=True, only=['address list'], iterations=3, warmup=0,
+                         compare=output, threshold=1000, stdout=StringIO(), stderr=StringIO())
+
+            report['results']['address list']['queries'] -= 1
+            with open(output, 'w') as file:
+                json.dump(report, file)
+            with self.assertRaisesMessage(CommandError, 'queries per request'):
+                call_command('benchmark_endpoints', existing=True, only=['address list'], iterations=3, warmup=0,
+                             compare=output, threshold=1000, stdout=StringIO(), stderr=StringIO())
+
+    def test_compare_results_ignores_noise(self):
+        baseline = {'products': {'p95_ms': 10.0, 'queries': 3, 'statuses': [200]}}
+        self.assertEqual(compare_results(baseline, {'products': {'p95_ms': 10.5, 'queries': 3, 'statuses': [200]}}),
+                         [])
+        self.assertEqual(len(compare_results(baseline, {'products': {'p95_ms': 20.0, 'queries': 4,
+                                                                     'statuses': [500]}})), 3)
+
+
+class ProfilingMiddlewareTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        SyntheticDataGenerator(seed=2, products=30, users=5, cities=2, categories=3, carts=5, ratings=20,
+                               comments=5, chunk_size=50).generate()
+        self.client = APIClient()
+        self.staff = User.objects.create_user('staff@test.com', 'staffpass', is_staff=True)
+        self.regular = User.objects.create_user('regular@test.com', 'regularpass')
+
+    def get_products(self, user=None, **headers):
+        if user is not None:
+            headers['HTTP_AUTHORIZATION'] = f"Bearer {generate_tokens_for_user(user)['access']}"
+        return self.client.get(reverse('search products'), **headers)
+
+    def test_off_by_default(self):
+        self.assertNotIn('Server-Timing', self.get_products())
+        self.assertNotIn('Server-Timing', self.get_products(HTTP_X_PROFILE='1'))
+        self.assertNotIn('Server-Timing', self.get_products(self.regular, HTTP_X_PROFILE='1'))
+        self.assertNotIn('Server-Timing', self.get_products(self.staff))
+
+    def test_staff_header_adds_server_timing(self):
+        response = self.get_products(self.staff, HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        timings = dict(part.strip().split(';', 1) for part in response['Server-Timing'].split(','))
+        self.assertEqual(set(timings), {'db', 'serializer', 'app', 'total'})
+        self.assertRegex(timings['db'], r'^dur=[\d.]+;desc="[1-9]\d* queries"$')
+        self.assertGreater(float(timings['serializer'].removeprefix('dur=')), 0)
+
+    def test_async_requests_are_not_adapted(self):
+        # An adapted middleware would run every ASGI request in a thread
+        self.assertTrue(ProfilingMiddleware.async_capable)
+        with self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()
+
+    async def test_staff_header_adds_server_timing_under_asgi(self):
+        token = (await asyncio.to_thread(generate_tokens_for_user, self.staff))['access']
+        response = await self.async_client.get(reverse('search products'),
+                                               headers={'Authorization': f'Bearer {token}', 'X-Profile': '1'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Queries and serializers of the sync view, run in a worker thread, are still counted
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+        self.assertNotIn('serializer;dur=0.00,', response['Server-Timing'])
+        response = await self.async_client.get(reverse('search products'), headers={'X-Profile': '1'})
+        self.assertNotIn('Server-Timing', response)
+
+    def test_sampled_requests_are_dumped(self):
+        context = build_benchmark_context()
+        purchase = next(scenario for scenario in BENCHMARK_SCENARIOS if scenario.name == 'cart purchase')
+        with tempfile.TemporaryDirectory() as directory, StringIO() as output, \
+                override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=1, PROFILING_DIRECTORY=directory):
+            self.assertIn('Server-Timing', self.get_products())
+            # The purchase view is async, so its queries run through sync_to_async
+            with patch('sys.stdout', output):
+                response = purchase.request(self.client, context)()
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIn('Server-Timing', response)
+
+            files = sorted(os.listdir(directory))
+            self.assertEqual(len(files), 4)
+            self.assertEqual(sum(name.endswith('.prof') for name in files), 2)
+            summary_name = next(name for name in files if name.endswith('.json') and 'purchase' in name)
+            with open(os.path.join(directory, summary_name)) as file:
+                summary = json.load(file)
+        self.assertEqual(summary['method'], 'POST')
+        self.assertGreater(summary['queries'], 0)
+        self.assertGreater(summary['serializer_ms'], 0)
+        self.assertEqual(sum(statement['count'] for statement in summary['statements']), summary['queries'])
+
+    def test_repeated_statements_are_grouped(self):
+        profile = RequestProfile()
+        for pk in range(3):
+            profile(lambda *args: None, f"SELECT name FROM product WHERE id = {pk} AND name = 'x{pk}'", (), False, {})
+        statements = profile.query_breakdown()['statements']
+        self.assertEqual(statements[0]['count'], 3)
+        self.assertEqual(statements[0]['sql'], 'SELECT name FROM product WHERE id = ? AND name = ?')
+
+
+class LoadReplayTestCase(SimpleTestCase):
+    collection = os.path.join(settings.BASE_DIR, 'docs', 'postman.json')
+    config = os.path.join(settings.BASE_DIR, 'docs', 'load_scenarios.json')
+
+    def test_bundled_config_matches_the_collection(self):
+        requests, defaults = load_collection(self.collection)
+        self.assertEqual(requests['User Purchase Cart']['method'], 'POST')
+        self.assertEqual(requests['Add Items to Cart']['headers'], {'Authorization': 'Bearer {{user_token}}'})
+        self.assertEqual(defaults['base_url'], 'http://localhost:8000')
+        with open(self.config) as file:
+            LoadReplay(requests, json.load(file), defaults=defaults)
+
+    def test_arrivals_ramp_up_to_the_rate(self):
+        replay = LoadReplay({}, {'journeys': []}, rate=10, ramp=2, duration=3)
+        offsets = list(replay.arrivals())
+        self.assertEqual(len(offsets), 10 * 2 // 2 + 10 * 3 - 1)
+        self.assertEqual(offsets, sorted(offsets))
+        # Arrivals get denser along the ramp and are evenly spaced after it
+        self.assertGreater(offsets[1] - offsets[0], offsets[9] - offsets[8])
+        self.assertAlmostEqual(offsets[20] - offsets[19], 0.1)
+
+    def test_journeys_chain_extracted_values(self):
+        requests, defaults = load_collection(self.collection)
+        purchases = []
+
+        def handler(request):
+            path = request.url.path
+            if path.endswith('/register/'):
+                return httpx.Response(200, json={'message': 'OTP sent'})
+            if path.endswith('/verify-otp/'):
+                return httpx.Response(201, json={'id': 'x'})
+            if path.endswith('/login/'):
+                return httpx.Response(200, json={'access': 'token', 'refresh': 'r'})
+            if path.endswith('/products/'):
+                return httpx.Response(200, json={'results': [{'id': 7, 'city': {'name': 'Tehran'}}]})
+            if path.endswith('/address/create'):
+                return httpx.Response(201, json={'id': 3})
+            if path.endswith('/add-items/'):
+                self.assertEqual(json.loads(request.content), [{'product_id': 7, 'quantity': 1}])
+                return httpx.Response(200, json={'cart': {'id': 11}})
+            if path.endswith('/purchase'):
+                self.assertEqual(request.headers['Authorization'], 'Bearer token')
+                purchases.append(json.loads(request.content))
+                return httpx.Response(500)
+            return httpx.Response(200, json={})
+
+        with open(self.config) as file:
+            config = json.load(file)
+        for journey in config['journeys']:
+            journey['weight'] = 1 if journey['name'] == 'purchase' else 0
+            for step in journey['steps']:
+                step.pop('think', None)
+        otps = SimpleNamespace(get=lambda key: '123456')
+        replay = LoadReplay(requests, config, defaults=defaults, rate=20, ramp=0, duration=0.2, seed=1, cache=otps,
+                            transport=httpx.MockTransport(handler))
+        report = asyncio.run(replay.run())
+
+        self.assertEqual(report['journeys']['purchase']['started'], 3)
+        self.assertEqual(report['journeys']['purchase']['failed'], 3)
+        self.assertEqual(purchases, [{'cart_id': 11, 'address_id': 3}] * 3)
+        step = report['steps']['purchase: User Purchase Cart']
+        self.assertEqual((step['requests'], step['error_rate'], step['statuses']), (3, 1.0, {'500': 3}))
+        self.assertEqual(sum(step['histogram'].values()), 3)
+        self.assertEqual(report['steps']['purchase: Login']['errors'], 0)
+
+
+class ReadThroughCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_stale_value_is_served_while_another_caller_refreshes(self):
+        cache.set('key', ('stale', 0), 60)
+        cache.add('key:lock', 1, 60)
+        self.assertEqual(read_through('key', lambda: 'fresh', 60), 'stale')
+
+        cache.delete('key:lock')
+        self.assertEqual(read_through('key', lambda: 'fresh', 60), 'fresh')
+        self.assertEqual(read_through('key', lambda: 'newer', 60), 'fresh')
+
+    def test_cold_miss_waits_for_the_caller_holding_the_lock(self):
+        cache.add('key:lock', 1, 60)
+        calls = []
+
+        def sleep(seconds):
+            cache.set('key', ('computed elsewhere', float('inf')), 60)
+
+        with patch('apps.utils.cache.time.sleep', side_effect=sleep):
+            self.assertEqual(read_through('key', lambda: calls.append(1), 60), 'computed elsewhere')
+        self.assertEqual(calls, [])
+
+
+class PurchaseGatewayTestCase(SimpleTestCase):
+    def make_gateway(self, **options):
+        gateway = LocalPurchaseGateway(**options)
+        self.addCleanup(gateway.close)
+        return gateway
+
+    def test_charge_returns_tracking_code(self):
+        gateway = self.make_gateway()
+        with patch('builtins.print'):
+            tracking_code = asyncio.run(gateway.charge(100, 'key'))
+            self.assertEqual(asyncio.run(gateway.charge(100, 'key')), tracking_code)
+        self.assertTrue(10000 <= tracking_code <= 99999)
+
+    def test_concurrent_charges_with_one_key_pay_once(self):
+        gateway = self.make_gateway(latency=0.05)
+
+        async def charge_twice():
+            return await asyncio.gather(gateway.charge(100, 'key'), gateway.charge(100, 'key'))
+
+        with patch('builtins.print') as print_:
+            tracking_codes = asyncio.run(charge_twice())
+        self.assertEqual(tracking_codes[0], tracking_codes[1])
+        self.assertEqual([call.args for call in print_.call_args_list].count(('The payment was made successfully',)),
+                         1)
+
+    def test_unreadable_responses_are_unknown_outcomes(self):
+        for response in (httpx.Response(200, text='OK'), httpx.Response(200, json={'status': 'paid'})):
+            with self.subTest(response=response.content):
+                gateway = HttpPurchaseGateway(url='http://gateway.test/pay', retries=1, retry_backoff=0)
+                self.addCleanup(gateway.close)
+                gateway._client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: response))
+                with self.assertRaisesMessage(PaymentGatewayUnavailable, 'failed after 2 attempts'):
+                    asyncio.run(gateway.charge(100, 'key'))
+
+    def test_charge_retries_transient_failures_then_gives_up(self):
+        gateway = self.make_gateway(retries=2, retry_backoff=0, failure_rate=1)
+        with patch.object(gateway, 'request_payment', wraps=gateway.request_payment) as request_payment:
+            with self.assertRaises(PaymentGatewayUnavailable):
+                asyncio.run(gateway.charge(100, 'key'))
+        self.assertEqual(request_payment.call_count, 3)
+        self.assertEqual({call.args[1] for call in request_payment.call_args_list}, {'key'})
+
+    def test_charge_times_out_slow_payments(self):
+        gateway = self.make_gateway(timeout=0.01, retries=0, latency=1)
+        with self.assertRaises(PaymentGatewayUnavailable):
+            asyncio.run(gateway.charge(100, 'key'))
+
+    def test_charge_bounds_concurrent_payments(self):
+        gateway = self.make_gateway(max_concurrency=2)
+        in_flight = []
+        peak = []
+
+        async def request_payment(price, idempotency_key):
+            in_flight.append(price)
+            peak.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(price)
+            return price
+
+        async def charge_many():
+            return await asyncio.gather(*[gateway.charge(price, str(price)) for price in range(10)])
+
+        with patch.object(gateway, 'request_payment', request_payment):
+            self.assertEqual(asyncio.run(charge_many()), list(range(10)))
+            # Under WSGI every request awaits the gateway from an event loop of its own
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                charges = executor.map(lambda price: asyncio.run(gateway.charge(price, str(price))), range(10))
+                self.assertEqual(list(charges), list(range(10)))
+        self.assertEqual(max(peak), 2)
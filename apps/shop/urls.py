@@ -3,9 +3,14 @@ from apps.shop.views import *
 
 urlpatterns = [
     path('products/', GetProducts.as_view(), name='search products'),
+    path('products/suggest/', SuggestProducts.as_view(), name='suggest products'),
+    path('products/changes/', GetProductChanges.as_view(), name='product changes'),
+    path('products/export/', ExportProducts.as_view(), name='export products'),
     path('categories/', GetCategories.as_view(), name='search categories'),
     path('products/create/', AdminCreateProducts.as_view(), name='admin create products'),
     path('products/update/', AdminUpdateProducts.as_view(), name='admin update products'),
+    path('products/bulk-update/', AdminBulkUpdateProducts.as_view(), name='admin bulk update products'),
+    path('products/import/', AdminImportProducts.as_view(), name='admin import products'),
     path('categories/create/', AdminCreateCategory.as_view(), name='admin create categories'),
     path('categories/update/', AdminUpdateCategory.as_view(), name='admin update categories'),
     path('cart/add-items/', UserAddItemsToCart.as_view(), name='user add items to cart'),
@@ -14,6 +19,7 @@ urlpatterns = [
     path('user/get-active-carts/', GetUserActiveCarts.as_view(), name='user get carts'),
     path('product/comment/', UserCommentProducts.as_view(), name='user comment product'),
     path('product/rate', UserRateProducts.as_view(), name='user rate product'),
+    path('product/rate/delete', UserDeleteProductRate.as_view(), name='user delete product rate'),
     path('user/address/create', UserAddAddress.as_view(), name='user create address'),
     path('user/address/update', UserUpdateAddress.as_view(), name='user update address'),
     path('user/address/delete', UserDeleteAddress.as_view(), name='user delete address'),
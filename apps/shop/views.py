@@ -1,13 +1,19 @@
+from django.http import StreamingHttpResponse
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
 
-from .models import (Product, ProductCategory, Address, City, Cart)
+from .models import (Product, ProductCategory, Address, City, Cart, UserRateProduct)
 
 from .selectors import (search_products, search_categories, update_product, create_product, update_category,
-                        create_category, process_add_items_to_cart, get_user_purchase_receipts, get_user_open_carts)
+                        create_category, process_add_items_to_cart, get_user_purchase_receipts, get_user_open_carts,
+                        get_product_facets,
+                        bulk_update_products, reprice_products, get_products_export_rows,
+                        PRODUCT_EXPORT_FIELDS, get_product_changes, get_user_addresses_validators,
+                        get_user_carts_validators)
 
 from .serializers import (OutGetProducts, InGetProducts, InGetCategories, OutGetCategories, InAdminUpdateProducts,
                           OutAdminCreateProducts, InAdminCreateProducts, OutAdminUpdateProducts, InAdminUpdateCategory,
@@ -15,70 +21,165 @@ from .serializers import (OutGetProducts, InGetProducts, InGetCategories, OutGet
                           InGetUserCarts, OutGetUserCarts, OutPurchaseReceiptSerializer, InUserCommentProducts,
                           OutUserCommentProducts, InUserRateProduct, InUserAddAddress, InUserUpdateAddress,
                           InUserDeleteAddress, OutUserGetAddress, InUserDeleteCart, UserPurchaseCartInputSerializer,
-                          UserPurchaseCartOutputSerializer)
+                          UserPurchaseCartOutputSerializer, InUserDeleteProductRate, InSuggestProducts,
+                          InAdminImportProducts, InAdminBulkUpdateProducts, InExportProducts)
 
 from .services import (create_user_comment, create_or_update_user_product_rate, create_user_address,
-                       update_user_address, inactive_user_address, delete_user_cart, user_purchase_order)
+                       update_user_address, inactive_user_address, delete_user_cart, user_purchase_order,
+                       remove_user_product_rate, CATALOG_CACHE_NAMESPACE)
 
-from ..utils.exceptions import TooManyItemsException, EmptyCartException, UserCartAddressCityDoesNotMatch
+from .suggest import suggester
 
-from ..utils.paginations import DefaultPagination
+from .product_import import import_products
 
+from ..utils.exceptions import (TooManyItemsException, EmptyCartException, UserCartAddressCityDoesNotMatch,
+                                CartNotOpenException, PaymentGatewayException)
 
-class GetProducts(APIView):
+from ..utils.paginations import CatalogPagination, KeysetPagination, WatermarkPagination
+
+from ..utils.profiling import serializer_timing
+
+from ..utils.idempotency import IdempotencyMixin
+
+from ..utils.streaming import csv_stream, ndjson_stream
+
+from ..utils.views import AsyncAPIView, ConditionalGetMixin, VersionedCacheMixin, make_etag
+
+
+class GetProducts(ConditionalGetMixin, VersionedCacheMixin, APIView):
     permission_classes = []
     throttle_classes = [AnonRateThrottle, UserRateThrottle]
-    pagination_class = DefaultPagination
+    pagination_class = CatalogPagination
+    cache_namespace = CATALOG_CACHE_NAMESPACE
+    cache_query_params = CatalogPagination.query_params
 
     def get(self, request):
         input_serializer = InGetProducts(data=request.query_params)
         input_serializer.is_valid(raise_exception=True)
 
-        queryset = search_products(input_serializer.validated_data)
+        def get_page():
+            queryset = search_products(input_serializer.validated_data)
+
+            paginator = self.pagination_class()
+            paginated_queryset = paginator.paginate_queryset(queryset, request)
+
+            serializer = OutGetProducts(paginated_queryset, many=True)
+            with serializer_timing():
+                results = serializer.data
+
+            data = paginator.get_paginated_response(results).data
+            facets = input_serializer.validated_data.get('facets')
+            if facets:
+                data['facets'] = get_product_facets(input_serializer.validated_data, facets)
+            return {'etag': make_etag(data), 'data': data}
+
+        # The ETag is taken from the page itself and cached with it, instead of a query over the whole filter
+        page = self.get_cached_data(request, input_serializer.validated_data, get_page, 'page')
+        not_modified = self.check_validators(request, page['etag'])
+        if not_modified is not None:
+            return not_modified
+        return Response(page['data'])
+
+
+class SuggestProducts(APIView):
+    permission_classes = []
+    throttle_classes = [AnonRateThrottle, UserRateThrottle]
+
+    def get(self, request):
+        input_serializer = InSuggestProducts(data=request.query_params)
+        input_serializer.is_valid(raise_exception=True)
+        return Response(suggester.suggest(input_serializer.validated_data['q'],
+                                          input_serializer.validated_data['limit']))
+
+
+class GetProductChanges(APIView):
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [UserRateThrottle]
+    pagination_class = WatermarkPagination
 
+    def get(self, request):
         paginator = self.pagination_class()
-        paginated_queryset = paginator.paginate_queryset(queryset, request)
+        products = paginator.paginate_queryset(get_product_changes(), request)
+        return paginator.get_paginated_response(OutGetProducts(products, many=True).data)
+
+
+class ExportProducts(APIView):
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [UserRateThrottle]
 
-        serializer = OutGetProducts(paginated_queryset, many=True)
+    def get(self, request):
+        input_serializer = InExportProducts(data=request.query_params)
+        input_serializer.is_valid(raise_exception=True)
 
-        return paginator.get_paginated_response(serializer.data)
+        rows = get_products_export_rows()
+        if input_serializer.validated_data['export_format'] == 'csv':
+            response = StreamingHttpResponse(csv_stream(rows, PRODUCT_EXPORT_FIELDS), content_type='text/csv')
+            response['Content-Disposition'] = 'attachment; filename="products.csv"'
+        else:
+            response = StreamingHttpResponse(ndjson_stream(rows), content_type='application/x-ndjson')
+            response['Content-Disposition'] = 'attachment; filename="products.ndjson"'
+        return response
 
 
-class GetCategories(APIView):
+class GetCategories(ConditionalGetMixin, VersionedCacheMixin, APIView):
     permission_classes = []
     throttle_classes = [AnonRateThrottle, UserRateThrottle]
-    pagination_class = DefaultPagination
+    pagination_class = CatalogPagination
+    cache_namespace = CATALOG_CACHE_NAMESPACE
+    cache_query_params = CatalogPagination.query_params
 
     def get(self, request):
         input_serializer = InGetCategories(data=request.query_params)
         input_serializer.is_valid(raise_exception=True)
 
-        queryset = search_categories(input_serializer.validated_data)
+        def get_page():
+            queryset = search_categories(input_serializer.validated_data)
 
-        paginator = self.pagination_class()
-        paginated_queryset = paginator.paginate_queryset(queryset, request)
+            paginator = self.pagination_class()
+            paginated_queryset = paginator.paginate_queryset(queryset, request)
+
+            serializer = OutGetCategories(paginated_queryset, many=True)
+            with serializer_timing():
+                results = serializer.data
 
-        serializer = OutGetCategories(paginated_queryset, many=True)
+            data = paginator.get_paginated_response(results).data
+            return {'etag': make_etag(data), 'data': data}
 
-        return paginator.get_paginated_response(serializer.data)
+        page = self.get_cached_data(request, input_serializer.validated_data, get_page, 'page')
+        not_modified = self.check_validators(request, page['etag'])
+        if not_modified is not None:
+            return not_modified
+        return Response(page['data'])
 
 
 class GetUserPurchaseReceipts(APIView):
     permission_classes = [IsAuthenticated]
     serializer_class = OutPurchaseReceiptSerializer
+    pagination_class = KeysetPagination
 
     def get(self, request):
         receipts = get_user_purchase_receipts(request.user)
-        output_serializer = self.serializer_class(receipts, many=True)
-        return Response(output_serializer.data)
 
+        paginator = self.pagination_class()
+        paginated_receipts = paginator.paginate_queryset(receipts, request)
+
+        output_serializer = self.serializer_class(paginated_receipts, many=True)
+        with serializer_timing():
+            results = output_serializer.data
+        return paginator.get_paginated_response(results)
 
-class GetUserActiveCarts(APIView):
+
+class GetUserActiveCarts(ConditionalGetMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
         serializer = InGetUserCarts(data=request.query_params)
         serializer.is_valid(raise_exception=True)
+
+        not_modified = self.check_validators(request, make_etag(get_user_carts_validators(request.user)))
+        if not_modified is not None:
+            return not_modified
+
         carts = get_user_open_carts(request.user, **serializer.validated_data)
         return Response(OutGetUserCarts(carts, many=True).data)
 
@@ -115,6 +216,33 @@ class AdminUpdateProducts(APIView):
             return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
 
 
+class AdminBulkUpdateProducts(APIView):
+    permission_classes = [IsAdminUser]
+    throttle_classes = [UserRateThrottle]
+
+    def post(self, request):
+        serializer = InAdminBulkUpdateProducts(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if 'patches' in serializer.validated_data:
+            updated, not_found = bulk_update_products(serializer.validated_data['patches'])
+            return Response({'updated': updated, 'not_found': not_found}, status=status.HTTP_200_OK)
+
+        updated = reprice_products(serializer.validated_data['filter'], **serializer.validated_data['price'])
+        return Response({'updated': updated}, status=status.HTTP_200_OK)
+
+
+class AdminImportProducts(APIView):
+    permission_classes = [IsAdminUser]
+    throttle_classes = [UserRateThrottle]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request):
+        serializer = InAdminImportProducts(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        report = import_products(serializer.validated_data['file'], serializer.validated_data['file_format'])
+        return Response(report, status=status.HTTP_200_OK)
+
+
 class AdminCreateCategory(APIView):
     permission_classes = [IsAdminUser]
     throttle_classes = [UserRateThrottle]
@@ -179,6 +307,23 @@ class UserRateProducts(APIView):
         return Response(status=status.HTTP_201_CREATED)
 
 
+class UserDeleteProductRate(APIView):
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [UserRateThrottle]
+
+    def post(self, request):
+        input_serializer = InUserDeleteProductRate(data=request.data)
+        input_serializer.is_valid(raise_exception=True)
+        try:
+            remove_user_product_rate(user=request.user, product_id=input_serializer.validated_data['product_id'])
+        except Product.DoesNotExist:
+            return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
+        except UserRateProduct.DoesNotExist:
+            return Response({"error": "Rate not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response(data={"product_id": input_serializer.validated_data['product_id']}, status=status.HTTP_200_OK)
+
+
 class UserAddAddress(APIView):
     permission_classes = [IsAuthenticated]
     throttle_classes = [UserRateThrottle]
@@ -219,12 +364,16 @@ class UserUpdateAddress(APIView):
         return self.post(request)
 
 
-class UserGetAddress(APIView):
+class UserGetAddress(ConditionalGetMixin, APIView):
     permission_classes = [IsAuthenticated]
     throttle_classes = [UserRateThrottle]
     output_serializer = OutUserGetAddress
 
     def get(self, request):
+        not_modified = self.check_validators(request, make_etag(get_user_addresses_validators(request.user)))
+        if not_modified is not None:
+            return not_modified
+
         user_addresses = Address.active.filter(user=request.user)
         output_data = self.output_serializer(user_addresses, many=True)
         return Response(output_data.data, status=status.HTTP_200_OK)
@@ -248,7 +397,7 @@ class UserDeleteAddress(APIView):
         return Response(data={"id": input_serializer.validated_data['address_id']}, status=status.HTTP_200_OK)
 
 
-class UserAddItemsToCart(APIView):
+class UserAddItemsToCart(IdempotencyMixin, APIView):
     permission_classes = [IsAuthenticated]
     throttle_classes = [UserRateThrottle]
 
@@ -284,29 +433,36 @@ class UserDeleteCart(APIView):
         return Response(data={"id": input_serializer.validated_data['cart_id']}, status=status.HTTP_200_OK)
 
 
-class UserPurchaseCart(APIView):
+class UserPurchaseCart(IdempotencyMixin, AsyncAPIView):
     permission_classes = [IsAuthenticated]
     throttle_classes = [UserRateThrottle]
 
-    def post(self, request):
+    async def post(self, request):
         input_serializer = UserPurchaseCartInputSerializer(data=request.data, context={'request': request})
         input_serializer.is_valid(raise_exception=True)
 
         try:
-            cart, price, tracking_code = user_purchase_order(user=request.user,
-                                                             cart_id=input_serializer.validated_data['cart_id'],
-                                                             address_id=input_serializer.validated_data['address_id'])
+            cart, receipt, price, tracking_code = await user_purchase_order(
+                user=request.user,
+                cart_id=input_serializer.validated_data['cart_id'],
+                address_id=input_serializer.validated_data['address_id'])
         except Cart.DoesNotExist:
             return Response(data={"error": "Cart not found"}, status=status.HTTP_404_NOT_FOUND)
         except Address.DoesNotExist:
             return Response(data={"error": "Address not found"}, status=status.HTTP_404_NOT_FOUND)
         except EmptyCartException:
             return Response(data={"error": "Cart is empty"}, status=status.HTTP_400_BAD_REQUEST)
+        except CartNotOpenException:
+            return Response(data={"error": "Cart is not open"}, status=status.HTTP_400_BAD_REQUEST)
         except UserCartAddressCityDoesNotMatch as e:
             product_id = e.kwargs['product_id']
             return Response(data={"error": f"Product with id {product_id} address city mismatch"},
                             status=status.HTTP_400_BAD_REQUEST)
+        except PaymentGatewayException:
+            return Response(data={"error": "Payment failed"}, status=status.HTTP_502_BAD_GATEWAY)
 
         output_serializer = UserPurchaseCartOutputSerializer(cart)
-        extra_args = {'total_price': price, 'tracking_code': tracking_code}
-        return Response(output_serializer.data | extra_args, status=status.HTTP_200_OK)
+        with serializer_timing():
+            data = output_serializer.data
+        extra_args = {'total_price': price, 'tracking_code': tracking_code, 'receipt_id': receipt.id}
+        return Response(data | extra_args, status=status.HTTP_200_OK)
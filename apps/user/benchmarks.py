@@ -0,0 +1,15 @@
+from apps.user.services import send_otp
+from apps.utils.benchmark import Scenario
+
+
+def _pending_registration(context):
+    login = 'benchmark-new@example.com'
+    return {'login': login, 'otp': send_otp({'email': login, 'password': 'benchmark-password'})}
+
+
+SCENARIOS = [
+    Scenario('register', 'POST', 'register',
+             params=lambda c: {'email': 'benchmark-new@example.com', 'password': 'benchmark-password'}),
+    Scenario('verify otp', 'POST', 'verify-otp', params=_pending_registration),
+    Scenario('login', 'POST', 'login', params=lambda c: {'login': c['user_login'], 'password': c['password']}),
+]
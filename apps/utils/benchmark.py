@@ -0,0 +1,140 @@
+import contextlib
+import io
+import math
+import statistics
+import time
+import tracemalloc
+from importlib import import_module
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+
+class Scenario:
+    """
+    One request to benchmark. `params(context)` returns the query parameters (GET) or body (other methods)
+    and runs inside the same rolled-back transaction as the request, so it may create the rows the request
+    needs; it is not timed. `auth` names the context entry holding the Authorization header to send.
+    """
+
+    def __init__(self, name, method, url_name, *, params=None, auth=None, format='json'):
+        self.name = name
+        self.method = method
+        self.url_name = url_name
+        self.params = params
+        self.auth = auth
+        self.format = format
+
+    def request(self, client, context):
+        data = self.params(context) if self.params else {}
+        headers = {'HTTP_AUTHORIZATION': context[self.auth]} if self.auth else {}
+        url = reverse(self.url_name)
+        if self.method == 'GET':
+            return lambda: client.get(url, data, **headers)
+        return lambda: getattr(client, self.method.lower())(url, data, format=self.format, **headers)
+
+
+class RowCounter:
+    """Execute wrapper adding up the rows the driver reports for each SELECT; None once a driver does not."""
+
+    def __init__(self):
+        self.rows = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        if self.rows is not None and sql.lstrip()[:6].upper() == 'SELECT':
+            rowcount = context['cursor'].rowcount
+            self.rows = self.rows + rowcount if rowcount >= 0 else None
+        return result
+
+
+def uncovered_routes(scenarios, *urlconfs):
+    """Names of the routes in the `urlconfs` modules that no scenario requests."""
+    names = {pattern.name for urlconf in urlconfs for pattern in import_module(urlconf).urlpatterns if pattern.name}
+    return sorted(names - {scenario.url_name for scenario in scenarios})
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def _consume(response):
+    # Streaming bodies are produced while they are read, so reading them is part of the request
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    return response
+
+
+def run_scenario(client, scenario, context, *, iterations=30, warmup=3, using=DEFAULT_DB_ALIAS):
+    """
+    Send the scenario's request `warmup + iterations` times, each in a transaction that is rolled back so
+    every run sees the same data, then once more under tracemalloc for the allocation peak. Returns the
+    latency percentiles in milliseconds, the median queries and rows per request and the status codes.
+    """
+    connection = connections[using]
+    timings, queries, rows, statuses = [], [], [], set()
+
+    def run(measure_memory=False):
+        # The local payment gateway and the OTP senders print; keep that out of the report
+        with transaction.atomic(using=using), contextlib.redirect_stdout(io.StringIO()):
+            send = scenario.request(client, context)
+            counter = RowCounter()
+            with CaptureQueriesContext(connection) as captured, connection.execute_wrapper(counter):
+                if measure_memory:
+                    tracemalloc.start()
+                started = time.perf_counter()
+                response = _consume(send())
+                elapsed = time.perf_counter() - started
+                peak = tracemalloc.get_traced_memory()[1] if measure_memory else None
+                if measure_memory:
+                    tracemalloc.stop()
+            transaction.set_rollback(True, using=using)
+        return response.status_code, elapsed, len(captured.captured_queries), counter.rows, peak
+
+    for iteration in range(warmup + iterations):
+        status_code, elapsed, query_count, row_count, _ = run()
+        if iteration < warmup:
+            continue
+        statuses.add(status_code)
+        timings.append(elapsed * 1000)
+        queries.append(query_count)
+        rows.append(row_count)
+    peak = run(measure_memory=True)[4]
+
+    return {
+        'method': scenario.method,
+        'url': reverse(scenario.url_name),
+        'statuses': sorted(statuses),
+        'iterations': iterations,
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'queries': statistics.median_low(queries),
+        'rows': None if None in rows else statistics.median_low(rows),
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+
+def compare_results(baseline, current, *, threshold=0.25, min_delta_ms=1.0):
+    """
+    Regressions of `current` against `baseline` (both `{name: result}`): a p95 latency more than
+    `threshold` (and `min_delta_ms`) above the baseline, more queries per request, or a new status code.
+    """
+    regressions = []
+    for name, result in current.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if (result['p95_ms'] > before['p95_ms'] * (1 + threshold)
+                and result['p95_ms'] - before['p95_ms'] >= min_delta_ms):
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {result['p95_ms']}ms")
+        if result['queries'] > before['queries']:
+            regressions.append(f"{name}: {before['queries']} -> {result['queries']} queries per request")
+        if result['statuses'] != before['statuses']:
+            regressions.append(f"{name}: status {before['statuses']} -> {result['statuses']}")
+    return regressions
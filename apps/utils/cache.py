@@ -0,0 +1,77 @@
+import hashlib
+import json
+import time
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+
+def _version_key(namespace):
+    return f'version:{namespace}'
+
+
+def get_version(namespace):
+    version = cache.get(_version_key(namespace))
+    if version is None:
+        # Start from the clock, so a version lost to eviction never points back at old entries
+        cache.add(_version_key(namespace), time.time_ns(), timeout=None)
+        version = cache.get(_version_key(namespace))
+    return version
+
+
+def bump_version(namespace):
+    try:
+        return cache.incr(_version_key(namespace))
+    except ValueError:
+        cache.add(_version_key(namespace), time.time_ns(), timeout=None)
+        return cache.get(_version_key(namespace))
+
+
+def bump_version_on_commit(namespace):
+    # Bumped again on commit, so anything read from the old rows before the commit is dropped too
+    bump_version(namespace)
+    transaction.on_commit(lambda: bump_version(namespace))
+
+
+def versioned_key(namespace, *parts):
+    """Cache key for `parts` under the current version of `namespace`; bumping the version drops them all."""
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+    return f'{namespace}:{get_version(namespace)}:{digest}'
+
+
+def read_through(key, compute, timeout, *, lock_timeout=30, wait=5, poll_interval=0.05):
+    """
+    Return the cached value of `key`, computing and storing it on a miss. Entries outlive `timeout` by
+    the same amount again: once stale, one caller (holding a cache lock) recomputes while the others keep
+    getting the stale value. On a cold miss the others wait for that caller instead of all recomputing.
+    """
+    lock_key = f'{key}:lock'
+    entry = cache.get(key)
+    if entry is not None:
+        value, fresh_until = entry
+        if time.time() < fresh_until or not cache.add(lock_key, 1, lock_timeout):
+            return value
+        return _refresh(key, lock_key, compute, timeout)
+
+    if cache.add(lock_key, 1, lock_timeout):
+        return _refresh(key, lock_key, compute, timeout)
+
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        time.sleep(poll_interval)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
+        if cache.get(lock_key) is None:
+            break
+    return compute()
+
+
+def _refresh(key, lock_key, compute, timeout):
+    try:
+        value = compute()
+        cache.set(key, (value, time.time() + timeout), timeout * 2)
+        return value
+    finally:
+        cache.delete(lock_key)
@@ -0,0 +1,49 @@
+import json
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+def is_postgresql(using=DEFAULT_DB_ALIAS):
+    return connections[using].vendor == 'postgresql'
+
+
+def postgresql_only(sql, reverse_sql=None):
+    """
+    Build a RunPython pair that only executes raw SQL on PostgreSQL, so migrations using
+    postgres-specific features (GIN indexes, extensions) still apply cleanly on SQLite.
+    """
+
+    def forwards(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute(sql)
+
+    def backwards(apps, schema_editor):
+        if reverse_sql and schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute(reverse_sql)
+
+    return forwards, backwards
+
+
+def estimate_count(queryset):
+    """
+    Cheap row count for pagination: the planner's estimate on PostgreSQL (`pg_class.reltuples` for
+    unfiltered tables, the EXPLAIN row estimate otherwise) and an exact COUNT on other databases.
+    """
+    if not is_postgresql(queryset.db):
+        return queryset.count()
+
+    queryset = queryset.order_by()
+    with connections[queryset.db].cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+            if row and row[0] >= 0:
+                return row[0]
+
+        sql, params = queryset.query.sql_with_params()
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
@@ -10,3 +10,15 @@ class UserCartAddressCityDoesNotMatch(Exception):
     def __init__(self,  message='', **kwargs):
         super().__init__(message)
         self.kwargs = kwargs
+
+
+class CartNotOpenException(Exception):
+    pass
+
+
+class PaymentGatewayException(Exception):
+    pass
+
+
+class PaymentGatewayUnavailable(PaymentGatewayException):
+    pass
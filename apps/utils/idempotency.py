@@ -0,0 +1,117 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+
+class IdempotencyKeyInProgress(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'A request with this Idempotency-Key is still in progress.'
+    default_code = 'idempotency_key_in_progress'
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = 'This Idempotency-Key was already used with a different request body.'
+    default_code = 'idempotency_key_reused'
+
+
+class IdempotentReplay(Exception):
+    def __init__(self, response):
+        super().__init__()
+        self.response = response
+
+
+class IdempotencyMixin:
+    """
+    Honour an `Idempotency-Key` header on POST. The first response for a key (per user and path) is
+    stored in the cache for IDEMPOTENCY_KEY_TTL seconds and replayed for every duplicate without running
+    the view again. A duplicate that arrives while the first request is still running waits for its
+    response behind a cache lock, and gets a 409 if it does not arrive in time.
+    """
+    idempotency_header = 'HTTP_IDEMPOTENCY_KEY'
+    idempotency_lock_timeout = 60
+    idempotency_wait = 10
+    idempotency_poll_interval = 0.05
+
+    @staticmethod
+    def get_idempotency_cache_key(request, key):
+        user_id = request.user.pk if request.user and request.user.is_authenticated else 'anonymous'
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return f"idempotency:{user_id}:{request.path}:{digest}"
+
+    @staticmethod
+    def get_request_fingerprint(request):
+        body = json.dumps(request.data, sort_keys=True, default=str)
+        return hashlib.sha256(body.encode()).hexdigest()
+
+    def initial(self, request, *args, **kwargs):
+        self._idempotency_pending = None
+        super().initial(request, *args, **kwargs)
+
+        key = request.META.get(self.idempotency_header)
+        if request.method != 'POST' or not key:
+            return
+
+        cache_key = self.get_idempotency_cache_key(request, key)
+        fingerprint = self.get_request_fingerprint(request)
+        stored = cache.get(cache_key)
+        if stored is None:
+            if cache.add(f'{cache_key}:lock', fingerprint, self.idempotency_lock_timeout):
+                # The first request may have stored its response and released the lock since the lookup
+                stored = cache.get(cache_key)
+                if stored is None:
+                    self._idempotency_pending = (cache_key, fingerprint)
+                    return
+                cache.delete(f'{cache_key}:lock')
+            else:
+                stored = self.wait_for_stored_response(cache_key)
+
+        if stored['fingerprint'] != fingerprint:
+            raise IdempotencyKeyReused()
+        raise IdempotentReplay(Response(stored['data'], status=stored['status'],
+                                        headers={'Idempotent-Replayed': 'true'}))
+
+    def wait_for_stored_response(self, cache_key):
+        deadline = time.monotonic() + self.idempotency_wait
+        while time.monotonic() < deadline:
+            time.sleep(self.idempotency_poll_interval)
+            stored = cache.get(cache_key)
+            if stored is not None:
+                return stored
+            if cache.get(f'{cache_key}:lock') is None:
+                # The first request finished without a storable response, so let the client retry
+                break
+        raise IdempotencyKeyInProgress()
+
+    def handle_exception(self, exc):
+        if isinstance(exc, IdempotentReplay):
+            return exc.response
+        try:
+            return super().handle_exception(exc)
+        except Exception:
+            # Unhandled errors skip finalize_response; without this, retries would get a 409 until the lock expires
+            self.settle_idempotency_key()
+            raise
+
+    def settle_idempotency_key(self, response=None):
+        pending = getattr(self, '_idempotency_pending', None)
+        if pending is None:
+            return
+        cache_key, fingerprint = pending
+        self._idempotency_pending = None
+        # Server errors are not stored, so the client can retry them with the same key
+        if isinstance(response, Response) and response.status_code < 500:
+            cache.set(cache_key, {'fingerprint': fingerprint, 'status': response.status_code,
+                                  'data': response.data}, settings.IDEMPOTENCY_KEY_TTL)
+        cache.delete(f'{cache_key}:lock')
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        self.settle_idempotency_key(response)
+        return response
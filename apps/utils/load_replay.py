@@ -0,0 +1,239 @@
+import asyncio
+import itertools
+import json
+import math
+import random
+import re
+import time
+import uuid
+from collections import Counter
+
+import httpx
+
+from apps.utils.benchmark import percentile
+
+VARIABLE_RE = re.compile(r'{{\s*([\w.-]+)\s*}}')
+# Upper bounds of the latency histogram buckets in milliseconds; the last bucket is open ended
+HISTOGRAM_BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class ReplayError(Exception):
+    pass
+
+
+def load_collection(path):
+    """
+    Map every request name of a Postman v2.1 collection, folders flattened, to its method, URL, headers and
+    raw JSON body. Also returns the collection variables.
+    """
+    with open(path) as file:
+        collection = json.load(file)
+
+    requests = {}
+
+    def walk(items):
+        for item in items:
+            if 'item' in item:
+                walk(item['item'])
+                continue
+            request = item['request']
+            url = request['url'] if isinstance(request['url'], str) else request['url']['raw']
+            headers = {header['key']: header['value'] for header in request.get('header', ())
+                       if not header.get('disabled')}
+            body = request.get('body') or {}
+            try:
+                payload = json.loads(body['raw']) if body.get('mode') == 'raw' and body.get('raw') else None
+            except ValueError:
+                payload = None
+            requests[item['name']] = {'method': request['method'], 'url': url, 'headers': headers, 'json': payload}
+
+    walk(collection.get('item', ()))
+    defaults = {variable['key']: variable['value'] for variable in collection.get('variable', ())}
+    return requests, defaults
+
+
+def render(value, variables):
+    """Fill `{{name}}` placeholders in strings, lists and dicts. A string that is one placeholder keeps its type."""
+    if isinstance(value, str):
+        match = VARIABLE_RE.fullmatch(value.strip())
+        if match:
+            return _lookup(variables, match.group(1))
+        return VARIABLE_RE.sub(lambda match: str(_lookup(variables, match.group(1))), value)
+    if isinstance(value, list):
+        return [render(item, variables) for item in value]
+    if isinstance(value, dict):
+        return {key: render(item, variables) for key, item in value.items()}
+    return value
+
+
+def _lookup(variables, name):
+    try:
+        return variables[name]
+    except KeyError:
+        raise ReplayError(f'Undefined variable {name}') from None
+
+
+def extract(data, path):
+    """Follow a dotted path such as `results.0.id` into decoded JSON."""
+    for part in path.split('.'):
+        try:
+            data = data[int(part)] if isinstance(data, list) else data[part]
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise ReplayError(f'Nothing at {path} in the response') from None
+    return data
+
+
+class StepStats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = Counter()
+
+    def record(self, elapsed, status=None, error=None):
+        self.latencies.append(elapsed * 1000)
+        if status is not None:
+            self.statuses[status] += 1
+        if error is not None:
+            self.errors[error] += 1
+
+    def summary(self):
+        requests = len(self.latencies)
+        histogram = Counter()
+        for latency in self.latencies:
+            bucket = next((f'<={bound}ms' for bound in HISTOGRAM_BOUNDS_MS if latency <= bound),
+                          f'>{HISTOGRAM_BOUNDS_MS[-1]}ms')
+            histogram[bucket] += 1
+        return {
+            'requests': requests,
+            'errors': sum(self.errors.values()),
+            'error_rate': round(sum(self.errors.values()) / requests, 4) if requests else 0,
+            'p50_ms': round(percentile(self.latencies, 50), 2) if requests else None,
+            'p95_ms': round(percentile(self.latencies, 95), 2) if requests else None,
+            'p99_ms': round(percentile(self.latencies, 99), 2) if requests else None,
+            'histogram': {bucket: histogram[bucket] for bucket in
+                          [f'<={bound}ms' for bound in HISTOGRAM_BOUNDS_MS] + [f'>{HISTOGRAM_BOUNDS_MS[-1]}ms']
+                          if histogram[bucket]},
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+            'error_kinds': dict(self.errors),
+        }
+
+
+class LoadReplay:
+    """
+    Open-model load from the Postman collection: virtual users arrive at `rate` per second, reached
+    linearly over `ramp` seconds and held for `duration` more, and each walks one journey of the config,
+    picked by weight. Steps name collection requests and add `params`, `json`, `extract` (variables taken
+    from the JSON response) and `cache` (variables read from the Django cache, for values such as OTPs
+    the API only sends out of band). At most `max_users` journeys run at once; arrivals beyond that wait.
+    """
+
+    def __init__(self, requests, config, *, defaults=None, rate=5.0, ramp=10.0, duration=60.0, max_users=100,
+                 timeout=10.0, seed=None, base_url=None, cache=None, transport=None):
+        self.requests = requests
+        self.journeys = config['journeys']
+        self.variables = {**(defaults or {}), **config.get('variables', {})}
+        if base_url:
+            self.variables['base_url'] = base_url
+        self.rate = rate
+        self.ramp = ramp
+        self.duration = duration
+        self.max_users = max_users
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.cache = cache
+        self.transport = transport
+        self.run_id = uuid.uuid4().hex[:8]
+        self.steps = {}
+        self.journey_counts = {journey['name']: Counter() for journey in self.journeys}
+        for journey in self.journeys:
+            for step in journey['steps']:
+                if step['request'] not in requests:
+                    raise ReplayError(f"Journey {journey['name']} uses unknown request {step['request']}")
+
+    def arrivals(self):
+        """Offsets in seconds at which virtual users start, evenly spaced along the ramp and then the plateau."""
+        ramp_users = self.rate * self.ramp / 2
+        for number in itertools.count(1):
+            # Inverse of the number of arrivals by time t: rate * t**2 / (2 * ramp) on the ramp, linear after it
+            if number <= ramp_users:
+                offset = math.sqrt(2 * self.ramp * number / self.rate)
+            else:
+                offset = self.ramp + (number - ramp_users) / self.rate
+            if offset >= self.ramp + self.duration:
+                return
+            yield offset
+
+    async def run(self):
+        limits = httpx.Limits(max_connections=self.max_users, max_keepalive_connections=self.max_users)
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits, transport=self.transport) as client:
+            semaphore = asyncio.Semaphore(self.max_users)
+            started = time.monotonic()
+            tasks = []
+            for number, offset in enumerate(self.arrivals()):
+                await asyncio.sleep(max(0.0, started + offset - time.monotonic()))
+                journey = self.rng.choices(self.journeys, [journey.get('weight', 1) for journey in self.journeys])[0]
+                tasks.append(asyncio.create_task(self.run_journey(client, semaphore, journey, number)))
+            await asyncio.gather(*tasks)
+            elapsed = time.monotonic() - started
+
+        return {
+            'meta': {'run': self.run_id, 'rate': self.rate, 'ramp': self.ramp, 'duration': self.duration,
+                     'max_users': self.max_users, 'elapsed_s': round(elapsed, 2)},
+            'journeys': {name: dict(counts) for name, counts in self.journey_counts.items()},
+            'steps': {name: stats.summary() for name, stats in self.steps.items()},
+        }
+
+    async def run_journey(self, client, semaphore, journey, number):
+        async with semaphore:
+            counts = self.journey_counts[journey['name']]
+            counts['started'] += 1
+            variables = {**self.variables, 'run': self.run_id, 'vu': number}
+            try:
+                # Config variables may refer to the built-in ones, e.g. "load-{{run}}-{{vu}}@example.com"
+                variables.update(render(self.variables, variables))
+            except ReplayError:
+                counts['failed'] += 1
+                return
+            for step in journey['steps']:
+                if not await self.run_step(client, journey, step, variables):
+                    counts['failed'] += 1
+                    return
+                if step.get('think'):
+                    await asyncio.sleep(self.rng.uniform(0, 2 * step['think']))
+            counts['completed'] += 1
+
+    async def run_step(self, client, journey, step, variables):
+        name = f"{journey['name']}: {step.get('name', step['request'])}"
+        stats = self.steps.setdefault(name, StepStats())
+        request = self.requests[step['request']]
+        started = time.perf_counter()
+        try:
+            response = await client.request(
+                request['method'], render(request['url'], variables), headers=render(request['headers'], variables),
+                params=render(step.get('params'), variables),
+                json=render(step.get('json', request['json']), variables))
+        except ReplayError as exc:
+            stats.record(time.perf_counter() - started, error=str(exc))
+            return False
+        except httpx.HTTPError as exc:
+            stats.record(time.perf_counter() - started, error=type(exc).__name__)
+            return False
+        elapsed = time.perf_counter() - started
+
+        if response.status_code >= 400:
+            stats.record(elapsed, response.status_code, error=f'HTTP {response.status_code}')
+            return False
+        try:
+            if step.get('extract'):
+                data = response.json()
+                variables.update({variable: extract(data, path) for variable, path in step['extract'].items()})
+            for variable, key in step.get('cache', {}).items():
+                value = await asyncio.to_thread(self.cache.get, render(key, variables)) if self.cache else None
+                if value is None:
+                    raise ReplayError(f'Nothing cached under {variable}')
+                variables[variable] = value
+        except (ReplayError, ValueError) as exc:
+            stats.record(elapsed, response.status_code, error=str(exc))
+            return False
+        stats.record(elapsed, response.status_code)
+        return True
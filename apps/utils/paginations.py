@@ -1,7 +1,267 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import binascii
+import datetime
+import json
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, OrderBy, Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from apps.utils.db import estimate_count
+
+COUNT_EXACT = 'exact'
+COUNT_ESTIMATE = 'estimate'
+COUNT_NONE = 'none'
+
+
+class CursorJSONEncoder(DjangoJSONEncoder):
+    """DjangoJSONEncoder keeping full microseconds, so a datetime cursor never lands before its own row."""
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        return estimate_count(self.object_list)
 
 
 class DefaultPagination(PageNumberPagination):
     page_size = 20
     page_size_query_param = 'page_size'
     max_page_size = 100
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get(self.count_query_param) == COUNT_ESTIMATE:
+            self.django_paginator_class = EstimatedCountPaginator
+        return super().paginate_queryset(queryset, request, view)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Forward-only keyset pagination over the queryset's own ordering, with the primary key appended as a
+    tiebreaker. The opaque cursor holds the sort key of the last row, so every page is a bounded index
+    range scan instead of an OFFSET. The total count is skipped unless `?count=exact|estimate` is given.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    default_count_mode = COUNT_NONE
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(queryset)
+        queryset = queryset.order_by(*[self.get_order_expression(*key) for key in self.ordering])
+
+        self.count = self.get_count(queryset, request)
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.get_position_filter(position))
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        payload = {}
+        if self.count is not None:
+            payload['count'] = self.count
+        payload['next'] = self.get_next_link()
+        payload['results'] = data
+        return Response(payload)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_count(self, queryset, request):
+        mode = request.query_params.get(self.count_query_param, self.default_count_mode)
+        if mode == COUNT_EXACT:
+            return queryset.count()
+        if mode == COUNT_ESTIMATE:
+            return estimate_count(queryset)
+        return None
+
+    @staticmethod
+    def get_ordering(queryset):
+        """Return `(field, descending, nullable)` sort keys, always ending with the primary key."""
+        model = queryset.model
+        ordering = list(queryset.query.order_by or model._meta.ordering)
+        pk_name = model._meta.pk.name
+
+        keys = []
+        for item in ordering:
+            if isinstance(item, OrderBy) and isinstance(item.expression, F):
+                descending, name = item.descending, item.expression.name
+            elif isinstance(item, str):
+                descending, name = item.startswith('-'), item.lstrip('-')
+            else:
+                raise TypeError('Keyset pagination only supports field name orderings')
+            if name == 'pk':
+                name = pk_name
+
+            if name in queryset.query.annotations:
+                keys.append((name, descending, True))
+                continue
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                keys.append((name, descending, True))
+                continue
+            # Foreign keys are compared on their raw column so the cursor never needs a join
+            keys.append((field.attname, descending, field.null))
+
+        if not any(name == pk_name for name, _, _ in keys):
+            keys.append((pk_name, False, False))
+        return keys
+
+    @staticmethod
+    def get_order_expression(name, descending, nullable):
+        # Nulls always sort last so the cursor filter is the same on every database
+        if descending:
+            return F(name).desc(nulls_last=True) if nullable else F(name).desc()
+        return F(name).asc(nulls_last=True) if nullable else F(name).asc()
+
+    def get_position_filter(self, position):
+        conditions = []
+        equal = Q()
+        for (name, descending, nullable), value in zip(self.ordering, position):
+            if value is not None:
+                after = Q(**{f"{name}__{'lt' if descending else 'gt'}": value})
+                if nullable:
+                    after |= Q(**{f'{name}__isnull': True})
+                conditions.append(equal & after)
+                equal &= Q(**{name: value})
+            else:
+                equal &= Q(**{f'{name}__isnull': True})
+
+        if not conditions:
+            return Q(pk__in=[])
+
+        position_filter = reduce(or_, conditions)
+        # Redundant leading bound that lets the database start an index range scan at the cursor
+        name, descending, nullable = self.ordering[0]
+        if position[0] is not None and not nullable:
+            position_filter &= Q(**{f"{name}__{'lte' if descending else 'gte'}": position[0]})
+        return position_filter
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        position = [self.get_position_value(last, name) for name, _, _ in self.ordering]
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param,
+                                   self.encode_cursor(position))
+
+    @staticmethod
+    def get_position_value(instance, name):
+        if isinstance(instance, dict):
+            return instance[name]
+        value = instance
+        for attr in name.split('__'):
+            value = getattr(value, attr)
+            if value is None:
+                break
+        return value
+
+    def get_ordering_signature(self):
+        return [[name, descending] for name, descending, _ in self.ordering]
+
+    def encode_cursor(self, position):
+        payload = json.dumps({'o': self.get_ordering_signature(), 'p': position},
+                             cls=CursorJSONEncoder, separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)))
+            position = payload['p']
+            signature = payload['o']
+        except (binascii.Error, TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+        # A cursor is only meaningful for the ordering it was issued for
+        if signature != self.get_ordering_signature() or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+
+class WatermarkPagination(KeysetPagination):
+    """
+    Keyset pagination for change feeds ordered by a timestamp and the primary key. Every response carries
+    a `watermark` cursor for the last row returned (or the one given when nothing changed), so a client
+    can store it and later ask for only what changed since. `since` also takes an ISO 8601 datetime.
+    """
+    page_size = 500
+    max_page_size = 1000
+    cursor_query_param = 'since'
+
+    def decode_cursor(self, request):
+        since = request.query_params.get(self.cursor_query_param)
+        try:
+            since_datetime = since and parse_datetime(since)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if since_datetime:
+            # Everything changed at or after that moment: (since, pk > 0) covers both
+            return [since] + [0] * (len(self.ordering) - 1)
+        return super().decode_cursor(request)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request_cursor = request.query_params.get(self.cursor_query_param)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.page:
+            last = self.page[-1]
+            watermark = self.encode_cursor([self.get_position_value(last, name) for name, _, _ in self.ordering])
+        else:
+            watermark = self.request_cursor
+        return Response({'watermark': watermark, 'has_more': self.has_next, 'results': data})
+
+
+class CatalogPagination(BasePagination):
+    """Page-number pagination by default, keyset pagination when the client sends `?pagination=cursor`."""
+    mode_query_param = 'pagination'
+    cursor_mode = 'cursor'
+    page_number_class = DefaultPagination
+    keyset_class = KeysetPagination
+    # Every query parameter that can change the page, for views that cache it
+    query_params = ('pagination', 'page', 'page_size', 'count', 'cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get(self.mode_query_param) == self.cursor_mode:
+            self.paginator = self.keyset_class()
+        else:
+            self.paginator = self.page_number_class()
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
@@ -0,0 +1,196 @@
+import contextvars
+import cProfile
+import json
+import os
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+_current_profile = contextvars.ContextVar('request_profile', default=None)
+# Literals stripped from SQL so that the same statement run in a loop (an N+1) groups together
+SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+class RequestProfile:
+    """Time spent in the database and in serializers during one request; also the execute wrapper that records it."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.db_time += duration
+            self.queries.append((duration, sql))
+
+    @contextmanager
+    def serializing(self):
+        # Queries run while serializing, such as lazily loaded relations, stay database time
+        started, db_time = time.perf_counter(), self.db_time
+        try:
+            yield
+        finally:
+            self.serializer_time += time.perf_counter() - started - (self.db_time - db_time)
+
+    def server_timing(self, total):
+        app = total - self.db_time - self.serializer_time
+        return (f'db;dur={self.db_time * 1000:.2f};desc="{len(self.queries)} queries", '
+                f'serializer;dur={self.serializer_time * 1000:.2f}, app;dur={app * 1000:.2f}, '
+                f'total;dur={total * 1000:.2f}')
+
+    def query_breakdown(self, limit=20):
+        statements = Counter()
+        durations = Counter()
+        for duration, sql in self.queries:
+            statement = SQL_LITERAL_RE.sub('?', sql)
+            statements[statement] += 1
+            durations[statement] += duration
+        return {
+            'slowest': [{'ms': round(duration * 1000, 3), 'sql': sql}
+                        for duration, sql in sorted(self.queries, key=lambda query: -query[0])[:limit]],
+            'statements': [{'count': count, 'ms': round(durations[statement] * 1000, 3), 'sql': statement}
+                           for statement, count in statements.most_common(limit)],
+        }
+
+
+@contextmanager
+def serializer_timing():
+    """Count the block as serializer time of the request being profiled; a no-op for every other request."""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    with profile.serializing():
+        yield
+
+
+class ProfilingMiddleware:
+    """
+    Profiles every request when PROFILING_ENABLED is set, otherwise only requests from staff carrying an
+    `X-Profile` header; everything else goes straight through. A profiled response gets a Server-Timing
+    header splitting the time into database, serializer and remaining application time; views mark
+    their serializer work with `serializer_timing`. A PROFILING_SAMPLE_RATE
+    share of them is also run under cProfile and written to PROFILING_DIRECTORY together with a query
+    breakdown. cProfile only sees the thread it was enabled on: under ASGI that is the event loop, where
+    sync views and sync_to_async calls show up as time spent waiting on their worker thread.
+    """
+    sync_capable = True
+    async_capable = True
+    header = 'HTTP_X_PROFILE'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Under ASGI the chain stays async instead of running every request in a thread
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if settings.PROFILING_ENABLED or (request.META.get(self.header) and self.is_staff(request)):
+            return self.profile(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        # The staff check may query the database, which is not allowed from the event loop
+        if settings.PROFILING_ENABLED or (request.META.get(self.header)
+                                          and await sync_to_async(self.is_staff)(request)):
+            return await self.aprofile(request)
+        return await self.get_response(request)
+
+    @staticmethod
+    def is_staff(request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return user.is_staff
+        # API clients authenticate with a JWT, which DRF only checks later inside the view
+        try:
+            authenticated = JWTAuthentication().authenticate(request)
+        except AuthenticationFailed:
+            return False
+        return authenticated is not None and authenticated[0].is_staff
+
+    @staticmethod
+    def record_queries(profile):
+        """Send the queries of this thread's connections to `profile` until the returned stack is closed."""
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(profile))
+        return stack
+
+    @staticmethod
+    @contextmanager
+    def sampling(profiler):
+        if profiler is None:
+            yield
+            return
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+
+    @staticmethod
+    def start():
+        profiler = cProfile.Profile() if random.random() < settings.PROFILING_SAMPLE_RATE else None
+        return RequestProfile(), profiler
+
+    def profile(self, request):
+        profile, profiler = self.start()
+        token = _current_profile.set(profile)
+        try:
+            with self.record_queries(profile), self.sampling(profiler):
+                response = self.get_response(request)
+        finally:
+            _current_profile.reset(token)
+        return self.finish(request, response, profile, profiler)
+
+    async def aprofile(self, request):
+        profile, profiler = self.start()
+        # Connections belong to threads, and the sync code of one ASGI request all runs in the same worker
+        # thread, so that is where the query wrappers go
+        queries = await sync_to_async(self.record_queries)(profile)
+        # Sync views see the profile too: sync_to_async runs them in a copy of this context
+        token = _current_profile.set(profile)
+        try:
+            with self.sampling(profiler):
+                response = await self.get_response(request)
+        finally:
+            _current_profile.reset(token)
+            await sync_to_async(queries.close)()
+        return self.finish(request, response, profile, profiler)
+
+    def finish(self, request, response, profile, profiler):
+        total = time.perf_counter() - profile.started
+        response.headers['Server-Timing'] = profile.server_timing(total)
+        if profiler is not None:
+            self.dump(request, response, profile, profiler, total)
+        return response
+
+    @staticmethod
+    def dump(request, response, profile, profiler, total):
+        os.makedirs(settings.PROFILING_DIRECTORY, exist_ok=True)
+        slug = re.sub(r'[^\w-]+', '-', request.path).strip('-') or 'root'
+        path = os.path.join(settings.PROFILING_DIRECTORY,
+                            f'{timezone.now():%Y%m%dT%H%M%S%f}-{request.method}-{slug}')
+        profiler.dump_stats(f'{path}.prof')
+        with open(f'{path}.json', 'w') as file:
+            json.dump({'method': request.method, 'path': request.get_full_path(), 'status': response.status_code,
+                       'total_ms': round(total * 1000, 3), 'db_ms': round(profile.db_time * 1000, 3),
+                       'serializer_ms': round(profile.serializer_time * 1000, 3), 'queries': len(profile.queries),
+                       **profile.query_breakdown()}, file, indent=2)
@@ -1,9 +1,176 @@
+import asyncio
+import atexit
 import random
+import threading
 
+import httpx
+from django.conf import settings
+from django.utils.module_loading import import_string
 
-def purchase_gateway(price: int):
-    print('=-' * 20)
-    print("The payment was made successfully")
-    print(f"Amount paid: {price} IRR")
-    print('=-' * 20)
-    return random.randint(10000, 99999)
+from apps.utils.exceptions import PaymentGatewayException, PaymentGatewayUnavailable
+
+
+class BasePurchaseGateway:
+    """
+    Async payment gateway. `charge` bounds the number of in-flight payments, applies a timeout to every
+    attempt and retries transient failures with exponential backoff. Every attempt carries the caller's
+    idempotency key, so a retried payment is never taken twice.
+
+    Payments run on one event loop thread owned by the gateway, whichever loop awaits them: under WSGI
+    every request gets a short-lived loop of its own, which would otherwise get its own semaphore and
+    connection pool. `close` stops the thread and releases the pool.
+    """
+
+    def __init__(self, *, timeout=5.0, retries=2, retry_backoff=0.2, max_concurrency=20, **options):
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.max_concurrency = max_concurrency
+        self.options = options
+        self._lock = threading.Lock()
+        self._loop = None
+        self._semaphore = None
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=self._run_loop, args=(loop,), name='purchase-gateway', daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    @staticmethod
+    def _run_loop(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+        loop.close()
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    async def aclose(self):
+        self._semaphore = None
+
+    async def charge(self, price: int, idempotency_key: str):
+        future = asyncio.run_coroutine_threadsafe(self._charge(price, idempotency_key), self._get_loop())
+        return await asyncio.wrap_future(future)
+
+    async def _charge(self, price, idempotency_key):
+        # Only ever touched from the gateway loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    return await asyncio.wait_for(self.request_payment(price, idempotency_key), self.timeout)
+                except (asyncio.TimeoutError, PaymentGatewayUnavailable) as exc:
+                    if attempt == self.retries:
+                        raise PaymentGatewayUnavailable(f"Payment gateway failed after {attempt + 1} attempts") from exc
+                    await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+
+    async def request_payment(self, price: int, idempotency_key: str):
+        raise NotImplementedError
+
+
+class LocalPurchaseGateway(BasePurchaseGateway):
+    """
+    Stub gateway for development and tests, with optional `latency` (seconds) and `failure_rate` (0-1).
+    Like a real gateway it answers a repeated idempotency key with the first payment's tracking code, also
+    while that payment is still in flight.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._payments = {}
+
+    async def aclose(self):
+        await super().aclose()
+        for payment in self._payments.values():
+            payment.cancel()
+
+    async def request_payment(self, price: int, idempotency_key: str):
+        # Recorded before it is awaited, so concurrent attempts with one key wait for the same payment
+        payment = self._payments.get(idempotency_key)
+        if payment is None:
+            payment = self._payments[idempotency_key] = asyncio.ensure_future(self._pay(price))
+        try:
+            # Shielded: an attempt that times out leaves the payment running for the retry to pick up
+            return await asyncio.shield(payment)
+        except PaymentGatewayUnavailable:
+            # Nothing was taken, so the next attempt pays afresh
+            if self._payments.get(idempotency_key) is payment:
+                del self._payments[idempotency_key]
+            raise
+
+    async def _pay(self, price):
+        latency = self.options.get('latency', 0)
+        if latency:
+            await asyncio.sleep(latency)
+        if random.random() < self.options.get('failure_rate', 0):
+            raise PaymentGatewayUnavailable('Injected payment gateway failure')
+
+        print('=-' * 20)
+        print("The payment was made successfully")
+        print(f"Amount paid: {price} IRR")
+        print('=-' * 20)
+        return random.randint(10000, 99999)
+
+
+class HttpPurchaseGateway(BasePurchaseGateway):
+    """Calls a remote gateway at `url` through one pooled HTTP client."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            headers = {}
+            if self.options.get('api_key'):
+                headers['Authorization'] = f"Bearer {self.options['api_key']}"
+            limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+            self._client = httpx.AsyncClient(headers=headers, limits=limits, timeout=self.timeout)
+        return self._client
+
+    async def aclose(self):
+        await super().aclose()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def request_payment(self, price: int, idempotency_key: str):
+        try:
+            response = await self._get_client().post(self.options['url'], json={'amount': price},
+                                                     headers={'Idempotency-Key': idempotency_key})
+        except httpx.TransportError as exc:
+            raise PaymentGatewayUnavailable(str(exc)) from exc
+
+        if response.status_code >= 500:
+            raise PaymentGatewayUnavailable(f"Payment gateway responded with {response.status_code}")
+        if response.status_code >= 400:
+            raise PaymentGatewayException(f"Payment was rejected with {response.status_code}")
+        try:
+            return response.json()['tracking_code']
+        except (ValueError, KeyError, TypeError) as exc:
+            # The payment may have gone through, so this is an unknown outcome like a timeout
+            raise PaymentGatewayUnavailable(f"Unreadable payment gateway response: {exc!r}") from exc
+
+
+_gateway = None
+
+
+def get_purchase_gateway():
+    global _gateway
+    if _gateway is None:
+        _gateway = import_string(settings.PURCHASE_GATEWAY['BACKEND'])(**settings.PURCHASE_GATEWAY['OPTIONS'])
+        atexit.register(_gateway.close)
+    return _gateway
+
+
+async def purchase_gateway(price: int, idempotency_key: str):
+    return await get_purchase_gateway().charge(price, idempotency_key)
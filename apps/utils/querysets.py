@@ -0,0 +1,110 @@
+from functools import lru_cache
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField
+
+
+class QuerysetShape:
+    """
+    The columns, joins and prefetches a ModelSerializer reads. `only` is None when some field reads
+    something we cannot see statically (a method field, a model property), so the full row is loaded.
+    Top-level sources that are not model fields are fine as long as the queryset annotates them.
+    """
+
+    def __init__(self):
+        self.only = set()
+        self.annotations = set()
+        self.select_related = set()
+        self.prefetches = {}
+
+    def apply(self, queryset):
+        if self.select_related:
+            queryset = queryset.select_related(*sorted(self.select_related))
+        for path, (model, shape, only) in sorted(self.prefetches.items()):
+            prefetch_queryset = model._default_manager.all()
+            if shape is not None:
+                prefetch_queryset = shape.apply(prefetch_queryset)
+            elif only:
+                prefetch_queryset = prefetch_queryset.only(*only)
+            queryset = queryset.prefetch_related(Prefetch(path, queryset=prefetch_queryset))
+        if self.only is not None and self.annotations <= set(queryset.query.annotations):
+            queryset = queryset.only(*sorted(self.only))
+        return queryset
+
+
+def _collect(shape, serializer, model, prefix):
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        if field.source == '*' or isinstance(field, serializers.SerializerMethodField):
+            shape.only = None
+            continue
+
+        current_model = model
+        path = []
+        attrs = field.source_attrs
+        for index, attr in enumerate(attrs):
+            last = index == len(attrs) - 1
+            try:
+                model_field = current_model._meta.get_field(attr)
+            except FieldDoesNotExist:
+                if not prefix and not path:
+                    shape.annotations.add(attr)
+                else:
+                    # A property or method: we cannot tell which columns it needs
+                    shape.only = None
+                break
+
+            lookup = prefix + '__'.join(path + [attr])
+            if model_field.many_to_many or model_field.one_to_many:
+                related_model = model_field.related_model
+                child = getattr(field, 'child', None) or getattr(field, 'child_relation', None)
+                if isinstance(child, serializers.ModelSerializer):
+                    child_shape = QuerysetShape()
+                    _collect(child_shape, child, related_model, '')
+                    if model_field.one_to_many and child_shape.only is not None:
+                        child_shape.only.add(model_field.field.name)
+                    shape.prefetches[lookup] = (related_model, child_shape, None)
+                elif isinstance(field, ManyRelatedField) and isinstance(child, PrimaryKeyRelatedField):
+                    only = [related_model._meta.pk.name]
+                    if model_field.one_to_many:
+                        only.append(model_field.field.name)
+                    shape.prefetches[lookup] = (related_model, None, only)
+                else:
+                    shape.prefetches[lookup] = (related_model, None, None)
+                break
+
+            if model_field.is_relation:
+                if shape.only is not None:
+                    shape.only.add(lookup)
+                if last and isinstance(field, PrimaryKeyRelatedField):
+                    break
+                shape.select_related.add(lookup)
+                if last:
+                    if isinstance(field, serializers.ModelSerializer):
+                        _collect(shape, field, model_field.related_model, lookup + '__')
+                    elif shape.only is not None:
+                        # Related fields rendered as a whole object (e.g. StringRelatedField) need every column
+                        shape.only |= {f'{lookup}__{f.name}' for f in model_field.related_model._meta.concrete_fields}
+                    break
+                path.append(attr)
+                current_model = model_field.related_model
+                continue
+
+            if shape.only is not None:
+                shape.only.add(lookup)
+            break
+
+
+@lru_cache(maxsize=None)
+def get_queryset_shape(serializer_class):
+    shape = QuerysetShape()
+    _collect(shape, serializer_class(), serializer_class.Meta.model, '')
+    return shape
+
+
+def shape_queryset(queryset, serializer_class):
+    """Restrict `queryset` to what `serializer_class` renders, joining and prefetching its relations."""
+    return get_queryset_shape(serializer_class).apply(queryset)
@@ -0,0 +1,40 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class _Echo:
+    """File-like object whose `write` hands back what it was given, so csv.writer can format single rows."""
+
+    def write(self, value):
+        return value
+
+
+def _batched(lines, batch_size):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def ndjson_stream(rows, batch_size=500):
+    """Encode an iterable of dicts as JSON Lines, lazily, `batch_size` lines per yielded chunk."""
+    encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    return _batched((encoder.encode(row) + '\n' for row in rows), batch_size)
+
+
+def csv_stream(rows, fields, batch_size=500):
+    """Encode an iterable of dicts as CSV with a header of `fields`, lazily, like `ndjson_stream`."""
+    writer = csv.writer(_Echo())
+
+    def lines():
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow([row[field] for field in fields])
+
+    return _batched(lines(), batch_size)
@@ -0,0 +1,57 @@
+import json
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryCountAssertionsMixin:
+    def assertConstantQueries(self, request, grow, sizes=(1, 5, 25), expected=None, using=DEFAULT_DB_ALIAS):
+        """
+        For each size, call `grow(size)` to bring the data set up to that size and then `request()`.
+        Fails unless every request ran the same number of queries (and `expected`, if given).
+        """
+        counts = {}
+        for size in sizes:
+            grow(size)
+            with CaptureQueriesContext(connections[using]) as context:
+                request()
+            counts[size] = len(context.captured_queries)
+
+        self.assertEqual(len(set(counts.values())), 1, f"Query count grows with the data set: {counts}")
+        if expected is not None:
+            self.assertEqual(counts[sizes[0]], expected, f"Expected {expected} queries, got {counts}")
+        return counts[sizes[0]]
+
+
+class QueryPlanAssertionsMixin:
+    def assertNoSequentialScans(self, func, tables, using=DEFAULT_DB_ALIAS):
+        """
+        Run `func()`, EXPLAIN every SELECT it issued and fail if any plan reads one of `tables` with a
+        sequential scan. PostgreSQL only: other planners report their plans differently.
+        """
+        connection = connections[using]
+        with CaptureQueriesContext(connection) as context:
+            func()
+
+        offenders = []
+        with connection.cursor() as cursor:
+            for query in context.captured_queries:
+                sql = query['sql']
+                if not sql.lstrip().upper().startswith('SELECT'):
+                    continue
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                scanned = {node['Relation Name'] for node in _plan_nodes(plan[0]['Plan'])
+                           if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in tables}
+                if scanned:
+                    offenders.append(f"{', '.join(sorted(scanned))}: {sql}")
+
+        self.assertFalse(offenders, 'Sequential scans:\n' + '\n'.join(offenders))
+
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get('Plans', ()):
+        yield from _plan_nodes(child)
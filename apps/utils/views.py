@@ -0,0 +1,92 @@
+import asyncio
+
+import hashlib
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.views import APIView
+
+from apps.utils.cache import read_through, versioned_key
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView whose handlers are coroutines. Authentication, permissions and throttling still run as
+    synchronous code in a worker thread; the handler itself runs on the event loop, so it can await slow
+    I/O without holding a worker. Under WSGI, Django runs the view through async_to_sync.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+
+class VersionedCacheMixin:
+    """
+    Caches response data under `cache_namespace`, keyed on the validated input and the listed raw query
+    parameters, until the namespace version is bumped or CATALOG_CACHE_TIMEOUT runs out. A timeout of 0
+    turns the cache off.
+    """
+    cache_namespace = None
+    cache_query_params = ()
+
+    def get_cached_data(self, request, validated_data, compute, *parts):
+        timeout = settings.CATALOG_CACHE_TIMEOUT
+        if not timeout:
+            return compute()
+        query_params = {name: request.query_params.get(name) for name in self.cache_query_params}
+        key = versioned_key(self.cache_namespace, request.get_host(), request.path, validated_data, query_params,
+                            *parts)
+        return read_through(key, compute, timeout)
+
+
+def make_etag(*parts):
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+    return quote_etag(digest[:32])
+
+
+class ConditionalGetMixin:
+    """
+    Conditional GET from validators the view works out before sending the body. `check_validators`
+    returns the 304 (or 412) response to send as is, or None to go on; successful responses carry the
+    validators as ETag and Last-Modified headers.
+    """
+
+    def check_validators(self, request, etag, last_modified=None):
+        self.validators = etag, last_modified
+        return get_conditional_response(request, etag=etag,
+                                        last_modified=last_modified and int(last_modified.timestamp()))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        validators = getattr(self, 'validators', None)
+        if validators is not None and response.status_code in (200, 304):
+            etag, last_modified = validators
+            response.headers['ETag'] = etag
+            if last_modified is not None:
+                response.headers['Last-Modified'] = http_date(last_modified.timestamp())
+        return response
@@ -32,6 +32,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'apps.user',
     'apps.shop',
@@ -43,6 +44,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'apps.utils.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -83,6 +85,15 @@ DATABASES = {
     }
 }
 
+# Cache
+# Anything shared between workers (OTPs, idempotency keys) needs a shared backend such as Redis in production
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -138,3 +149,51 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 AUTH_USER_MODEL = 'user.User'
+
+# Product search
+# Empty selects the tsvector backend on PostgreSQL and the in-memory index elsewhere
+PRODUCT_SEARCH_BACKEND = config('PRODUCT_SEARCH_BACKEND', default='')
+
+# Minimum trigram word similarity (0-1) of a product name to a `fuzzy=true` search
+PRODUCT_FUZZY_SEARCH_THRESHOLD = config('PRODUCT_FUZZY_SEARCH_THRESHOLD', default=0.4, cast=float)
+
+# Seconds a product change waits before the change feed (products/changes/) shows it, so that writes
+# still in flight with an earlier `updated` are never skipped by a client's watermark
+PRODUCT_CHANGES_LAG = config('PRODUCT_CHANGES_LAG', default=5, cast=int)
+
+# Age in seconds after which a worker rebuilds its name suggestion index in the background
+SUGGEST_INDEX_TTL = config('SUGGEST_INDEX_TTL', default=300, cast=int)
+
+# Upper bounds (exclusive, in IRR) of the price facet buckets; the last bucket is open ended
+PRODUCT_PRICE_FACET_BOUNDS = [500_000, 1_000_000, 5_000_000, 10_000_000, 50_000_000]
+
+# How long each worker keeps its copy of the city and category tables before reloading them, in seconds
+REGISTRY_TTL = config('REGISTRY_TTL', default=300, cast=int)
+
+# How long anonymous catalog pages (products and categories) stay cached, in seconds; 0 turns the cache off
+CATALOG_CACHE_TIMEOUT = config('CATALOG_CACHE_TIMEOUT', default=60, cast=int)
+
+# How long responses to requests sent with an Idempotency-Key header are kept, in seconds
+IDEMPOTENCY_KEY_TTL = config('IDEMPOTENCY_KEY_TTL', default=24 * 60 * 60, cast=int)
+
+# Profile every request (Server-Timing header); otherwise only staff requests sent with an X-Profile header
+PROFILING_ENABLED = config('PROFILING_ENABLED', default=False, cast=bool)
+
+# Share of profiled requests also run under cProfile and written to PROFILING_DIRECTORY, from 0 to 1
+PROFILING_SAMPLE_RATE = config('PROFILING_SAMPLE_RATE', default=0.0, cast=float)
+PROFILING_DIRECTORY = config('PROFILING_DIRECTORY', default=str(BASE_DIR / 'profiles'))
+
+# Payment gateway
+PURCHASE_GATEWAY = {
+    'BACKEND': config('PURCHASE_GATEWAY_BACKEND', default='apps.utils.purchase_gateway.LocalPurchaseGateway'),
+    'OPTIONS': {
+        'timeout': config('PURCHASE_GATEWAY_TIMEOUT', default=5.0, cast=float),
+        'retries': config('PURCHASE_GATEWAY_RETRIES', default=2, cast=int),
+        'max_concurrency': config('PURCHASE_GATEWAY_MAX_CONCURRENCY', default=20, cast=int),
+        'url': config('PURCHASE_GATEWAY_URL', default=''),
+        'api_key': config('PURCHASE_GATEWAY_API_KEY', default=''),
+        # Local stub only: simulated latency in seconds and the share of payments that fail
+        'latency': config('PURCHASE_GATEWAY_LATENCY', default=0.0, cast=float),
+        'failure_rate': config('PURCHASE_GATEWAY_FAILURE_RATE', default=0.0, cast=float),
+    },
+}